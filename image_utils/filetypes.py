@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+from typing import Optional
+
+# ISO base media files (HEIF, AVIF and Canon's CR3) name their flavour in
+# the brand following the 'ftyp' box
+FTYP_BRANDS = {
+    b"heic": "heic",
+    b"heix": "heic",
+    b"hevc": "heic",
+    b"hevx": "heic",
+    b"heim": "heic",
+    b"heis": "heic",
+    b"mif1": "heif",
+    b"msf1": "heif",
+    b"avif": "avif",
+    b"avis": "avif",
+    b"crx ": "cr3",
+}
+
+# Sizes of the DIB headers which may follow a BMP's 'BM' marker
+BMP_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """
+    Identify an image format from the first bytes of a file. Returns a short
+    name, e.g. 'jpeg' or 'cr2', or None if the signature isn't one we know.
+    """
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header.startswith(b"FUJIFILMCCD-RAW"):
+        return "raf"
+    if header[:4] in (b"IIRO", b"IIRS", b"MMOR"):
+        return "orf"
+    if header[:4] == b"IIU\x00":
+        return "rw2"
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        # CR2 marks itself after the TIFF header, NEF, ARW and DNG are plain
+        # TIFF containers as far as the first bytes go
+        if header[8:10] == b"CR":
+            return "cr2"
+        return "tiff"
+    if header[4:8] == b"ftyp":
+        return FTYP_BRANDS.get(header[8:12])
+    if header[:2] == b"BM" and int.from_bytes(header[14:18], "little") in (
+        BMP_HEADER_SIZES
+    ):
+        return "bmp"
+    return None
@@ -2,22 +2,24 @@
 
 import asyncio
 import argparse
+import concurrent.futures
 import datetime
 import json
 import logging
 import os
 import pprint
 import sys
-import shutil
 import time
 
 from image_cache import ImageCache
 from image_cache import ImageHelper
+from image_cache import VERIFY_LEVELS
+from image_cache import WORKER_MODES
+from metrics import log_progress
+from transfer import TRANSFER_MODES
+from transfer import transfer_file
 
-from PIL import Image
-from PIL.ExifTags import TAGS
-
-from typing import Dict
+from typing import Dict, Optional
 
 # Setup a logger
 logging.basicConfig(
@@ -28,12 +30,17 @@ logging.basicConfig(
 logger = logging.getLogger("image_util")
 
 
-async def gen_database(path: str, fast: bool) -> None:
+async def gen_database(
+    path: str, fast: bool, cluster_distance: Optional[int] = None, **cache_opts
+) -> None:
     """
     Takes in a target directory and computes information about
     the images contained therin
+
+    When `cluster_distance` is set the report also groups every image into
+    clusters whose phash and dhash are within that many bits of each other.
     """
-    ic = ImageCache(fast=fast)
+    ic = ImageCache(fast=fast, **cache_opts)
     await ic.gen_cache_from_directory(path)
 
     report = {}
@@ -44,16 +51,28 @@ async def gen_database(path: str, fast: bool) -> None:
         "total_images": "SELECT COUNT(*) FROM {};",
         "average_size": "SELECT AVG(size) FROM {};",
         "total_size": "SELECT SUM(size) FROM {};",
+        "dated_images": "SELECT COUNT(date_taken) FROM {};",
     }
 
     for k, v in queries.items():
         rows = ic.query(v.format(ic.get_table()))
         report[k] = rows[0][0]
 
+    # The cameras are read from the cached EXIF, no file is opened again
+    report["cameras"] = dict(
+        ic.query(
+            f"SELECT camera_model, COUNT(*) FROM {ic.get_table()} "
+            + "WHERE camera_model IS NOT NULL GROUP BY camera_model;"
+        )
+    )
+
     # Get duplicate and ambiguous images
     report["duplicates"] = ic.get_duplicates()
     report["ambiguous"] = ic.get_ambiguous()
+    if cluster_distance is not None:
+        report["clusters"] = ic.find_clusters(cluster_distance)
     report["process_time"] = ic.processing_time
+    report["metrics"] = ic.metrics.snapshot()
 
     pp = pprint.PrettyPrinter(indent=2, compact=False)
     pp.pprint(report)
@@ -69,16 +88,26 @@ async def gen_database(path: str, fast: bool) -> None:
 
 
 async def find_dupes(
-    source: str, target: str, skip: bool, fast: bool
+    source: str,
+    target: str,
+    skip: bool,
+    fast: bool,
+    similarity: Optional[int] = None,
+    **cache_opts,
 ) -> Dict[str, any]:
     """
     Use the Image Cache helper class to read in the source directory
     to an sqlite3 DB, compute hashes and any necessary pieces for checking
     if the two images are the same. Then given the target directory, check
     to see if the image already exists, if it does to a pprint report
-    about all potential dupes
+    about all potential dupes. Images which only differ from a source image
+    in their metadata count as duplicates too, by their pixel hash.
+
+    When `similarity` is set, target images which aren't exact duplicates
+    are also checked for a source image whose phash is within that many bits,
+    catching resized or re-encoded copies.
     """
-    ic = ImageCache(fast=fast)
+    ic = ImageCache(fast=fast, **cache_opts)
     if not skip:
         await ic.gen_cache_from_directory(source)
         logger.info(f"Processing took {ic.processing_time} seconds.")
@@ -90,50 +119,58 @@ async def find_dupes(
         + "long time."
     )
 
+    if ic.verify is not None:
+        # Only read each target as far as the verification level needs
+        images, classified = await ic.verify_directory(
+            target, perceptual=similarity is not None
+        )
+    else:
+        # Hash the whole target with the worker pool, then classify every file
+        # against the cache in a handful of set based queries
+        images = await ic.hash_directory(target, perceptual=similarity is not None)
+        # Source files cached by size first filtering only get an md5 once a
+        # target file of the same size turns up
+        await ic.complete_digests({image.size for image in images})
+        classified = ic.classify_targets(images)
+
+    for full, original in classified["duplicates"]:
+        logger.warning(f"Duplicate image verified: {full} already exists at {original}")
+    for full, original in classified["ambiguous"]:
+        logger.warning(
+            f"Ambiguous files detected. {full} has same size and "
+            + f"crc32 as source directory file {original}, but md5 "
+            + "does not match."
+        )
+
     report = {
-        "duplicates": [],
-        "ambiguous": [],
+        "duplicates": [full for full, _ in classified["duplicates"]],
+        "ambiguous": [full for full, _ in classified["ambiguous"]],
         "migrate": [],
     }
 
-    for root, _, filenames in os.walk(target):
-        logger.info(f"Processing {len(filenames)} files in {root}")
-        for f in filenames:
-            full: str = os.path.join(root, f)
-            image: ImageHelper = ImageHelper(full)
-            image.check_image_type()
-            if not image.is_image:
-                continue
-
-            image.read_image()
-            image.compute_md5()
+    if similarity is not None:
+        report["similar"] = []
+        phashes = {image.full_path: image.phash for image in images}
 
-            # Check if the file/size exists in the db.
-            row = ic.lookup(f"WHERE md5 = '{image.md5}'")
-            if len(row) > 0:
-
-                # If file and size are the same, grab the crc32 and md5 to verify dupe
+    for full, _ in classified["migrate"]:
+        if similarity is not None:
+            # A file the pool failed to hash has no phash
+            matches = ic.find_similar(phashes.get(full, ""), similarity)
+            if len(matches) > 0:
+                distance, original = matches[0]
                 logger.warning(
-                    f"Duplicate image verified: {full} already exists in "
-                    + f"at {row[2]}"
+                    f"Similar image detected. {full} is within {distance} "
+                    + f"bits of source directory file {original}."
                 )
-                report["duplicates"].append(image.full_path)
-                continue
-            else:
-                row = ic.lookup(
-                    f"WHERE crc32 = '{image.crc32}' and size = '{image.size}'"
+                report["similar"].append(
+                    {"original": original, "duplicate": full, "distance": distance}
                 )
-                if len(row) > 0:
-                    logger.warning(
-                        f"Ambiguous files detected. {full} has same size and "
-                        + f"crc32 as source directory file {row[2]}, but md5 "
-                        + "does not match."
-                    )
-                    report["ambiguous"].append(image.full_path)
-                    continue
-
-            # Add the file to the list of potentials to migrate
-            report["migrate"].append(image.full_path)
+                continue
+
+        # Add the file to the list of potentials to migrate
+        report["migrate"].append(full)
+
+    report["metrics"] = ic.metrics.snapshot()
 
     pp = pprint.PrettyPrinter(indent=2, compact=False)
     pp.pprint(report)
@@ -143,56 +180,136 @@ async def find_dupes(
     logger.info(
         f"Report:\n\tDuplicates:\t{len(report['duplicates'])}"
         + f"\n\tAmbiguous:\t{len(report['ambiguous'])}"
+        + f"\n\tSimilar:\t{len(report.get('similar', []))}"
         + f"\n\tUnique:\t{len(report['migrate'])}"
     )
     tstamp = datetime.datetime.now().strftime("find_dupes_%Y-%m-%d.json")
     with open(tstamp, "w") as fout:
         fout.write(json.dumps(report))
     logger.info(f"Report written to {tstamp}")
+    return report
 
 
-def get_exif(img_path: str) -> Dict[str, str]:
-    image = Image.open(img_path)
-    exif = {}
-    img_exif = image._getexif()
-    if img_exif is not None:
-        for (k, v) in img_exif.items():
-            exif[TAGS.get(k)] = v
-    return exif
-
-
-async def sort_images(source: str, dest: str) -> None:
-    # Helper function to read in a directory of pictures and sort them all
-    # based off of exif metadata. By default the sorting happens by /YYYY/MM
-    for root, _, filenames in os.walk(source):
-        logger.info(f"Processing {len(filenames)} files in {root}")
-        for f in filenames:
-            full = os.path.join(root, f)
-            # Use an ImageHelper for convenience
-            ic = ImageHelper(full)
-            ic.check_image_type()
-            if not ic.is_image:
-                logger.warning(
-                    f"Encountered file which is not an image: {ic.full_path}"
-                )
-                continue
-            exif = get_exif(full)
-            if exif == {}:
-                logger.warning(f"Failed to find exif data for {full}")
-                continue
-
-            dt = time.strptime(exif["DateTimeOriginal"], "%Y:%m:%d %H:%M:%S")
-            new_dest = os.path.join(dest, str(dt.tm_year), str(dt.tm_mon))
-            if not os.path.exists(new_dest):
-                os.makedirs(new_dest)
+def _sort_file(full: str, new_path: str, md5: str, transfer: str) -> str:
+    """
+    Transfer one planned file, unless an identical copy is already there
+    """
+    if os.path.exists(new_path):
+        if os.path.samefile(full, new_path):
+            return "skipped"
+        existing = ImageHelper(new_path)
+        if existing.size == os.stat(full).st_size:
+            # Rows from size first filtering don't have an md5 yet
+            if not md5:
+                original = ImageHelper(full)
+                original.read_image(keep_data=False)
+                md5 = original.md5
+            existing.read_image(keep_data=False)
+            if existing.md5 == md5:
+                return "skipped"
+        logger.warning(f"Replacing {new_path}, it differs from {full}")
+        os.remove(new_path)
+    return transfer_file(full, new_path, transfer)
+
+
+async def sort_images(
+    source: str,
+    dest: str,
+    skip: bool = False,
+    transfer: str = "copy",
+    transfer_workers: Optional[int] = None,
+    **cache_opts,
+) -> Dict[str, int]:
+    """
+    Sort the images under `source` into `dest` by the date they were taken,
+    as /YYYY/MM. The source is cached first, unless `skip` is set, and every
+    transfer is planned from the EXIF dates in the cache before any file is
+    touched. The transfers are then run by a pool of threads, see
+    transfer.transfer_file for the `transfer` modes. Files already at their
+    destination with a matching md5 are skipped. Returns how many files were
+    handled each way.
+    """
+    ic = ImageCache(**cache_opts)
+    if not skip:
+        await ic.gen_cache_from_directory(source)
 
-            # Copy the file, including metadata
-            shutil.copy(full, os.path.join(new_dest, f))
-            shutil.copystat(full, os.path.join(new_dest, f))
+    prefix = os.path.join(source, "")
+    rows = ic.query(
+        f"""SELECT full_path, filename, md5, ahash, date_taken FROM {ic.get_table()}
+        WHERE full_path >= ? AND full_path < ?;""",
+        (prefix, prefix + chr(0x10FFFF)),
+    )
+    plan = {}
+    planned = set()
+    for full, filename, md5, ahash, date_taken in rows:
+        # Copies of a file are all cached, only sort one of them
+        if md5 and md5 in planned:
+            continue
+        # Files which were never opened, from size first filtering, haven't
+        # had their EXIF read yet
+        if date_taken is None and not ahash:
+            image = ImageHelper(full)
+            try:
+                image.compute_exif()
+            except OSError as e:
+                logger.warning(f"Failed to read exif data for {full} with {e}")
+                continue
+            date_taken = image.date_taken
+        if date_taken is None:
+            logger.warning(f"Failed to find exif data for {full}")
+            continue
+        try:
+            dt = time.strptime(date_taken, "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            logger.warning(f"Failed to parse exif date {date_taken} for {full}")
+            continue
+
+        new_path = os.path.join(dest, str(dt.tm_year), str(dt.tm_mon), filename)
+        # Two transfers racing for the same name would clobber each other
+        if new_path in plan:
+            logger.warning(
+                f"Not sorting {full}, {plan[new_path][0]} is also sorted to {new_path}"
+            )
+            continue
+        plan[new_path] = (full, md5)
+        planned.add(md5)
+
+    logger.info(f"Sorting {len(plan)} images from {source} into {dest}")
+    for new_dest in set(os.path.dirname(new_path) for new_path in plan):
+        os.makedirs(new_dest, exist_ok=True)
+
+    def run(new_path: str) -> str:
+        full, md5 = plan[new_path]
+        try:
+            return _sort_file(full, new_path, md5, transfer)
+        except OSError as e:
+            logger.warning(f"Failed to sort {full} to {new_path} with {e}")
+            return "failed"
+
+    counts: Dict[str, int] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=transfer_workers) as pool:
+        for new_path, outcome in zip(plan, pool.map(run, plan)):
+            counts[outcome] = counts.get(outcome, 0) + 1
+            # Keep the cache pointing at files we moved
+            if outcome == "moved":
+                ic.rename(plan[new_path][0], new_path)
+
+    logger.info(f"Completed sorting: {counts}")
+    return counts
 
 
 async def main(
-    source: str, target: str, genstats: bool, should_sort: bool, skip: bool, fast: bool
+    source: str,
+    target: str,
+    genstats: bool,
+    should_sort: bool,
+    skip: bool,
+    fast: bool,
+    similarity: Optional[int] = None,
+    cluster_distance: Optional[int] = None,
+    transfer: str = "copy",
+    transfer_workers: Optional[int] = None,
+    **cache_opts,
 ) -> None:
 
     if not os.path.exists(source):
@@ -202,15 +319,17 @@ async def main(
     # TODO: Might be able to immediate declare/make an ImageCache, as
     # everyone already takes the `source` dir...
     if should_sort:
-        await sort_images(source, target)
+        await sort_images(
+            source, target, skip, transfer, transfer_workers, **cache_opts
+        )
     elif genstats:
-        await gen_database(source, fast)
+        await gen_database(source, fast, cluster_distance, **cache_opts)
         return
     else:
         if not os.path.exists(target):
             logger.error(f"Directory does not exist: {target}")
             sys.exit()
-        await find_dupes(source, target, skip, fast)
+        await find_dupes(source, target, skip, fast, similarity, **cache_opts)
 
 
 if __name__ == "__main__":
@@ -252,7 +371,146 @@ if __name__ == "__main__":
         help="When set, sort the images specified with '-d' by year and "
         + "as extracted from exif metadata on the image.",
     )
+    parser.add_argument(
+        "--transfer",
+        choices=TRANSFER_MODES,
+        default="copy",
+        help="How --sort_images puts files in place. 'copy' (default) clones "
+        + "files where the filesystem supports it, 'link' hard links and "
+        + "'move' renames them when source and destination share a filesystem.",
+    )
+    parser.add_argument(
+        "--transfer_workers",
+        type=int,
+        default=None,
+        help="Number of threads transferring files while sorting.",
+    )
     parser.add_argument("-f", "--fast", default=False, action="store_true")
+    parser.add_argument(
+        "--refresh",
+        default=False,
+        action="store_true",
+        help="Only hash source files which are new or have changed since the "
+        + "cache was last generated, and drop files which have been deleted.",
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        action="store_true",
+        help="Pick up an interrupted cache generation or target scan where it "
+        + "stopped, rather than starting over.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of workers used to hash images while building the cache. "
+        + "Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--worker_mode",
+        choices=WORKER_MODES,
+        default="process",
+        help="Hash images in a pool of processes (default) or threads.",
+    )
+    parser.add_argument(
+        "--size_first",
+        default=False,
+        action="store_true",
+        help="Only fully hash source files whose size and partial hash match "
+        + "another file. Unique files are read in full only if a target file "
+        + "of the same size shows up. Until then they have no pixel hash, so "
+        + "copies of them with edited metadata are not found.",
+    )
+    parser.add_argument(
+        "--verify",
+        choices=VERIFY_LEVELS,
+        default=None,
+        help="Check target files against the source only as far as needed: "
+        + "'size', then the 'partial' digest, then the full 'md5', each read "
+        + "only for files which matched at the one before. 'pixels' also "
+        + "decodes files with the same phash as a source file and compares "
+        + "the images, catching copies whose metadata was edited. By default "
+        + "every target is hashed in full.",
+    )
+    parser.add_argument(
+        "--similar",
+        type=int,
+        default=None,
+        metavar="DISTANCE",
+        help="Also report target images whose phash is within DISTANCE bits of "
+        + "a source image, to catch resized or re-encoded copies.",
+    )
+    parser.add_argument(
+        "--cluster",
+        type=int,
+        default=None,
+        metavar="DISTANCE",
+        help="With --genstats, group visually similar images whose phash and "
+        + "dhash are within DISTANCE bits of each other.",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Only scan files whose name matches GLOB, e.g. '*.jpg'. May be "
+        + "given more than once.",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Skip files and directories whose name matches GLOB. May be given "
+        + "more than once.",
+    )
+    parser.add_argument(
+        "--include_hidden",
+        default=False,
+        action="store_true",
+        help="Also scan dot files and hidden or NAS system directories, such "
+        + "as @eaDir and #recycle.",
+    )
+    parser.add_argument(
+        "--scan_workers",
+        type=int,
+        default=1,
+        help="Number of threads listing directories in parallel. Helps on slow "
+        + "network shares.",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=256,
+        help="Number of files allowed to wait between each stage of the "
+        + "walk, hash and write pipeline.",
+    )
+    parser.add_argument(
+        "--io_concurrency",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Read up to N files at once ahead of the hashing workers, and "
+        + "move the SQLite work off the event loop. For high latency NFS and "
+        + "SMB shares, where reads wait on the network rather than the disk.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=500,
+        help="Number of new cache rows written and committed together.",
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Log throughput, error counts and queue depths every SECONDS "
+        + "while files are processed. Per stage timings are always included "
+        + "in the report.",
+    )
     args = parser.parse_args()
 
     # TODO: Use args/kwargs :P
@@ -264,5 +522,24 @@ if __name__ == "__main__":
             args.sort_images,
             args.skip_cache_gen,
             args.fast,
+            similarity=args.similar,
+            cluster_distance=args.cluster,
+            transfer=args.transfer,
+            transfer_workers=args.transfer_workers,
+            workers=args.workers,
+            worker_mode=args.worker_mode,
+            refresh=args.refresh,
+            resume=args.resume,
+            batch_size=args.batch_size,
+            size_first=args.size_first,
+            include=tuple(args.include),
+            exclude=tuple(args.exclude),
+            skip_hidden=not args.include_hidden,
+            scan_workers=args.scan_workers,
+            queue_size=args.queue_size,
+            io_concurrency=args.io_concurrency,
+            verify=args.verify,
+            progress_interval=args.progress,
+            hooks=(log_progress,) if args.progress else (),
         )
     )
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import contextlib
+import logging
+import threading
+import time
+
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger("metrics")
+
+# Hooks are called with the event name, 'progress' or 'finished', and a
+# snapshot of the metrics
+Hook = Callable[[str, Dict[str, any]], None]
+
+
+class Metrics(object):
+    """
+    Per stage timings and counters for a run. Stages are timed wherever the
+    work happens, in the hashing workers too, whose timings travel back on the
+    ImageHelper and are merged in by `record_image`. Hooks receive a snapshot
+    every `progress_interval` seconds while files are being processed, and
+    once more when a run finishes.
+    """
+
+    def __init__(self, progress_interval: Optional[float] = None) -> None:
+        self.progress_interval = progress_interval
+        self.started = time.perf_counter()
+        self.stages: Dict[str, List[float]] = {}
+        self.counters: Dict[str, int] = {}
+        self.queues: Dict[str, Dict[str, int]] = {}
+        self._hooks: List[Hook] = []
+        self._last_progress = self.started
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Hook) -> None:
+        """
+        Register a callable to be handed snapshots, see the class docstring
+        """
+        self._hooks.append(hook)
+
+    def add_time(self, stage: str, seconds: float, count: int = 1) -> None:
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += count
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, count: int = 1):
+        """
+        Time the body of a with block as one or more `count` of a stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start, count)
+
+    def increment(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def queue_depth(self, queue: str, depth: int) -> None:
+        """
+        Track the current and deepest size seen of a pipeline queue
+        """
+        with self._lock:
+            depths = self.queues.setdefault(queue, {"current": 0, "max": 0})
+            depths["current"] = depth
+            depths["max"] = max(depths["max"], depth)
+
+    def record_image(self, image) -> None:
+        """
+        Count a processed file and merge in the stage timings it carries
+        """
+        for stage, seconds in image.timings.items():
+            self.add_time(stage, seconds)
+        self.increment("files")
+        self.increment("bytes", image.size)
+        self.tick()
+
+    def tick(self) -> None:
+        """
+        Hand a progress snapshot to the hooks if one is due
+        """
+        if self.progress_interval is None or not self._hooks:
+            return
+        now = time.perf_counter()
+        if now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        self.emit("progress")
+
+    def emit(self, event: str) -> None:
+        snapshot = self.snapshot()
+        for hook in self._hooks:
+            hook(event, snapshot)
+
+    def snapshot(self) -> Dict[str, any]:
+        """
+        The metrics so far as plain values, ready for a JSON report
+        """
+        with self._lock:
+            elapsed = time.perf_counter() - self.started
+            files = self.counters.get("files", 0)
+            size = self.counters.get("bytes", 0)
+            return {
+                "elapsed": round(elapsed, 3),
+                "files_per_second": round(files / elapsed, 2) if elapsed else 0,
+                "bytes_per_second": round(size / elapsed, 2) if elapsed else 0,
+                "stages": {
+                    stage: {"seconds": round(seconds, 6), "count": count}
+                    for stage, (seconds, count) in sorted(self.stages.items())
+                },
+                "counters": dict(self.counters),
+                "queues": {name: dict(depths) for name, depths in self.queues.items()},
+            }
+
+
+def log_progress(event: str, snapshot: Dict[str, any]) -> None:
+    """
+    A hook writing each snapshot out as a one line progress report
+    """
+    counters = snapshot["counters"]
+    queues = " ".join(
+        f"{name}={depths['current']}" for name, depths in snapshot["queues"].items()
+    )
+    logger.info(
+        f"[{event}] {counters.get('files', 0)} files in {snapshot['elapsed']:.0f}s, "
+        + f"{snapshot['files_per_second']:.1f} files/s, "
+        + f"{snapshot['bytes_per_second'] / 1048576:.1f} MiB/s, "
+        + f"{counters.get('errors', 0)} errors, queues {queues or 'idle'}"
+    )
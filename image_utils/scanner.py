@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import fnmatch
+import logging
+import os
+
+from typing import Callable, Collection, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("scanner")
+
+# Directories NAS boxes and operating systems litter shares with, which never
+# hold anything we want to cache
+SYSTEM_DIRECTORIES = set(
+    [
+        "@eaDir",
+        "#recycle",
+        "#snapshot",
+        "$RECYCLE.BIN",
+        "System Volume Information",
+        "lost+found",
+    ]
+)
+
+# A scanned file, its full path and the stat taken while listing its directory
+ScannedFile = Tuple[str, os.stat_result]
+
+
+def _matches(name: str, patterns: Sequence[str]) -> bool:
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def _is_hidden(name: str) -> bool:
+    return name.startswith(".") or name in SYSTEM_DIRECTORIES
+
+
+def is_wanted(
+    name: str,
+    include: Sequence[str] = (),
+    exclude: Sequence[str] = (),
+    skip_hidden: bool = True,
+) -> bool:
+    """
+    Whether `walk` returns a file of this name, from a directory it lists
+    """
+    if skip_hidden and _is_hidden(name):
+        return False
+    if _matches(name, exclude):
+        return False
+    return not include or _matches(name, include)
+
+
+def is_walked(
+    path: str,
+    root: str,
+    include: Sequence[str] = (),
+    exclude: Sequence[str] = (),
+    skip_hidden: bool = True,
+) -> bool:
+    """
+    Whether `walk` of `root` returns the file at `path`, if it exists, as none
+    of the directories between them are skipped and its name is wanted
+    """
+    parts = os.path.relpath(path, root).split(os.sep)
+    for directory in parts[:-1]:
+        if directory == os.pardir:
+            return False
+        if (skip_hidden and _is_hidden(directory)) or _matches(directory, exclude):
+            return False
+    return is_wanted(parts[-1], include, exclude, skip_hidden)
+
+
+def _scan_directory(
+    path: str,
+    include: Sequence[str],
+    exclude: Sequence[str],
+    skip_hidden: bool,
+    skip_files: Collection[str],
+) -> Tuple[str, Optional[List[ScannedFile]], List[str]]:
+    """
+    List one directory, returning its files along with their stat and the
+    subdirectories still to be walked. The files are None if the directory
+    couldn't be listed.
+    """
+    files, directories = [], []
+    list_files = path not in skip_files
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if skip_hidden and _is_hidden(entry.name):
+                    continue
+                if _matches(entry.name, exclude):
+                    continue
+                try:
+                    # Like os.walk, don't descend into symlinked directories
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif list_files and entry.is_file():
+                        if include and not _matches(entry.name, include):
+                            continue
+                        files.append((entry.path, entry.stat()))
+                except OSError as e:
+                    logger.warning(f"Failed to stat {entry.path} with {e}")
+    except OSError as e:
+        logger.warning(f"Failed to list {path} with {e}")
+        files = None
+    return path, files, directories
+
+
+def walk(
+    root: str,
+    include: Sequence[str] = (),
+    exclude: Sequence[str] = (),
+    skip_hidden: bool = True,
+    workers: int = 1,
+    skip_files: Collection[str] = (),
+    failed: Optional[Callable[[str], None]] = None,
+) -> Iterator[Tuple[str, List[ScannedFile]]]:
+    """
+    Walk the tree under `root` with os.scandir, yielding every directory with
+    the (full_path, stat) of the files in it, so nothing downstream has to
+    stat them again.
+
+    File names must match one of the `include` globs, if any are given, and
+    files or directories matching an `exclude` glob are skipped, as are dot
+    files and hidden or NAS system directories unless `skip_hidden` is False.
+
+    With more than one worker, directories are listed by a pool of threads,
+    which hides the latency of cold network shares. Directories are then
+    yielded in the order they finish rather than top down.
+
+    Directories in `skip_files` are only searched for subdirectories, their
+    files aren't listed or stat'd. Used to resume an interrupted walk.
+    Directories which fail to list aren't yielded at all, so they are never
+    mistaken for empty ones, and are handed to `failed` if it is given.
+    """
+    if workers <= 1:
+        stack = [root]
+        while stack:
+            path, files, directories = _scan_directory(
+                stack.pop(), include, exclude, skip_hidden, skip_files
+            )
+            stack.extend(reversed(directories))
+            if files is not None:
+                yield path, files
+            elif failed is not None:
+                failed(path)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set(
+            [
+                executor.submit(
+                    _scan_directory, root, include, exclude, skip_hidden, skip_files
+                )
+            ]
+        )
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                path, files, directories = future.result()
+                for directory in directories:
+                    pending.add(
+                        executor.submit(
+                            _scan_directory,
+                            directory,
+                            include,
+                            exclude,
+                            skip_hidden,
+                            skip_files,
+                        )
+                    )
+                if files is not None:
+                    yield path, files
+                elif failed is not None:
+                    failed(path)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import numpy
+
+from typing import Any, List, Optional, Sequence, Tuple
+
+# Bits set in every byte value, for numpy versions without bitwise_count
+_POPCOUNT_TABLE = numpy.array([bin(i).count("1") for i in range(256)], numpy.uint8)
+
+
+def hamming(a: int, b: int) -> int:
+    """
+    Number of differing bits between two hashes
+    """
+    return bin(a ^ b).count("1")
+
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree over integer perceptual hashes. Every child is
+    keyed on its Hamming distance to its parent, so the triangle inequality
+    lets a search skip any subtree which can't hold a hash within range.
+    """
+
+    def __init__(self) -> None:
+        # Nodes are [hash, values, {distance: child}], values holds everything
+        # added under exactly the same hash
+        self.root = None
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, key: int, value: Any) -> None:
+        """
+        Add a value to the tree under the given hash
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key: int, max_distance: int) -> List[Tuple[int, Any]]:
+        """
+        Find every value whose hash is within `max_distance` bits of `key`.
+        Returns (distance, value) pairs, closest first.
+        """
+        matches = []
+        if self.root is None:
+            return matches
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, value) for value in node[1])
+            low = distance - max_distance
+            high = distance + max_distance
+            for child_distance, child in node[2].items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+def stored_to_array(values: Sequence[int]) -> numpy.ndarray:
+    """
+    Reinterpret 64 bit hashes stored as SQLite's signed integers as a uint64
+    array, without going through hex
+    """
+    return numpy.array(values, dtype=numpy.int64).view(numpy.uint64)
+
+
+def popcount64(values: numpy.ndarray) -> numpy.ndarray:
+    """
+    Count the set bits in every element of a uint64 array
+    """
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(values)
+    counts = _POPCOUNT_TABLE[numpy.ascontiguousarray(values).view(numpy.uint8)]
+    return counts.reshape(values.shape + (8,)).sum(axis=-1, dtype=numpy.uint8)
+
+
+def _close_pairs(
+    hashes: Sequence[numpy.ndarray], start: int, max_distance: int, block_size: int
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Compare one block of rows against itself and every later block, returning
+    the index pairs whose hashes are all within `max_distance` bits
+    """
+    first = hashes[0]
+    count = len(first)
+    left = first[start : start + block_size]
+    xor = numpy.empty((len(left), block_size), dtype=numpy.uint64)
+    found_rows, found_cols = [], []
+    for j in range(start, count, block_size):
+        right = first[j : j + block_size]
+        block = xor[:, : len(right)]
+        numpy.bitwise_xor(left[:, None], right[None, :], out=block)
+        close = popcount64(block) <= max_distance
+        # Most blocks hold nothing similar, and any() is far cheaper
+        if not close.any():
+            continue
+        rows, cols = numpy.nonzero(close)
+        rows += start
+        cols += j
+        # The diagonal block sees every pair twice, and itself
+        if j == start:
+            keep = rows < cols
+            rows, cols = rows[keep], cols[keep]
+        # The remaining hashes only need checking for the candidates
+        for other in hashes[1:]:
+            keep = popcount64(other[rows] ^ other[cols]) <= max_distance
+            rows, cols = rows[keep], cols[keep]
+        found_rows.append(rows)
+        found_cols.append(cols)
+
+    if not found_rows:
+        empty = numpy.empty(0, dtype=numpy.intp)
+        return empty, empty
+    return numpy.concatenate(found_rows), numpy.concatenate(found_cols)
+
+
+def cluster_hashes(
+    hashes: Sequence[numpy.ndarray],
+    max_distance: int,
+    block_size: int = 512,
+    workers: Optional[int] = None,
+) -> List[List[int]]:
+    """
+    Group items whose hashes are all within `max_distance` bits of each
+    other, transitively. `hashes` holds one uint64 array per hash type, each
+    with an entry per item. Every pair is compared with vectorized XOR and
+    popcount, a block_size square at a time so the working set stays in
+    cache, and blocks of rows are spread over `workers` threads as numpy
+    releases the GIL. Returns the indexes of every group with more than one
+    member.
+    """
+    count = len(hashes[0])
+    parent = list(range(count))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            lambda start: _close_pairs(hashes, start, max_distance, block_size),
+            range(0, count, block_size),
+        )
+        for rows, cols in results:
+            for a, b in zip(rows.tolist(), cols.tolist()):
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parent[root_b] = root_a
+
+    groups = {}
+    for i in range(count):
+        groups.setdefault(find(i), []).append(i)
+    return [group for group in groups.values() if len(group) > 1]
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("transfer")
+
+# How a file gets to its destination. 'copy' clones the data where the
+# filesystem allows it and copies otherwise, 'link' hard links and 'move'
+# renames, both falling back to copying across filesystems.
+TRANSFER_MODES = ("copy", "link", "move")
+
+# ioctl cloning a whole file on btrfs, XFS and other reflink filesystems
+FICLONE = 0x40049409
+
+# Errors meaning the fast path isn't available here, rather than a real failure
+_UNSUPPORTED = set(
+    [
+        errno.EXDEV,
+        errno.EINVAL,
+        errno.ENOTTY,
+        errno.EOPNOTSUPP,
+        errno.ENOSYS,
+        errno.EPERM,
+        errno.EBADF,
+    ]
+)
+
+
+def same_filesystem(src: str, dest_dir: str) -> bool:
+    """
+    Whether a file and a destination directory live on the same device
+    """
+    try:
+        return os.stat(src).st_dev == os.stat(dest_dir).st_dev
+    except OSError:
+        return False
+
+
+def _reflink(src: str, dest: str) -> bool:
+    """
+    Clone `src` to `dest` without copying any data, where supported
+    """
+    if fcntl is None:
+        return False
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    return False
+
+
+def _copy_range(src: str, dest: str) -> bool:
+    """
+    Copy inside the kernel with copy_file_range, which network filesystems and
+    CoW filesystems can also turn into a server side copy or a clone. Some
+    filesystems copy nothing rather than fail, so anything short of the
+    whole file counts as unsupported.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        remaining = os.fstat(fin.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fin.fileno(), fout.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            return False
+    return remaining == 0
+
+
+def copy_file(src: str, dest: str) -> str:
+    """
+    Copy a file and its metadata, cloning it if the filesystem can, then
+    falling back to copy_file_range and finally a plain copy. Returns which
+    of 'reflinked' or 'copied' happened.
+    """
+    if _reflink(src, dest):
+        how = "reflinked"
+    else:
+        how = "copied"
+        if not _copy_range(src, dest):
+            shutil.copyfile(src, dest)
+    shutil.copystat(src, dest)
+    return how
+
+
+def transfer_file(src: str, dest: str, mode: str = "copy") -> str:
+    """
+    Put `src` at `dest` as `mode` describes, see TRANSFER_MODES. Links and
+    renames only happen within a filesystem, elsewhere the file is copied,
+    and moved files are then removed. Returns what was done: 'reflinked',
+    'copied', 'linked' or 'moved'.
+    """
+    if mode not in TRANSFER_MODES:
+        raise ValueError(
+            f"Unknown transfer mode {mode}, expected one of {TRANSFER_MODES}"
+        )
+
+    if mode != "copy" and same_filesystem(src, os.path.dirname(dest)):
+        try:
+            if mode == "link":
+                os.link(src, dest)
+                return "linked"
+            os.rename(src, dest)
+            return "moved"
+        except OSError as e:
+            # Some filesystems, SMB shares and FAT for one, can't hard link
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    how = copy_file(src, dest)
+    if mode == "move":
+        # Never lose the only complete copy
+        if os.stat(dest).st_size != os.stat(src).st_size:
+            raise OSError(
+                errno.EIO, f"Copy of {src} is incomplete, not removing it", dest
+            )
+        os.remove(src)
+        return "moved"
+    return how
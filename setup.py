@@ -12,7 +12,8 @@ setup(
     packages=["image_utils"],
     install_requires=[
         "ImageHash>=4.0",
-        "Pillow>=7.0.0",
+        "numpy",
+        "Pillow>=8.2.0",
         "python-magic-bin>=0.4.14",
     ],
     test_suite="tests.test_image_utils",
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+import asyncio
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+from image_cache import ImageCache
+from image_cache import ImageHelper
+from image_cache import WORKER_MODES
+from scanner import walk
+
+from PIL import Image
+from PIL import ImageDraw
+
+from typing import Dict, List, Optional, Sequence
+
+logging.basicConfig(
+    format="[%(asctime)s] %(message)s",
+    datefmt="[%Y-%m-%d %I:%M:%S]",
+    level=logging.INFO,
+)
+logger = logging.getLogger("benchmark")
+
+# Bumped whenever the layout of the results changes
+RESULTS_VERSION = 2
+
+# Pillow format name and file extension for each corpus format
+FORMATS = {
+    "jpeg": ("JPEG", "jpg"),
+    "png": ("PNG", "png"),
+    "bmp": ("BMP", "bmp"),
+    "gif": ("GIF", "gif"),
+    "webp": ("WEBP", "webp"),
+    "tiff": ("TIFF", "tif"),
+}
+
+# Files per directory of a generated corpus
+FILES_PER_DIRECTORY = 100
+
+
+def _draw_image(rng: random.Random, size: Sequence[int]) -> Image.Image:
+    """
+    A gradient covered in random shapes, different enough from every other
+    one that the perceptual hashes don't collide
+    """
+    img = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1 = x0 + rng.randrange(8, size[0] // 2)
+        y1 = y0 + rng.randrange(8, size[1] // 2)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape([x0, y0, x1, y1], fill=colour)
+    return img
+
+
+def generate_corpus(
+    path: str,
+    count: int,
+    formats: Sequence[str] = ("jpeg",),
+    duplicate_ratio: float = 0.1,
+    size: Sequence[int] = (640, 480),
+    seed: int = 0,
+) -> Dict[str, int]:
+    """
+    Write `count` synthetic images under `path`, spread over subdirectories
+    and cycling through `formats`. A `duplicate_ratio` share of them are byte
+    for byte copies of earlier images under another name. Returns how many
+    unique and duplicate files were written, and their total size.
+    """
+    rng = random.Random(seed)
+    written: List[str] = []
+    corpus = {"unique": 0, "duplicates": 0, "bytes": 0}
+    for i in range(count):
+        directory = os.path.join(path, f"{i // FILES_PER_DIRECTORY:04d}")
+        os.makedirs(directory, exist_ok=True)
+        if written and rng.random() < duplicate_ratio:
+            original = rng.choice(written)
+            full = os.path.join(
+                directory, f"copy_{i:06d}_" + os.path.basename(original)
+            )
+            shutil.copyfile(original, full)
+            corpus["duplicates"] += 1
+        else:
+            pil_format, extension = FORMATS[formats[i % len(formats)]]
+            full = os.path.join(directory, f"img_{i:06d}.{extension}")
+            _draw_image(rng, size).save(full, pil_format)
+            written.append(full)
+            corpus["unique"] += 1
+        corpus["bytes"] += os.path.getsize(full)
+    return corpus
+
+
+def _stage(seconds: float, files: int) -> Dict[str, float]:
+    return {
+        "seconds": round(seconds, 6),
+        "files": files,
+        "files_per_second": round(files / seconds, 2) if seconds > 0 else None,
+    }
+
+
+def time_stages(path: str, db_name: str) -> Dict[str, Dict[str, float]]:
+    """
+    Time each step of caching a file on its own, in a single thread, over
+    every file under `path`. Reading streams the CRC32 and MD5 as it goes, so
+    'md5' times the digest alone over the bytes already in memory.
+    """
+    stages = {}
+
+    start = time.perf_counter()
+    files = [entry for _, listing in walk(path) for entry in listing]
+    stages["walk"] = _stage(time.perf_counter() - start, len(files))
+
+    start = time.perf_counter()
+    images = [ImageHelper(full, stat=stat) for full, stat in files]
+    for image in images:
+        image.check_image_type()
+    images = [image for image in images if image.is_image]
+    stages["type_check"] = _stage(time.perf_counter() - start, len(files))
+
+    start = time.perf_counter()
+    for image in images:
+        image.read_image(keep_data=True)
+    stages["read"] = _stage(time.perf_counter() - start, len(images))
+
+    start = time.perf_counter()
+    for image in images:
+        hashlib.md5(image.data).hexdigest()
+    stages["md5"] = _stage(time.perf_counter() - start, len(images))
+
+    start = time.perf_counter()
+    for image in images:
+        image.compute_partial()
+    stages["partial"] = _stage(time.perf_counter() - start, len(images))
+
+    start = time.perf_counter()
+    for image in images:
+        image.compute_image_hashes()
+        image.release_data()
+    stages["perceptual_hash"] = _stage(time.perf_counter() - start, len(images))
+
+    ic = ImageCache(db_name=db_name, table_name="stages")
+    start = time.perf_counter()
+    for image in images:
+        ic.insert(image)
+    ic.flush()
+    stages["insert"] = _stage(time.perf_counter() - start, len(images))
+
+    start = time.perf_counter()
+    for image in images:
+        ic.by_md5(image.md5)
+    stages["lookup"] = _stage(time.perf_counter() - start, len(images))
+
+    start = time.perf_counter()
+    ic.by_md5_many([image.md5 for image in images])
+    stages["lookup_many"] = _stage(time.perf_counter() - start, len(images))
+
+    start = time.perf_counter()
+    ic.find_clusters(8)
+    stages["cluster"] = _stage(time.perf_counter() - start, len(images))
+    return stages
+
+
+async def time_pipeline(
+    source: str, target: str, db_name: str, **cache_opts
+) -> Dict[str, Dict[str, float]]:
+    """
+    Time the end to end pipelines: building the cache of `source` with the
+    worker pool, and checking `target` against it the way find_dupes does
+    """
+    files = sum(len(listing) for _, listing in walk(source))
+    targets = sum(len(listing) for _, listing in walk(target))
+    pipeline = {}
+
+    ic = ImageCache(db_name=db_name, table_name="pipeline", **cache_opts)
+    start = time.perf_counter()
+    await ic.gen_cache_from_directory(source)
+    pipeline["gen_cache"] = _stage(time.perf_counter() - start, files)
+
+    start = time.perf_counter()
+    images = await ic.hash_directory(target)
+    await ic.complete_digests({image.size for image in images})
+    classified = ic.classify_targets(images)
+    pipeline["find_dupes"] = _stage(time.perf_counter() - start, targets)
+    pipeline["find_dupes"]["duplicates"] = len(classified["duplicates"])
+    pipeline["find_dupes"]["migrate"] = len(classified["migrate"])
+    # Where the time went inside both pipelines, as seen by the cache itself
+    pipeline["metrics"] = ic.metrics.snapshot()
+    return pipeline
+
+
+async def run_benchmark(
+    count: int = 1000,
+    formats: Sequence[str] = ("jpeg",),
+    duplicate_ratio: float = 0.1,
+    size: Sequence[int] = (640, 480),
+    seed: int = 0,
+    workdir: Optional[str] = None,
+    **cache_opts,
+) -> Dict[str, any]:
+    """
+    Generate a source corpus of `count` images and a target corpus a tenth
+    the size, holding copies of source images in the same `duplicate_ratio`,
+    then time every stage and both pipelines over them. Returns the results,
+    ready to be written out as JSON.
+    """
+    results = {
+        "version": RESULTS_VERSION,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "count": count,
+            "formats": list(formats),
+            "duplicate_ratio": duplicate_ratio,
+            "size": list(size),
+            "seed": seed,
+            "cache_opts": cache_opts,
+        },
+    }
+    with tempfile.TemporaryDirectory(dir=workdir, prefix="image-bench") as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        target = os.path.join(tmpdir, "target")
+        db_name = os.path.join(tmpdir, "bench.sqlite")
+
+        start = time.perf_counter()
+        results["corpus"] = generate_corpus(
+            source, count, formats, duplicate_ratio, size, seed
+        )
+        targets = max(1, count // 10)
+        results["target_corpus"] = generate_corpus(
+            target, targets, formats, 0.0, size, seed + 1
+        )
+        # Seed the target with copies of source images
+        rng = random.Random(seed)
+        originals = [full for _, listing in walk(source) for full, _ in listing]
+        for i in range(int(targets * duplicate_ratio)):
+            original = rng.choice(originals)
+            shutil.copyfile(
+                original,
+                os.path.join(target, f"dupe_{i}_" + os.path.basename(original)),
+            )
+        results["generate_seconds"] = round(time.perf_counter() - start, 6)
+
+        logger.info(f"Timing individual stages over {count} images")
+        results["stages"] = time_stages(source, db_name)
+        logger.info("Timing the cache and find_dupes pipelines")
+        results["pipeline"] = await time_pipeline(source, target, db_name, **cache_opts)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark hashing and caching over a synthetic corpus."
+    )
+    parser.add_argument(
+        "-n", "--count", type=int, default=1000, help="Number of source images."
+    )
+    parser.add_argument(
+        "--formats",
+        default="jpeg",
+        help="Comma separated image formats to generate, from "
+        + f"{', '.join(FORMATS)}.",
+    )
+    parser.add_argument(
+        "--duplicate_ratio",
+        type=float,
+        default=0.1,
+        help="Share of the images which are copies of another.",
+    )
+    parser.add_argument(
+        "--size",
+        default="640x480",
+        help="Dimensions of the generated images, as WIDTHxHEIGHT.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--workdir",
+        default=None,
+        help="Where to generate the corpus. Defaults to the system temp "
+        + "directory, point it at the disk or share you want to measure.",
+    )
+    parser.add_argument("-w", "--workers", type=int, default=None)
+    parser.add_argument("--worker_mode", choices=WORKER_MODES, default="process")
+    parser.add_argument(
+        "--io_concurrency",
+        type=int,
+        default=0,
+        help="Files read at once ahead of the workers, see image_utils.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="File the JSON results are written to. Defaults to stdout.",
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run_benchmark(
+            count=args.count,
+            formats=[f.strip() for f in args.formats.split(",")],
+            duplicate_ratio=args.duplicate_ratio,
+            size=[int(d) for d in args.size.lower().split("x")],
+            seed=args.seed,
+            workdir=args.workdir,
+            workers=args.workers,
+            worker_mode=args.worker_mode,
+            io_concurrency=args.io_concurrency,
+        )
+    )
+    report = json.dumps(results, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as fout:
+            fout.write(report)
+        logger.info(f"Results written to {args.output}")
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import asyncio
+import concurrent.futures
+import functools
 import hashlib
 import imagehash
+import io
 import logging
 import magic
+import mmap
 import os
 import pprint
 import sqlite3
@@ -12,30 +16,70 @@ import time
 import threading
 import zlib
 
-from PIL import Image
-from typing import List, Dict
+from PIL import Image, ImageSequence
+from filetypes import sniff_image_type
+from metrics import Metrics
+from scanner import is_walked
+from scanner import walk
+from similarity import BKTree
+from similarity import cluster_hashes
+from similarity import stored_to_array
+from typing import List, Dict, Optional, Set, Tuple
 
 """
     Image Cache Schema
 
-    id INTEGER PRIMARY KEY,
-    filename TEXT NOT NULL,
-    full_path TEXT NOT NULL,
-    crc32 TEXT NOT NULL,
-    md5 TEXT NOT NULL,
-    ahash TEXT,
-    phash TEXT,
-    dhash TEXT,
-    whash TEXT,
-    size INTEGER NOT NULL,
-    img_type TEXT NOT NULL
+    The cache is content addressed. Whatever depends only on a file's bytes
+    is kept once per md5 in {table}_content, and every path points at it
+    from {table}_paths. Digests are stored as BLOBs, the crc32 and the 64 bit
+    ImageHashes as INTEGERs.
+
+    {table}_content (md5 BLOB PRIMARY KEY, crc32 INTEGER NOT NULL,
+        size INTEGER NOT NULL, ahash INTEGER, phash INTEGER, dhash INTEGER,
+        whash INTEGER, date_taken TEXT, camera_model TEXT, width INTEGER,
+        height INTEGER, orientation INTEGER, gps_latitude REAL,
+        gps_longitude REAL, pixel_hash BLOB)
+    {table}_paths (id INTEGER PRIMARY KEY, filename TEXT NOT NULL,
+        full_path TEXT NOT NULL UNIQUE, md5 BLOB, size INTEGER NOT NULL,
+        type_id INTEGER NOT NULL, mtime REAL, inode INTEGER, partial BLOB)
+    {table}_types (id INTEGER PRIMARY KEY, img_type TEXT NOT NULL UNIQUE)
+
+    The {table} view joins them back into one row per path, showing the
+    digests and hashes as hex: id, filename, full_path, crc32, md5, ahash,
+    phash, dhash, whash, size, img_type, mtime, inode, partial, the EXIF
+    columns and pixel_hash. Files which size first filtering never read in
+    full have no md5, and no content.
+
+    Lookup indexes on the paths' md5, (filename, size) and (size, partial),
+    and on the content's (crc32, size) and pixel_hash. {table}_meta holds the
+    schema version of the cache, see ImageCache.migrate.
+
+    Scan sessions, so an interrupted walk can be resumed, are kept in
+    {table}_scans (id, kind, root, started, finished), with the files
+    processed so far in {table}_scan_files (scan_id, full_path, size, mtime,
+    inode, crc32, md5, phash, pixel_hash) and the directories finished in
+    {table}_scan_dirs (scan_id, directory)
 """
 
-SUPPORTED_TYPES = set([
-    "jpeg",
-    "png",
-    "bmp",
-])
+SUPPORTED_TYPES = set(
+    [
+        "jpeg",
+        "png",
+        "bmp",
+        "gif",
+        "webp",
+        "tiff",
+        "heic",
+        "heif",
+        "avif",
+        # Camera RAW formats
+        "cr2",
+        "cr3",
+        "orf",
+        "rw2",
+        "raf",
+    ]
+)
 
 logging.basicConfig(
     format="[%(asctime)-15s] %(message)s",
@@ -43,42 +87,206 @@ logging.basicConfig(
 )
 logger = logging.getLogger("image_cache")
 
+# The ImageHash columns a near duplicate search can be run against
+PERCEPTUAL_HASHES = ("ahash", "phash", "dhash", "whash")
+
+# The columns each of the ImageCache.by_* lookups match rows on
+LOOKUP_KEYS = {
+    "md5": ("md5",),
+    "crc_size": ("crc32", "size"),
+    "name_size": ("filename", "size"),
+    "pixel_hash": ("pixel_hash",),
+}
+
+# Bumped whenever the cache schema changes, see ImageCache.migrate
+SCHEMA_VERSION = 9
+
+# The EXIF tags we cache, and the IFDs holding the photo and GPS details
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+EXIF_MODEL = 0x0110
+EXIF_ORIENTATION = 0x0112
+EXIF_DATETIME_ORIGINAL = 0x9003
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+
+# The EXIF details stored alongside the digests and their column types, all
+# NULL when missing
+EXIF_COLUMNS = {
+    "date_taken": "TEXT",
+    "camera_model": "TEXT",
+    "width": "INTEGER",
+    "height": "INTEGER",
+    "orientation": "INTEGER",
+    "gps_latitude": "REAL",
+    "gps_longitude": "REAL",
+}
+
+# The cache is content addressed. Whatever depends only on a file's bytes is
+# stored once per md5 in the content table, every path pointing at it.
+CONTENT_COLUMNS = (
+    ("md5", "crc32", "size") + PERCEPTUAL_HASHES + tuple(EXIF_COLUMNS) + ("pixel_hash",)
+)
+# The content columns up to schema version 8, which its migrations copy
+CONTENT_COLUMNS_V8 = CONTENT_COLUMNS[:-1]
+# The lookup indexes on the paths and content tables, as (name, table, columns)
+CACHE_INDEXES = (
+    ("paths_md5", "paths", "md5"),
+    ("paths_filename_size", "paths", "filename, size"),
+    ("paths_size_partial", "paths", "size, partial"),
+    ("content_crc32_size", "content", "crc32, size"),
+)
+PATH_COLUMNS = (
+    "filename",
+    "full_path",
+    "md5",
+    "size",
+    "type_id",
+    "mtime",
+    "inode",
+    "partial",
+)
+
+# Digests are stored as BLOBs and the 64 bit ImageHashes as (signed) INTEGERs.
+# The number of hex digits each is shown with, see `_row_select`.
+HEX_DIGITS = {"crc32": 8, "ahash": 16, "phash": 16, "dhash": 16, "whash": 16}
+
+# Where the columns the by_* lookups match on are stored
+LOOKUP_COLUMNS = {
+    "md5": "p.md5",
+    "crc32": "c.crc32",
+    "size": "p.size",
+    "filename": "p.filename",
+    "pixel_hash": "c.pixel_hash",
+}
+
+# JPEG markers. Segments up to the start of scan carry a length, except the
+# standalone markers. APPn and COM segments only hold metadata.
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+JPEG_SOS = 0xDA
+JPEG_STANDALONE = set([0x01] + list(range(0xD0, 0xD8)))
+JPEG_METADATA = set(list(range(0xE0, 0xF0)) + [0xFE])
+
+# How the heavy hashing work is fanned out. Processes sidestep the GIL for the
+# pure Python parts of ImageHash, threads avoid the cost of pickling results.
+WORKER_MODES = ("process", "thread")
+
+# How far find_dupes and gen_stats_for_file go to prove a file is a copy of a
+# cached one, cheapest first. Each level only runs for files which collided at
+# the one before: the same size, then the same partial digest, then the same
+# md5. 'pixels' finally compares the decoded images of files with the same
+# phash, catching copies whose metadata was edited.
+VERIFY_LEVELS = ("size", "partial", "md5", "pixels")
+
 
 class ImageHelper(object):
     """
     Helper class to process all of the data on an image we desire
     """
+
     crc_chunk_size = 65535
     magic_buffer = 4096
+    # Files up to this size are kept in memory after being read so they can
+    # be decoded without touching the disk again. Anything larger is only
+    # streamed through the digests.
+    buffer_limit = 32 * 1024 * 1024
+    # Files of at least this size are memory mapped instead, and hashed and
+    # decoded straight from the mapping without copying them. 0 disables it.
+    mmap_threshold = 64 * 1024 * 1024
+    # The ImageHashes only look at tiny thumbnails, so images are decoded and
+    # shrunk to no less than this many pixels on their short side first
+    hash_scale = 256
+    # Bytes hashed from each end of a file for its partial digest
+    partial_size = 65536
 
-    def __init__(self, full_path: str) -> None:
-        # As its SQL, avoid quotes if possible
-        if "'" in full_path or "\"" in full_path:
-            full_path_old = full_path
-            full_path.replace("'", "")
-            full_path.replace("\"", "")
-            os.rename(full_path_old, full_path)
-
+    def __init__(
+        self,
+        full_path: str,
+        extra_digests: Tuple[str, ...] = (),
+        stat: Optional[os.stat_result] = None,
+    ) -> None:
         self.full_path: str = full_path
         self.filename: str = os.path.basename(self.full_path)
-        self.size: int = os.stat(self.full_path).st_size
-        self.data = b''
+        # The scanner hands over the stat it took while listing the directory
+        if stat is None:
+            stat = os.stat(self.full_path)
+        self.size: int = stat.st_size
+        self.mtime: float = stat.st_mtime
+        self.inode: int = stat.st_ino
+        self.data = b""
+        self.header = b""
         self.has_been_read = False
-        self.md5: str = ''
-        self.crc32: str = ''
-        self.ahash: str = ''
-        self.phash: str = ''
-        self.dhash: str = ''
-        self.whash: str = ''
-        self.img_type: str = ''
+        self.extra_digests = extra_digests
+        self.digests: Dict[str, str] = {}
+        self.partial: str = ""
+        self.md5: str = ""
+        self.crc32: str = ""
+        self.ahash: str = ""
+        self.phash: str = ""
+        self.dhash: str = ""
+        self.whash: str = ""
+        self.pixel_hash: str = ""
+        self.img_type: str = ""
         self.is_image = False
+        self.date_taken: Optional[str] = None
+        self.camera_model: Optional[str] = None
+        self.width: Optional[int] = None
+        self.height: Optional[int] = None
+        self.orientation: Optional[int] = None
+        self.gps_latitude: Optional[float] = None
+        self.gps_longitude: Optional[float] = None
+        # Seconds spent in each stage, merged into the cache's Metrics
+        self.timings: Dict[str, float] = {}
         logger.debug(f"Processing {full_path}. . .")
 
+    @classmethod
+    def restore(
+        cls,
+        full_path: str,
+        size: int,
+        mtime: Optional[float],
+        inode: Optional[int],
+        **digests,
+    ) -> "ImageHelper":
+        """
+        Rebuild an image hashed by an earlier run from the values it stored,
+        without touching the file
+        """
+        # A stat_result carrying only what we stored, so the file isn't stat'd
+        stat = os.stat_result(
+            (0, inode or 0, 0, 0, 0, 0, size, 0, 0, 0), {"st_mtime": mtime}
+        )
+        image = cls(full_path, stat=stat)
+        for name, value in digests.items():
+            setattr(image, name, value or "")
+        image.is_image = True
+        image.has_been_read = True
+        return image
+
     def check_image_type(self) -> None:
         """
-        A helper to process the Magic MIME type from the buffer
+        Identify the image type from the signature in the first bytes of the
+        file. Headers we don't recognise are handed to libmagic, which also
+        keeps its full description around as the img_type.
         """
-        self.img_type = magic.from_file(self.full_path).lower()
+        start = time.perf_counter()
+        if not self.header:
+            with open(self.full_path, "rb") as fin:
+                self.header = fin.read(self.magic_buffer)
+
+        sniffed = sniff_image_type(self.header)
+        self._timed("type_check", start)
+        if sniffed is not None:
+            self.img_type = sniffed
+            self.is_image = True
+            return
+
+        start = time.perf_counter()
+        self.img_type = magic.from_buffer(self.header).lower()
+        self._timed("magic", start)
         # first verify the file is of an image mime type
         imagic: set = set([x for x in self.img_type.split()])
         if len(imagic.intersection(SUPPORTED_TYPES)) == 0:
@@ -86,57 +294,306 @@ class ImageHelper(object):
         else:
             self.is_image = True
 
-    def read_image(self) -> None:
+    def _timed(self, stage: str, start: float) -> None:
+        """
+        Add the time since `start` to a stage's timing
+        """
+        elapsed = time.perf_counter() - start
+        self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    def read_image(self, keep_data: Optional[bool] = None) -> None:
         """
-        A helper function that reads the image one block at a time. We do this
-        to compute the CRC32 as we go, which is used for 'Fast' dupe checking
+        A helper function that reads the image one block at a time. Every
+        block is fed to the CRC32, MD5 and any `extra_digests` as it arrives,
+        so the file is only read once. Blocks are read straight into a
+        preallocated buffer, which becomes `data` if we keep the contents
+        around for decoding (by default, files up to `buffer_limit`). Any
+        header already read by `check_image_type` isn't read again.
+
+        Files of at least `mmap_threshold` bytes are handed to `_read_mapped`,
+        and contents already handed over by `load` are digested from memory.
         """
         # We've already read the file, don't do it again
         if self.has_been_read:
             logger.warning("File already processed, skipping duplicate read")
-            return 
+            return
+
+        # The contents were read ahead for us, see `load`
+        if self.data:
+            self._digest_buffer(self.data)
+            if keep_data is False:
+                self.release_data()
+            return
+
+        if 0 < self.mmap_threshold <= self.size:
+            self._read_mapped(keep_data is not False)
+            return
+
+        if keep_data is None:
+            keep_data = self.size <= self.buffer_limit
 
         crc32 = 0
+        digests = [hashlib.md5()] + [hashlib.new(d) for d in self.extra_digests]
+        buf = bytearray(self.size if keep_data else self.crc_chunk_size)
+        view = memoryview(buf)
+        offset = 0
+        # Time spent waiting on reads and in the digests, kept apart to tell
+        # a disk bound run from a CPU bound one
+        reading = digesting = 0.0
+        start = time.perf_counter()
         with open(self.full_path, "rb") as fin:
+            header = self.header[: self.size]
+            if header:
+                crc32 = zlib.crc32(header)
+                for digest in digests:
+                    digest.update(header)
+                if keep_data:
+                    buf[: len(header)] = header
+                offset = fin.seek(len(header))
             while True:
-                data = fin.read(self.crc_chunk_size)
-                if not data:
+                # When keeping the data each block lands after the last one,
+                # otherwise the one block sized buffer is reused. Should the
+                # file have grown since it was stat'd, we stop at the size we
+                # will be caching it under.
+                begin = offset if keep_data else 0
+                block = view[begin : begin + self.crc_chunk_size]
+                read = fin.readinto(block) if len(block) > 0 else 0
+                now = time.perf_counter()
+                reading += now - start
+                if not read:
                     break
-                self.data += data
-                crc32 = zlib.crc32(data, crc32)
+                block = block[:read]
+                crc32 = zlib.crc32(block, crc32)
+                for digest in digests:
+                    digest.update(block)
+                offset += read
+                start = time.perf_counter()
+                digesting += start - now
+
+        self.timings["read"] = self.timings.get("read", 0.0) + reading
+        self.timings["digest"] = self.timings.get("digest", 0.0) + digesting
+        if keep_data:
+            self.data = buf if offset == len(buf) else bytes(view[:offset])
+        self.crc32 = f"{crc32:08x}"
+        self.md5 = digests[0].hexdigest()
+        for name, digest in zip(self.extra_digests, digests[1:]):
+            self.digests[name] = digest.hexdigest()
+        self.has_been_read = True
+
+    def _read_mapped(self, keep_data: bool) -> None:
+        """
+        Memory map the file and run every digest over the whole mapping in one
+        call each, with no copies on our side. Kept mappings become `data`,
+        which Pillow decodes from directly, and are closed by `release_data`.
+        """
+        start = time.perf_counter()
+        with open(self.full_path, "rb") as fin:
+            mapping = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self._timed("read", start)
+        # The pages are faulted in as they are digested, so the disk time of
+        # a mapped file shows up under 'digest'
+        self._digest_buffer(mapping)
+        if keep_data:
+            self.data = mapping
+        else:
+            mapping.close()
+
+    def _digest_buffer(self, buffer) -> None:
+        """
+        Run every digest over a buffer holding the whole file, in one call
+        each and without copying it
+        """
+        digests = [hashlib.md5()] + [hashlib.new(d) for d in self.extra_digests]
+        # Like a streamed read, stop at the size we will be caching it under
+        start = time.perf_counter()
+        with memoryview(buffer)[: self.size] as view:
+            crc32 = zlib.crc32(view)
+            for digest in digests:
+                digest.update(view)
+        self._timed("digest", start)
         self.crc32 = f"{crc32:08x}"
+        self.md5 = digests[0].hexdigest()
+        for name, digest in zip(self.extra_digests, digests[1:]):
+            self.digests[name] = digest.hexdigest()
         self.has_been_read = True
 
+    def load(self, data: bytes) -> None:
+        """
+        Hand over the file's contents, read ahead by the cache's I/O threads.
+        The type check, digests and decode then all run from memory.
+        """
+        self.data = data
+        self.header = bytes(data[: self.magic_buffer])
+
+    def release_data(self) -> None:
+        """
+        Drop the contents kept by `read_image`, unmapping them if mapped
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = b""
+
     def compute_md5(self) -> None:
         """
-        We use the MD5 as a slower "fast" mechanism to see if we've already 
-        processed this file.
+        We use the MD5 as a slower "fast" mechanism to see if we've already
+        processed this file. The digest is computed while the file is streamed
+        in `read_image`, so this only has to read the file if that hasn't
+        happened yet.
         """
-        self.md5: str = hashlib.md5(self.data).hexdigest()
+        if not self.has_been_read:
+            self.read_image()
+
+    def compute_partial(self) -> None:
+        """
+        A cheap digest over the first and last `partial_size` bytes of the
+        file. Files of the same size with different partial digests can't be
+        duplicates, so most files never need to be read in full.
+        """
+        start = time.perf_counter()
+        if self.data:
+            head = self.data[: self.partial_size]
+            tail = self.data[
+                max(self.partial_size, len(self.data) - self.partial_size) :
+            ]
+        else:
+            with open(self.full_path, "rb") as fin:
+                head = fin.read(self.partial_size)
+                fin.seek(max(self.partial_size, self.size - self.partial_size))
+                tail = fin.read(self.partial_size)
+        digest = hashlib.md5(head)
+        digest.update(tail)
+        self.partial = digest.hexdigest()
+        self._timed("partial", start)
 
     def compute_image_hashes(self) -> None:
         """
-        We use ImageHash values to help us identify if we've already seen this 
-        file with higher levels of certainty
+        We use ImageHash values to help us identify if we've already seen this
+        file with higher levels of certainty. The pixel hash is computed from
+        the same decode.
         """
         if not self.is_image:
             logger.warning(
-                "Attempted to compute image hashes on non-image: " +
-                f"{self.img_type}"
+                "Attempted to compute image hashes on non-image: " + f"{self.img_type}"
             )
             return
 
         # next, compute the ImageHashes of the file
         try:
-            img = Image.open(self.full_path)
+            start = time.perf_counter()
+            img = self._load_hash_image()
+            self._timed("decode", start)
+            start = time.perf_counter()
             self.ahash: str = str(imagehash.average_hash(img))
             self.phash: str = str(imagehash.phash(img))
             self.dhash: str = str(imagehash.dhash(img))
             self.whash: str = str(imagehash.whash(img))
+            self._timed("imagehash", start)
         except Exception as e:
-            logger.warning(
-                f"Failed to compute ImageHash for {self.full_path} with {e}"
-            )
+            logger.warning(f"Failed to compute ImageHash for {self.full_path} with {e}")
+
+    def _load_hash_image(self) -> Image.Image:
+        """
+        Decode the image once into the small grayscale copy every ImageHash is
+        derived from. JPEGs are scaled down by up to 8x while decoding, then
+        everything is box reduced to around `hash_scale` so the hashes never
+        resize a full resolution image themselves.
+        """
+        img = self._open_image()
+        # Opening only parsed the headers, so the EXIF comes for free
+        self.compute_exif(img)
+        # Before draft mode gets a say in how the image is decoded
+        self.compute_pixel_hash(img)
+        img.draft("L", (self.hash_scale, self.hash_scale))
+        if img.mode != "L":
+            img = img.convert("L")
+        factor = min(img.size) // self.hash_scale
+        if factor > 1:
+            img = img.reduce(factor)
+        return img
+
+    def _open_image(self) -> Image.Image:
+        """
+        Open the image from memory if we kept the bytes, saves a second read.
+        A mapping is already file like, wrapping it would copy the whole file.
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.seek(0)
+            return Image.open(self.data)
+        return Image.open(io.BytesIO(self.data) if self.data else self.full_path)
+
+    def compute_pixel_hash(self, img: Optional[Image.Image] = None) -> None:
+        """
+        An md5 of what the image shows rather than of the file, so copies
+        which only differ in their metadata, EXIF edits, rotation flags or
+        tags, share it. JPEGs digest their compressed scan data and the
+        tables it is decoded with, see `jpeg_scan_digest`, and are never
+        decoded for it. Everything else digests its decoded pixels, along
+        with the palette and transparency they are shown with, using `img` if
+        the image is being decoded anyway. Animations get no pixel hash, as
+        only their first frame would be digested.
+        """
+        start = time.perf_counter()
+        digest = ""
+        if img is None or img.format == "JPEG":
+            if self.data:
+                digest = jpeg_scan_digest(self.data)
+            else:
+                with open(self.full_path, "rb") as fin:
+                    with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        digest = jpeg_scan_digest(mapped)
+        if not digest:
+            if img is None:
+                with self._open_image() as opened:
+                    self.compute_pixel_hash(opened)
+                return
+            if getattr(img, "n_frames", 1) > 1:
+                return
+            pixels = hashlib.md5(f"{img.mode} {img.size}".encode())
+            # Palette images hold indexes, the colours are in the palette
+            if img.palette is not None:
+                pixels.update(bytes(img.getpalette() or []))
+            pixels.update(repr(img.info.get("transparency")).encode())
+            pixels.update(img.tobytes())
+            digest = pixels.hexdigest()
+        self.pixel_hash = digest
+        self._timed("pixel_hash", start)
+
+    def compute_exif(self, img: Optional[Image.Image] = None) -> None:
+        """
+        Pull the EXIF details we cache out of an opened image, opening the
+        file if we weren't handed one. Any that are missing are left as None,
+        and a broken EXIF block never stops the image from being hashed.
+        """
+        if img is None:
+            with Image.open(self.full_path) as opened:
+                self.compute_exif(opened)
+            return
+
+        # The full resolution size, before any draft mode scaling
+        self.width, self.height = img.size
+        try:
+            exif = img.getexif()
+            photo = exif.get_ifd(EXIF_IFD)
+            gps = exif.get_ifd(GPS_IFD)
+        except Exception as e:
+            logger.debug(f"Failed to parse EXIF for {self.full_path} with {e}")
+            return
+
+        date_taken = photo.get(EXIF_DATETIME_ORIGINAL, exif.get(EXIF_DATETIME_ORIGINAL))
+        if isinstance(date_taken, str) and date_taken.strip():
+            self.date_taken = date_taken.strip()
+        model = exif.get(EXIF_MODEL)
+        if isinstance(model, str) and model.strip():
+            self.camera_model = model.strip()
+        orientation = exif.get(EXIF_ORIENTATION)
+        if isinstance(orientation, int):
+            self.orientation = orientation
+        self.gps_latitude = _gps_degrees(
+            gps.get(GPS_LATITUDE), gps.get(GPS_LATITUDE_REF), "S"
+        )
+        self.gps_longitude = _gps_degrees(
+            gps.get(GPS_LONGITUDE), gps.get(GPS_LONGITUDE_REF), "W"
+        )
 
     def print_image_details(self) -> None:
         report = {
@@ -144,226 +601,2350 @@ class ImageHelper(object):
             "filename": self.filename,
             "crc32": self.crc32,
             "size": self.size,
+            "mtime": self.mtime,
+            "inode": self.inode,
             "img_type": self.img_type,
             "md5": self.md5,
+            "partial": self.partial,
             "ahash": self.ahash,
             "phash": self.phash,
             "dhash": self.dhash,
             "whash": self.whash,
+            "pixel_hash": self.pixel_hash,
+            "date_taken": self.date_taken,
+            "camera_model": self.camera_model,
+            "width": self.width,
+            "height": self.height,
+            "orientation": self.orientation,
+            "gps_latitude": self.gps_latitude,
+            "gps_longitude": self.gps_longitude,
+            **self.digests,
         }
         pp = pprint.PrettyPrinter(indent=4)
         pp.pprint(report)
 
 
+def _gps_degrees(dms, ref, negative: str) -> Optional[float]:
+    """
+    Convert an EXIF (degrees, minutes, seconds) GPS coordinate to signed
+    decimal degrees, negative for the `negative` hemisphere
+    """
+    try:
+        degrees, minutes, seconds = (float(part) for part in dms)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    value = degrees + minutes / 60 + seconds / 3600
+    if isinstance(ref, bytes):
+        ref = ref.decode("ascii", "ignore")
+    if isinstance(ref, str) and ref.strip().upper() == negative:
+        value = -value
+    return round(value, 7)
+
+
+def jpeg_scan_digest(data) -> str:
+    """
+    The md5 of a JPEG without its metadata: every segment up to the start of
+    scan except APPn and COM, then the scan data up to the last end of image
+    marker. Returns "" if `data` doesn't parse as a JPEG.
+    """
+    if data[:2] != JPEG_SOI:
+        return ""
+    digest = hashlib.md5()
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return ""
+        marker = data[pos + 1]
+        # Any number of fill bytes may come before a marker
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in JPEG_STANDALONE:
+            pos += 2
+            continue
+        if marker == JPEG_SOS:
+            end = data.rfind(JPEG_EOI, pos)
+            digest.update(data[pos : len(data) if end < 0 else end + 2])
+            return digest.hexdigest()
+        end = pos + 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+        if marker not in JPEG_METADATA:
+            digest.update(data[pos:end])
+        pos = end
+    return ""
+
+
+def _pack_digest(value: Optional[str]) -> Optional[bytes]:
+    """
+    A hex digest as the bytes we store, or None if it is missing or invalid
+    """
+    try:
+        return bytes.fromhex(value) if value else None
+    except ValueError:
+        return None
+
+
+def _pack_hash(value: Optional[str]) -> Optional[int]:
+    """
+    A hex hash of up to 64 bits as the signed integer SQLite can store
+    """
+    try:
+        packed = int(value, 16) if value else None
+    except ValueError:
+        return None
+    if packed is not None and packed >= 1 << 63:
+        packed -= 1 << 64
+    return packed
+
+
+def _pack_key(columns: Tuple[str, ...], key: tuple) -> tuple:
+    """
+    Convert a by_* lookup key to the values stored in its columns
+    """
+    packers = {"md5": _pack_digest, "crc32": _pack_hash, "pixel_hash": _pack_digest}
+    return tuple(
+        packers[column](value) if column in packers else value
+        for column, value in zip(columns, key)
+    )
+
+
+def _row_select(table: str, source: Optional[str] = None) -> str:
+    """
+    The SELECT behind the cache's view, joining a path to its content and
+    type, and turning the stored digests and hashes back into hex. Rows have
+    the columns of the original single table, in the same order. Lookups
+    pass their own `source` of paths p and content c, to pick the join order.
+    """
+    if source is None:
+        source = f"{table}_paths p LEFT JOIN {table}_content c ON c.md5 = p.md5"
+
+    def hex_column(column: str, alias: str) -> str:
+        if column in HEX_DIGITS:
+            return (
+                f"CASE WHEN {alias}.{column} IS NOT NULL THEN "
+                + f"printf('%0{HEX_DIGITS[column]}x', {alias}.{column}) END"
+            )
+        return f"NULLIF(lower(hex({alias}.{column})), '')"
+
+    columns = (
+        ["p.id", "p.filename", "p.full_path", hex_column("crc32", "c")]
+        + [hex_column("md5", "p")]
+        + [hex_column(column, "c") for column in PERCEPTUAL_HASHES]
+        + ["p.size", "ty.img_type", "p.mtime", "p.inode", hex_column("partial", "p")]
+        + [f"c.{column}" for column in EXIF_COLUMNS]
+        + [hex_column("pixel_hash", "c")]
+    )
+    names = (
+        ["id", "filename", "full_path", "crc32", "md5"]
+        + list(PERCEPTUAL_HASHES)
+        + ["size", "img_type", "mtime", "inode", "partial"]
+        + list(EXIF_COLUMNS)
+        + ["pixel_hash"]
+    )
+    return (
+        "SELECT "
+        + ", ".join(f"{c} AS {name}" for c, name in zip(columns, names))
+        + f" FROM {source} LEFT JOIN {table}_types ty ON ty.id = p.type_id"
+    )
+
+
+def hash_image(
+    full_path: str,
+    perceptual: bool = True,
+    stat: Optional[os.stat_result] = None,
+    partials: Optional[Set[str]] = None,
+    data: Optional[bytes] = None,
+    pixel_hash: bool = False,
+) -> Optional[ImageHelper]:
+    """
+    Worker entry point for the hashing pool. Computes every digest we store
+    for a file and hands the ImageHelper back to the writer, or None if the
+    file is not an image. The ImageHashes can be skipped when only the exact
+    digests are needed, and with them the pixel hash of anything but JPEGs.
+    Given the cached `partials` of its size, a file matching none of them
+    can't be a copy and is decoded now, rather than read again later.
+    The file's `data` may have been read ahead already. With `pixel_hash`
+    everything gets a pixel hash, even when the ImageHashes are skipped.
+    """
+    image = ImageHelper(full_path, stat=stat)
+    if data is not None:
+        image.load(data)
+    image.check_image_type()
+    if not image.is_image:
+        return None
+
+    image.read_image()
+    image.compute_md5()
+    image.compute_partial()
+    if partials is not None and image.partial not in partials:
+        perceptual = True
+    if perceptual:
+        image.compute_image_hashes()
+    elif image.img_type == "jpeg":
+        # No decode needed for a JPEG, see ImageHelper.compute_pixel_hash
+        image.compute_pixel_hash()
+    elif pixel_hash:
+        try:
+            image.compute_pixel_hash()
+        except Exception as e:
+            logger.warning(f"Failed to compute pixel hash for {full_path} with {e}")
+
+    # The raw bytes are no longer needed, don't ship them back across the pool
+    image.release_data()
+    image.header = b""
+    return image
+
+
+def read_ahead(
+    full_path: str, stat: Optional[os.stat_result] = None
+) -> Optional[bytes]:
+    """
+    Read a whole file for the hashing pool, on one of the I/O threads. Files
+    too large to be kept in memory are left to the workers to stream, and
+    None is returned for them.
+    """
+    size = os.stat(full_path).st_size if stat is None else stat.st_size
+    if size == 0 or size > ImageHelper.buffer_limit:
+        return None
+    with open(full_path, "rb") as fin:
+        return fin.read(size)
+
+
+def sniff_image(
+    full_path: str, stat: Optional[os.stat_result] = None, partial: bool = True
+) -> Optional[ImageHelper]:
+    """
+    Worker entry point for size first filtering and the cheap verification
+    levels. Only checks the file type and computes the partial digest, if
+    `partial` is set, or returns None for non-images.
+    """
+    image = ImageHelper(full_path, stat=stat)
+    image.check_image_type()
+    if not image.is_image:
+        return None
+    if partial:
+        image.compute_partial()
+    image.header = b""
+    return image
+
+
+def same_pixels(first: str, second: str) -> bool:
+    """
+    Worker entry point for 'pixels' verification. Whether two files decode to
+    the same image, whatever metadata either carries. Every frame is compared
+    as RGBA, so palette images match only when they show the same colours.
+    """
+    with Image.open(first) as a, Image.open(second) as b:
+        if a.size != b.size or a.mode != b.mode:
+            return False
+        if getattr(a, "n_frames", 1) != getattr(b, "n_frames", 1):
+            return False
+        for frame_a, frame_b in zip(
+            ImageSequence.Iterator(a), ImageSequence.Iterator(b)
+        ):
+            if frame_a.convert("RGBA").tobytes() != frame_b.convert("RGBA").tobytes():
+                return False
+        return True
+
+
+class ScanSession(object):
+    """
+    The progress of one walk over a directory tree, persisted in the cache's
+    scan tables so that an interrupted walk can be resumed. Files are recorded
+    once their results are in, directories once every file in them is, see
+    `ImageCache.start_scan`.
+    """
+
+    def __init__(
+        self, cache: "ImageCache", scan_id: int, processed: Set[str], walked: Set[str]
+    ) -> None:
+        self.cache = cache
+        self.scan_id = scan_id
+        # What earlier runs of this scan already finished
+        self.processed = processed
+        self.walked = walked
+        # Files handed to the pool, the directory they were listed in, and
+        # how many files of each directory are still out
+        self._directories: Dict[str, str] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._listed: Set[str] = set()
+
+    def queued(self, root: str, full: str) -> None:
+        """
+        A file of directory `root` was handed to the pool
+        """
+        self._directories[full] = root
+        self._in_flight[root] = self._in_flight.get(root, 0) + 1
+
+    def listed(self, root: str) -> None:
+        """
+        Every file of directory `root` has been handled or queued
+        """
+        if self._in_flight.get(root, 0) == 0:
+            self.cache._queue_progress(self.scan_id, directory=root)
+        else:
+            self._listed.add(root)
+
+    def finished(self, full: str, image: Optional[ImageHelper] = None) -> None:
+        """
+        Record that a file is done, along with its digests if given
+        """
+        self.cache._queue_progress(self.scan_id, full, image)
+        root = self._directories.pop(full, None)
+        if root is None:
+            return
+        self._in_flight[root] -= 1
+        if self._in_flight[root] == 0:
+            del self._in_flight[root]
+            if root in self._listed:
+                self._listed.remove(root)
+                self.cache._queue_progress(self.scan_id, directory=root)
+
+    def images(self) -> List[ImageHelper]:
+        """
+        The images earlier runs of this scan hashed
+        """
+        return self.cache._scan_images(self.scan_id)
+
+    def close(self) -> None:
+        """
+        The walk completed, its progress is no longer needed
+        """
+        self.cache.finish_scan(self.scan_id)
+
+
 class ImageCache(object):
 
     dupe_count = 0
+    # Keys per query for the by_*_many lookups
+    lookup_chunk = 250
     # Dupes and Ambiguous are lists of dicts, indicating the original file
     # and the file which is considered to be a duplicate
     duplicates: List[Dict[str, str]] = []
     ambiguous: List[Dict[str, str]] = []
 
-    def __init__(self,
-                 db_name: str = "image_cache.sqlite",
-                 table_name: str = "image_cache",
-                 fast: bool = False):
+    def __init__(
+        self,
+        db_name: str = "image_cache.sqlite",
+        table_name: str = "image_cache",
+        fast: bool = False,
+        workers: Optional[int] = None,
+        worker_mode: str = "process",
+        refresh: bool = False,
+        batch_size: int = 500,
+        commit_interval: float = 5.0,
+        size_first: bool = False,
+        resume: bool = False,
+        include: Tuple[str, ...] = (),
+        exclude: Tuple[str, ...] = (),
+        skip_hidden: bool = True,
+        scan_workers: int = 1,
+        queue_size: int = 256,
+        progress_interval: Optional[float] = None,
+        hooks: Tuple = (),
+        io_concurrency: int = 0,
+        verify: Optional[str] = None,
+    ):
         self.db_name = db_name
         self.db_table = table_name
+        # Per stage timings and counters, see metrics.Metrics for the hooks
+        self.metrics = Metrics(progress_interval)
+        for hook in hooks:
+            self.metrics.add_hook(hook)
         self._lock = threading.Lock()
-        self.db_conn = sqlite3.connect(self.db_name, check_same_thread=False)
-        self.create_table()
-        self.processing_time = 0
-        self.fast = fast
-
-    def create_table(self) -> None:
-        """
-        Helper sqlite function to create our table
-        """
-        self._lock.acquire()
-        db_curr = self.db_conn.cursor()
-        db_curr.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {self.db_table} (
-                id INTEGER PRIMARY KEY,
-                filename TEXT NOT NULL,
-                full_path TEXT NOT NULL,
-                crc32 TEXT NOT NULL,
-                md5 TEXT NOT NULL,
-                ahash TEXT,
-                phash TEXT,
-                dhash TEXT,
-                whash TEXT,
-                size INTEGER NOT NULL,
-                img_type TEXT NOT NULL
-            )
-            """
+        # Every statement we run is built once with bound parameters, so
+        # sqlite3's statement cache can reuse the compiled plans
+        self.db_conn = sqlite3.connect(
+            self.db_name, check_same_thread=False, cached_statements=256
         )
-        db_curr.close()
-        self._lock.release()
-
-    def __del__(self):
-        self.db_conn.commit()
-        self.db_conn.close()
-
-    async def gen_stats_for_file(self, full: str) -> Dict[str, any]:
-
-        image = ImageHelper(full)
-        image.check_image_type()
-        if not image.is_image:
-            return
-        
-        # If 'fast', just check for filename and size, ambiguous will still 
-        # check for crc32. If not fast, use the md5 value to search
-        if self.fast:
-            # Only insert if it's likely we have not seen this image before
-            where = f"WHERE filename = '{image.filename}' AND size = '{image.size}'"
-            row = self.lookup(where)
-            if len(row) > 0:
-                logger.info(
-                    "Potential duplicate image found: " + 
-                    f"{image.full_path}:{image.crc32} has same size/name as " + 
-                    f"{row[2]}:{row[3]}"
-                )
-                self.dupe_count += 1
-                self.duplicates.append(
-                    {'original': row[2], 'duplicate': image.full_path}
+        self.tune_connection()
+        self.create_table()
+        # Lookups match on the stored columns rather than the view's hex, so
+        # they use the indexes. Matching on the content means it must exist.
+        self._lookup_sql = {}
+        self._lookup_many_sql = {}
+        for kind, columns in LOOKUP_KEYS.items():
+            if "crc32" in columns or "pixel_hash" in columns:
+                source = (
+                    f"{self.db_table}_content c "
+                    + f"JOIN {self.db_table}_paths p ON p.md5 = c.md5"
                 )
-
-                # TODO: Currently, if a file has the same name/size, we consider
-                # it a duplicate and do not process this file. In the future, I'll
-                # introduce a 'deep' concept that will compute ImageHash values and
-                # use these to check if the image exists
-                return
             else:
-                image.read_image()
-                where = f"WHERE crc32 = '{image.crc32}'"
-                row = self.lookup(where)
-                if len(row) > 0:
-                    logger.info(
-                        "Duplicate crc32 found: " + 
-                        f"{image.full_path}:{image.crc32} has same size/name as" + 
-                        f"{row[2]}:{row[3]}"
-                    )
-                    self.ambiguous.append(
-                        {'original': row[2], 'duplicate': image.full_path}
-                    )
-                    return
-        else:
-            # The default behavior is to compe the MD5 of the image and use this
-            # to check for image duplication
-            image.read_image()
-            image.compute_md5()
-            where = f"WHERE md5 = '{image.md5}'"
-            row = self.lookup(where)
-            if len(row) > 0:
-                logger.info(
-                    "Duplicate md5 found: " + 
-                    f"{image.full_path}:{image.md5} has same size/name as" + 
-                    f"{row[2]}:{row[4]}"
+                source = (
+                    f"{self.db_table}_paths p "
+                    + f"LEFT JOIN {self.db_table}_content c ON c.md5 = p.md5"
                 )
-                self.duplicates.append(
-                    {'original': row[2], 'duplicate': image.full_path}
+            where = " AND ".join(f"{LOOKUP_COLUMNS[column]} = ?" for column in columns)
+            self._lookup_sql[
+                kind
+            ] = f"{_row_select(self.db_table, source)} WHERE {where} LIMIT 1;"
+            # Joining against a list of VALUES lets every key use the index.
+            # The CROSS JOIN keeps sqlite from scanning the table instead.
+            values = ", ".join(
+                ["(" + ", ".join("?" * len(columns)) + ")"] * self.lookup_chunk
+            )
+            self._lookup_many_sql[kind] = (
+                _row_select(
+                    self.db_table, f"(VALUES {values}) AS k CROSS JOIN {source}"
                 )
-                return
+                + " WHERE "
+                + " AND ".join(
+                    f"{LOOKUP_COLUMNS[column]} = k.column{i + 1}"
+                    for i, column in enumerate(columns)
+                )
+                + ";"
+            )
 
-        # This is precautionary, as our `read_image` happens inside of a
-        # conditional, I'd rather ensure we've read in the data before getting
-        # the digests, but this should rarely, if ever, happen.
-        if not image.has_been_read:
-            image.read_image()
+        # New rows are buffered and written with a single executemany per
+        # batch. Each batch is its own transaction, committed once it holds
+        # `batch_size` rows or its oldest row is `commit_interval` seconds old.
+        self.batch_size = max(1, batch_size)
+        self.commit_interval = commit_interval
+        self._pending: List[tuple] = []
+        self._pending_content: List[tuple] = []
+        self._pending_keys: Dict[tuple, tuple] = {}
+        # Paths whose rows are dropped when the batch is written, see `flush`
+        self._pending_deletes: Set[str] = set()
+        self._pending_since = 0.0
+        # Scan session progress, written in the same transactions as the rows
+        self._pending_files: List[tuple] = []
+        self._pending_directories: List[tuple] = []
 
-        # Compute the heavy lifting for the image
-        image.compute_md5()
-        image.compute_image_hashes()
-        
-        # and store all of this information in our db
-        self.insert(image)
+        # In memory near duplicate indexes, keyed on the hash column. They are
+        # built on first use and dropped whenever the table changes.
+        self._similarity_indexes: Dict[str, BKTree] = {}
+        self.processing_time = 0
+        self.fast = fast
+        self.workers = workers or os.cpu_count() or 1
+        self.worker_mode = worker_mode
+        self.refresh = refresh
+        self.size_first = size_first
+        self.resume = resume
+        # Options for the directory scanner, see scanner.walk
+        self.scan_options = {
+            "include": include,
+            "exclude": exclude,
+            "skip_hidden": skip_hidden,
+            "workers": scan_workers,
+        }
+        # Bound on the files waiting to be hashed, and on the hashed images
+        # waiting to be written, between the stages of `_pipeline`
+        self.queue_size = max(1, queue_size)
+        # I/O mode, for network shares where latency is what limits us. Up to
+        # `io_concurrency` files are read at once by a pool of threads, ahead
+        # of the hashing workers, and all of the SQLite work moves to its own
+        # thread so neither ever blocks the event loop. 0 leaves the reads to
+        # the workers and the SQLite work on the loop.
+        self.io_concurrency = max(0, io_concurrency)
+        self._io_executor = None
+        self._db_executor = None
+        if self.io_concurrency:
+            self._io_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.io_concurrency, thread_name_prefix="image-io"
+            )
+            self._db_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="image-db"
+            )
+        if worker_mode not in WORKER_MODES:
+            raise ValueError(
+                f"Unknown worker mode {worker_mode}, expected one of {WORKER_MODES}"
+            )
+        # The verification level targets are checked to, see VERIFY_LEVELS.
+        # None fully hashes every file, as `fast` and the default always have.
+        if verify is not None and verify not in VERIFY_LEVELS:
+            raise ValueError(
+                f"Unknown verify level {verify}, expected one of {VERIFY_LEVELS}"
+            )
+        self.verify = verify
 
-    async def gen_cache_from_directory(self, source: str) -> None:
+    def tune_connection(self) -> None:
         """
-        Given a directory generate the image cache for all image files
+        Write ahead logging lets readers carry on while a batch is committed,
+        and with it a NORMAL sync level is still safe against corruption.
         """
-        start = time.time()
-        tasks = []
-        for root, _, filenames in os.walk(source):
-            logger.info(f"Processing {len(filenames)} files in {root}")
-            for filename in filenames:
-                full: str = os.path.join(root, filename)
-                tasks.append(asyncio.create_task(self.gen_stats_for_file(full)))
-        
-        await asyncio.gather(*tasks, return_exceptions=True)
+        db_curr = self.db_conn.cursor()
+        db_curr.execute("PRAGMA journal_mode = WAL;")
+        db_curr.execute("PRAGMA synchronous = NORMAL;")
+        db_curr.execute("PRAGMA temp_store = MEMORY;")
+        # Negative values are in KiB, so give sqlite 64MB of page cache
+        db_curr.execute("PRAGMA cache_size = -65536;")
+        db_curr.close()
 
-        self.db_conn.commit()
-        self.processing_time = int(time.time() - start)
+    def create_table(self) -> None:
+        """
+        Helper sqlite function to create our tables, or bring existing ones
+        up to date
+        """
+        self._lock.acquire()
+        db_curr = self.db_conn.cursor()
+        exists = db_curr.execute(
+            "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?;",
+            (self.db_table,),
+        ).fetchone()
+        db_curr.close()
+        self._lock.release()
+        self.migrate(fresh=exists is None)
 
-    def insert(self, image: ImageHelper) -> None:
+    def migrate(self, fresh: bool = False) -> None:
         """
-        Helper sqlite function to insert a new row
+        Bring the cache up to SCHEMA_VERSION. Several caches can share one
+        database, so the version is tracked per table in a `{table}_meta` row.
+        Tables older than that fall back to sqlite's user_version pragma, which
+        is otherwise left alone. `fresh` tables are created with the current
+        schema straight away, see `_create_schema`.
         """
+        migrations = {
+            2: self._add_stat_columns,
+            3: self._add_indexes,
+            4: self._add_partial_column,
+            5: self._add_exif_columns,
+            6: self._add_scan_tables,
+            7: self._split_content,
+            8: self._compact_hashes,
+            9: self._add_pixel_hash,
+        }
         self._lock.acquire()
-        # TODO: This could probably be optimized somehow.
         db_curr = self.db_conn.cursor()
         db_curr.execute(
-            f"""INSERT INTO {self.db_table} (
-                filename, full_path, crc32, md5, ahash, 
-                phash, dhash, whash, size, img_type
-            ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )""",
-            (
-                image.filename,
-                image.full_path,
-                image.crc32,
-                image.md5, 
-                image.ahash, 
-                image.phash, 
-                image.dhash, 
-                image.whash, 
-                image.size, 
-                image.img_type
-            )
+            f"""CREATE TABLE IF NOT EXISTS {self.db_table}_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );"""
         )
+        row = db_curr.execute(
+            f"SELECT value FROM {self.db_table}_meta WHERE key = 'schema_version';"
+        ).fetchone()
+        if fresh:
+            self._create_schema(db_curr)
+            version = SCHEMA_VERSION
+        elif row is not None:
+            version = row[0]
+        else:
+            version = db_curr.execute("PRAGMA user_version;").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            logger.warning(
+                f"{self.db_table} in {self.db_name} has schema version {version}, "
+                + f"newer than the supported {SCHEMA_VERSION}"
+            )
+        for step in sorted(migrations):
+            if version >= step:
+                continue
+            logger.debug(f"Migrating {self.db_table} to schema version {step}")
+            migrations[step](db_curr)
+            version = step
+            self._set_version(db_curr, version)
+        if row is None or fresh:
+            self._set_version(db_curr, version)
+        self.db_conn.commit()
         db_curr.close()
         self._lock.release()
 
-    def get_table(self) -> str:
-        return self.db_table
-
-    def get_duplicates(self) -> List[Dict[str, str]]:
-        return self.duplicates
-
-    def get_ambiguous(self) -> List[Dict[str, str]]:
-        return self.ambiguous
-
-    def lookup(self, where_clause: str = "") -> List[str]:
-        """
-        Helper sqlite function to look up any rows that might exist given
-        a where clause. Returns at most one row.
+    def _create_schema(self, db_curr: sqlite3.Cursor) -> None:
         """
-        query = f"""
-            SELECT * FROM {self.db_table}
+        Create the tables, indexes and view of a new cache as they are at
+        SCHEMA_VERSION
         """
-        if where_clause:
-            query += " " + where_clause
-        query += ";"
-        db_curr = self.db_conn.cursor()
-        ret = db_curr.execute(query).fetchone()
-        return [] if ret is None else ret
+        self._create_compact_tables(db_curr)
+        self._add_cache_indexes(db_curr)
+        self._add_scan_tables(db_curr)
+        self._add_pixel_hash(db_curr)
 
-    def get_count(self, where_clause: str = "") -> List[str]:
+    def _create_compact_tables(self, db_curr: sqlite3.Cursor, suffix: str = "") -> None:
         """
-        Helper sqlite function to fetch the size of the DB
+        Create the types table, and the content and paths tables with the
+        column types of schema version 8, named with `suffix`
         """
-        query = f"""
+        exif = ", ".join(f"{column} {t}" for column, t in EXIF_COLUMNS.items())
+        db_curr.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.db_table}_types (
+                id INTEGER PRIMARY KEY,
+                img_type TEXT NOT NULL UNIQUE
+            );"""
+        )
+        db_curr.execute(
+            f"""CREATE TABLE {self.db_table}_content{suffix} (
+                md5 BLOB PRIMARY KEY,
+                crc32 INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                ahash INTEGER,
+                phash INTEGER,
+                dhash INTEGER,
+                whash INTEGER,
+                {exif}
+            ) WITHOUT ROWID;"""
+        )
+        db_curr.execute(
+            f"""CREATE TABLE {self.db_table}_paths{suffix} (
+                id INTEGER PRIMARY KEY,
+                filename TEXT NOT NULL,
+                full_path TEXT NOT NULL UNIQUE,
+                md5 BLOB,
+                size INTEGER NOT NULL,
+                type_id INTEGER NOT NULL,
+                mtime REAL,
+                inode INTEGER,
+                partial BLOB
+            );"""
+        )
+
+    def _add_cache_indexes(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Index the paths and content tables for the by_* lookups
+        """
+        for name, table, columns in CACHE_INDEXES:
+            db_curr.execute(
+                f"""CREATE INDEX IF NOT EXISTS {self.db_table}_{name}
+                ON {self.db_table}_{table} ({columns});"""
+            )
+
+    def _set_version(self, db_curr: sqlite3.Cursor, version: int) -> None:
+        """
+        Record the schema version this cache's tables are at
+        """
+        db_curr.execute(
+            f"""INSERT OR REPLACE INTO {self.db_table}_meta (key, value)
+            VALUES ( 'schema_version', ? );""",
+            (version,),
+        )
+
+    def _add_stat_columns(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Caches built before we tracked mtime and inode are missing the
+        columns, add them so a refresh can pick up where they left off
+        """
+        columns = [r[1] for r in db_curr.execute(f"PRAGMA table_info({self.db_table})")]
+        for column, column_type in (("mtime", "REAL"), ("inode", "INTEGER")):
+            if column not in columns:
+                db_curr.execute(
+                    f"ALTER TABLE {self.db_table} ADD COLUMN {column} {column_type}"
+                )
+
+    def _add_indexes(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Index every column set we look rows up by, and make full_path unique.
+        Older caches could hold the same path several times, so only the most
+        recent row for each path is kept.
+        """
+        db_curr.execute(
+            f"""DELETE FROM {self.db_table} WHERE id NOT IN (
+                SELECT MAX(id) FROM {self.db_table} GROUP BY full_path
+            );"""
+        )
+        db_curr.execute(
+            f"""CREATE UNIQUE INDEX IF NOT EXISTS {self.db_table}_full_path
+            ON {self.db_table} (full_path);"""
+        )
+        for name, columns in (
+            ("md5", "md5"),
+            ("crc32_size", "crc32, size"),
+            ("filename_size", "filename, size"),
+        ):
+            db_curr.execute(
+                f"""CREATE INDEX IF NOT EXISTS {self.db_table}_{name}
+                ON {self.db_table} ({columns});"""
+            )
+
+    def _add_partial_column(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Size first filtering stores a partial digest, and looks rows up by size
+        """
+        columns = [r[1] for r in db_curr.execute(f"PRAGMA table_info({self.db_table})")]
+        if "partial" not in columns:
+            db_curr.execute(f"ALTER TABLE {self.db_table} ADD COLUMN partial TEXT")
+        db_curr.execute(
+            f"""CREATE INDEX IF NOT EXISTS {self.db_table}_size_partial
+            ON {self.db_table} (size, partial);"""
+        )
+
+    def _add_exif_columns(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Store the EXIF details read while hashing, so sorting and reports
+        don't have to open the files again
+        """
+        columns = [r[1] for r in db_curr.execute(f"PRAGMA table_info({self.db_table})")]
+        for column, column_type in EXIF_COLUMNS.items():
+            if column not in columns:
+                db_curr.execute(
+                    f"ALTER TABLE {self.db_table} ADD COLUMN {column} {column_type}"
+                )
+
+    def _add_scan_tables(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Scan sessions record the progress of a walk, so it can be resumed
+        """
+        db_curr.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.db_table}_scans (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                root TEXT NOT NULL,
+                started REAL NOT NULL,
+                finished REAL
+            );"""
+        )
+        db_curr.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.db_table}_scan_files (
+                scan_id INTEGER NOT NULL,
+                full_path TEXT NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                inode INTEGER,
+                crc32 TEXT,
+                md5 TEXT,
+                phash TEXT,
+                PRIMARY KEY (scan_id, full_path)
+            );"""
+        )
+        db_curr.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.db_table}_scan_dirs (
+                scan_id INTEGER NOT NULL,
+                directory TEXT NOT NULL,
+                PRIMARY KEY (scan_id, directory)
+            );"""
+        )
+
+    def _split_content(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Split the cache into a content table keyed on the md5, and a paths
+        table pointing at it. Copies and moved files then share one content
+        row rather than being decoded and stored again. A view under the old
+        table name joins them back into the same columns, so reads and rows
+        are unchanged.
+        """
+        table = db_curr.execute(
+            "SELECT type FROM sqlite_master WHERE name = ?;", (self.db_table,)
+        ).fetchone()
+        if table[0] != "table":
+            return
+
+        exif = ", ".join(f"{column} {t}" for column, t in EXIF_COLUMNS.items())
+        db_curr.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.db_table}_content (
+                md5 TEXT PRIMARY KEY,
+                crc32 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                ahash TEXT,
+                phash TEXT,
+                dhash TEXT,
+                whash TEXT,
+                {exif}
+            ) WITHOUT ROWID;"""
+        )
+        db_curr.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.db_table}_paths (
+                id INTEGER PRIMARY KEY,
+                filename TEXT NOT NULL,
+                full_path TEXT NOT NULL UNIQUE,
+                md5 TEXT,
+                size INTEGER NOT NULL,
+                img_type TEXT NOT NULL,
+                mtime REAL,
+                inode INTEGER,
+                partial TEXT
+            );"""
+        )
+        # Rows which were decoded win over ones that only have digests
+        db_curr.execute(
+            f"""INSERT OR IGNORE INTO {self.db_table}_content
+            SELECT {", ".join(CONTENT_COLUMNS_V8)} FROM {self.db_table}
+            WHERE md5 != '' ORDER BY COALESCE(ahash, '') = '', id DESC;"""
+        )
+        # Size first filtering leaves rows without an md5, and no content
+        db_curr.execute(
+            f"""INSERT INTO {self.db_table}_paths
+            SELECT id, filename, full_path, NULLIF(md5, ''), size, img_type,
+            mtime, inode, partial FROM {self.db_table};"""
+        )
+        db_curr.execute(f"DROP TABLE {self.db_table};")
+        db_curr.execute(
+            f"""CREATE VIEW {self.db_table} AS SELECT
+                p.id, p.filename, p.full_path, c.crc32, p.md5,
+                c.ahash, c.phash, c.dhash, c.whash, p.size, p.img_type,
+                p.mtime, p.inode, p.partial,
+                {", ".join(f"c.{column}" for column in EXIF_COLUMNS)}
+            FROM {self.db_table}_paths p
+            LEFT JOIN {self.db_table}_content c ON c.md5 = p.md5;"""
+        )
+        self._add_cache_indexes(db_curr)
+
+    def _compact_hashes(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Store the md5 and partial digests as BLOBs, and the crc32 and the
+        ImageHashes as INTEGERs rather than hex, and move the image types into
+        a lookup table. The tables are rebuilt with the new column types, the
+        view still shows everything as it was.
+        """
+        columns = [
+            r[1] for r in db_curr.execute(f"PRAGMA table_info({self.db_table}_paths)")
+        ]
+        if "type_id" in columns:
+            return
+
+        self._create_compact_tables(db_curr, "_compact")
+
+        db_curr.executemany(
+            f"INSERT OR IGNORE INTO {self.db_table}_types (img_type) VALUES ( ? );",
+            db_curr.execute(
+                f"SELECT DISTINCT img_type FROM {self.db_table}_paths;"
+            ).fetchall(),
+        )
+        type_ids = self._type_ids(db_curr)
+        reader = self.db_conn.cursor()
+        reader.execute(
+            f"""SELECT {", ".join(CONTENT_COLUMNS_V8)}
+            FROM {self.db_table}_content;"""
+        )
+        db_curr.executemany(
+            f"""INSERT OR IGNORE INTO {self.db_table}_content_compact
+            VALUES ( {", ".join("?" * len(CONTENT_COLUMNS_V8))} );""",
+            (
+                (_pack_digest(row[0]), _pack_hash(row[1]), row[2])
+                + tuple(_pack_hash(value) for value in row[3:7])
+                + row[7:]
+                for row in reader
+                if _pack_digest(row[0]) is not None and _pack_hash(row[1]) is not None
+            ),
+        )
+        reader.execute(
+            f"""SELECT id, filename, full_path, md5, size, img_type, mtime, inode,
+            partial FROM {self.db_table}_paths;"""
+        )
+        db_curr.executemany(
+            f"""INSERT INTO {self.db_table}_paths_compact
+            VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? );""",
+            (
+                row[:3]
+                + (_pack_digest(row[3]), row[4], type_ids[row[5]])
+                + row[6:8]
+                + (_pack_digest(row[8]),)
+                for row in reader
+            ),
+        )
+        reader.close()
+
+        db_curr.execute(f"DROP VIEW {self.db_table};")
+        for table in ("paths", "content"):
+            db_curr.execute(f"DROP TABLE {self.db_table}_{table};")
+            db_curr.execute(
+                f"""ALTER TABLE {self.db_table}_{table}_compact
+                RENAME TO {self.db_table}_{table};"""
+            )
+        db_curr.execute(f"CREATE VIEW {self.db_table} AS {_row_select(self.db_table)};")
+        self._add_cache_indexes(db_curr)
+
+    def _add_pixel_hash(self, db_curr: sqlite3.Cursor) -> None:
+        """
+        Store the pixel hash of every decoded image, indexed so copies which
+        only differ in their metadata are found with an exact lookup. Scan
+        sessions keep it too. Content cached before has none until rehashed.
+        """
+        db_curr.execute(f"DROP VIEW IF EXISTS {self.db_table};")
+        for table, column_type in (("content", "BLOB"), ("scan_files", "TEXT")):
+            columns = [
+                r[1]
+                for r in db_curr.execute(f"PRAGMA table_info({self.db_table}_{table})")
+            ]
+            if "pixel_hash" not in columns:
+                db_curr.execute(
+                    f"""ALTER TABLE {self.db_table}_{table}
+                    ADD COLUMN pixel_hash {column_type}"""
+                )
+        db_curr.execute(
+            f"""CREATE INDEX IF NOT EXISTS {self.db_table}_content_pixel_hash
+            ON {self.db_table}_content (pixel_hash);"""
+        )
+        db_curr.execute(f"CREATE VIEW {self.db_table} AS {_row_select(self.db_table)};")
+
+    def _type_ids(
+        self, db_curr: sqlite3.Cursor, img_types: Set[str] = frozenset()
+    ) -> Dict[str, int]:
+        """
+        Map image types to their ids in the types table, adding any of
+        `img_types` which are new
+        """
+        db_curr.executemany(
+            f"INSERT OR IGNORE INTO {self.db_table}_types (img_type) VALUES ( ? );",
+            [(img_type,) for img_type in img_types],
+        )
+        return dict(db_curr.execute(f"SELECT img_type, id FROM {self.db_table}_types;"))
+
+    def __del__(self):
+        self.flush()
+        self.db_conn.commit()
+        self.db_conn.close()
+        for executor in (self._io_executor, self._db_executor):
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _executor(self) -> concurrent.futures.Executor:
+        """
+        Build the pool used to hash files, as configured by `worker_mode`
+        """
+        if self.worker_mode == "thread":
+            return concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+
+    def _is_fast_duplicate(self, image: ImageHelper) -> bool:
+        """
+        In 'fast' mode a file with the same name and size as one we've already
+        cached is considered a duplicate, no need to read it.
+        """
+        row = self.by_name_size(image.filename, image.size)
+        if len(row) == 0:
+            return False
+
+        logger.info(
+            "Potential duplicate image found: "
+            + f"{image.full_path}:{image.crc32} has same size/name as "
+            + f"{row[2]}:{row[3]}"
+        )
+        self.dupe_count += 1
+        self.duplicates.append({"original": row[2], "duplicate": image.full_path})
+
+        # TODO: Currently, if a file has the same name/size, we consider
+        # it a duplicate and do not process this file. In the future, I'll
+        # introduce a 'deep' concept that will compute ImageHash values and
+        # use these to check if the image exists
+        return True
+
+    def record(self, image: ImageHelper) -> None:
+        """
+        Check a fully hashed image against the cache and store it. Images we
+        have seen before are reported as duplicates, and only their path is
+        added. This is the single writer behind the hashing pool, all of the
+        SQLite work happens here.
+        """
+        # If 'fast', just check for filename and size, ambiguous will still
+        # check for crc32 and size. If not fast, use the md5 value to search
+        if self.fast:
+            # Another worker may have cached the same name/size since the
+            # file was handed out, so check again
+            if self._is_fast_duplicate(image):
+                return
+
+            row = self.by_crc_size(image.crc32, image.size)
+            if len(row) > 0:
+                logger.info(
+                    "Duplicate crc32 found: "
+                    + f"{image.full_path}:{image.crc32} has same size/name as"
+                    + f"{row[2]}:{row[3]}"
+                )
+                self.ambiguous.append(
+                    {"original": row[2], "duplicate": image.full_path}
+                )
+                return
+        else:
+            # The default behavior is to compare the MD5 of the image and use
+            # this to check for image duplication
+            row = self.by_md5(image.md5)
+            if len(row) > 0:
+                logger.info(
+                    "Duplicate md5 found: "
+                    + f"{image.full_path}:{image.md5} has same size/name as"
+                    + f"{row[2]}:{row[4]}"
+                )
+                self.duplicates.append(
+                    {"original": row[2], "duplicate": image.full_path}
+                )
+                # The content is already cached, only the new path is stored
+                self.insert(image)
+                return
+
+        # and store all of this information in our db
+        self.insert(image)
+
+    async def gen_stats_for_file(self, full: str) -> None:
+        """
+        Hash a single file in the calling thread and record it in the cache.
+        With `verify`, the file is first checked against the cache up the
+        verification ladder, see `verify_files`. Copies proven by size or
+        partial digest are never read in full, and aren't stored.
+        """
+        if self.fast and self._is_fast_duplicate(ImageHelper(full)):
+            return
+
+        if self.verify is None:
+            image = hash_image(full)
+            if image is not None:
+                self.record(image)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            images, classified = await self.verify_files(
+                executor, [(full, os.stat(full))], perceptual=True
+            )
+        for _, original in classified["duplicates"]:
+            logger.info(
+                f"Duplicate found: {full} is a copy of {original}, verified by "
+                + f"{self.verify}"
+            )
+            self.duplicates.append({"original": original, "duplicate": full})
+        for _, original in classified["ambiguous"]:
+            self.ambiguous.append({"original": original, "duplicate": full})
+        # Everything read in full was decoded too, and is worth caching
+        for image in images:
+            self.insert(image)
+
+    async def _in_pool(
+        self, executor: concurrent.futures.Executor, worker, full: str, *args
+    ) -> Optional[ImageHelper]:
+        """
+        Run one of the worker entry points for a file in the pool
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, worker, full, *args)
+        except Exception as e:
+            logger.warning(f"Failed to process {full} with {e}")
+            self.metrics.increment("errors")
+            return None
+
+    async def _db(self, function, *args):
+        """
+        Run SQLite work, or anything touching the queued writes and scan
+        sessions, on the database thread in I/O mode and right away otherwise.
+        A single thread keeps every such call in order.
+        """
+        if self._db_executor is None:
+            return function(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_executor, function, *args)
+
+    async def _read_ahead(
+        self, full: str, stat: Optional[os.stat_result] = None
+    ) -> Optional[bytes]:
+        """
+        Read a file on the I/O threads, or None if the worker has to read it
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            data = await loop.run_in_executor(self._io_executor, read_ahead, full, stat)
+        except OSError as e:
+            logger.warning(f"Failed to read {full} with {e}")
+            return None
+        if data is not None:
+            self.metrics.add_time("read", time.perf_counter() - start)
+        return data
+
+    async def _scan(self, source: str, skip_files: Set[str] = frozenset(), failed=None):
+        """
+        Walk `source` with the scanner one directory at a time, off the event
+        loop, yielding (root, files) as each directory is listed. `failed` is
+        called with every directory which couldn't be listed.
+        """
+        loop = asyncio.get_running_loop()
+        directories = walk(
+            source, skip_files=skip_files, failed=failed, **self.scan_options
+        )
+        while True:
+            start = time.perf_counter()
+            listing = await loop.run_in_executor(None, next, directories, None)
+            self.metrics.add_time("walk", time.perf_counter() - start)
+            if listing is None:
+                return
+            yield listing
+
+    async def _pipeline(
+        self,
+        executor: concurrent.futures.Executor,
+        worker,
+        jobs,
+        consume,
+        done=None,
+        read: bool = False,
+    ) -> None:
+        """
+        Stream `jobs`, an iterable or async iterable of argument tuples for
+        `worker`, through the pool and hand every image it returns to
+        `consume`. `done`, if given, is then called with every job and its
+        result, None included. The stages are joined by queues of at most
+        `queue_size` entries, so a slow stage holds back the ones before it.
+        Work starts as soon as the first job is produced and memory stays flat
+        however many files there are.
+
+        In I/O mode, workers which take the file's `data` can have it `read`
+        ahead. Every hasher then waits on its read before handing the file to
+        the pool, so up to `io_concurrency` reads are outstanding while the
+        pool hashes the files already read.
+        """
+        jobs_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        results: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        failure: List[BaseException] = []
+
+        async def hasher() -> None:
+            while True:
+                job = await jobs_queue.get()
+                if job is None:
+                    return
+                self.metrics.queue_depth("jobs", jobs_queue.qsize())
+                task = worker
+                if read and self._io_executor is not None:
+                    stat = job[2] if len(job) > 2 else None
+                    data = await self._read_ahead(job[0], stat)
+                    if data is not None:
+                        task = functools.partial(worker, data=data)
+                image = await self._in_pool(executor, task, *job)
+                await results.put((job, image))
+                self.metrics.queue_depth("results", results.qsize())
+
+        def handle(job: tuple, image) -> None:
+            if image is not None:
+                consume(image)
+                if isinstance(image, ImageHelper):
+                    self.metrics.record_image(image)
+            else:
+                self.metrics.increment("skipped")
+            if done is not None:
+                done(job, image)
+
+        async def writer() -> None:
+            while True:
+                result = await results.get()
+                if result is None:
+                    return
+                # Keep draining after a failure so the hashers never block
+                if failure:
+                    continue
+                try:
+                    await self._db(handle, *result)
+                except Exception as e:
+                    failure.append(e)
+
+        # Two jobs per worker keeps the pool busy while results are handed
+        # back, and in I/O mode there is a hasher for every outstanding read
+        count = self.workers * 2
+        if read:
+            count = max(count, self.io_concurrency)
+        hashers = [asyncio.create_task(hasher()) for _ in range(count)]
+        writer_task = asyncio.create_task(writer())
+        if hasattr(jobs, "__aiter__"):
+            async for job in jobs:
+                await jobs_queue.put(job)
+                self.metrics.queue_depth("jobs", jobs_queue.qsize())
+        else:
+            for job in jobs:
+                await jobs_queue.put(job)
+                self.metrics.queue_depth("jobs", jobs_queue.qsize())
+        for _ in hashers:
+            await jobs_queue.put(None)
+        await asyncio.gather(*hashers)
+        await results.put(None)
+        await writer_task
+        if failure:
+            raise failure[0]
+
+    async def hash_directory(
+        self, target: str, perceptual: bool = False
+    ) -> List[ImageHelper]:
+        """
+        Hash every image under `target` with the worker pool, without touching
+        the cache. Used to check a target directory against the source, so
+        every image gets a pixel hash whether or not it is decoded for its
+        ImageHashes. With `resume`, images an interrupted run already hashed
+        are picked up from its scan session rather than hashed again.
+        """
+        session = self.start_scan("targets", target)
+        images: List[ImageHelper] = session.images()
+
+        def plan(root: str, files: List[Tuple[str, os.stat_result]]) -> List[tuple]:
+            planned = []
+            for full, stat in files:
+                if full in session.processed:
+                    continue
+                session.queued(root, full)
+                planned.append((full, perceptual, stat))
+            session.listed(root)
+            return planned
+
+        async def jobs():
+            async for root, files in self._scan(target, session.walked):
+                logger.info(f"Processing {len(files)} files in {root}")
+                for job in await self._db(plan, root, files):
+                    yield job
+
+        with self._executor() as executor:
+            await self._pipeline(
+                executor,
+                functools.partial(hash_image, pixel_hash=True),
+                jobs(),
+                images.append,
+                lambda job, image: session.finished(job[0], image),
+                read=True,
+            )
+        session.close()
+        self.metrics.emit("finished")
+        return images
+
+    def classify_targets(
+        self, images: List[ImageHelper]
+    ) -> Dict[str, List[Tuple[str, Optional[str]]]]:
+        """
+        Sort hashed target images into duplicates (same md5 as a cached file,
+        or the same pixel hash, showing the same image with other metadata),
+        ambiguous (same crc32 and size, but a different md5) and migrate
+        (neither). The targets are loaded into a temporary table and classified
+        with a few joins against the cache rather than a lookup per file.
+        Returns (target, original) pairs for each class, original being None
+        for files to migrate. The joins run against the stored digests, not
+        the view, so they stay on the indexes.
+        """
+        self.flush()
+        start = time.perf_counter()
+        targets = f"temp.{self.db_table}_targets"
+        self._lock.acquire()
+        db_curr = self.db_conn.cursor()
+        db_curr.execute(f"DROP TABLE IF EXISTS {targets};")
+        db_curr.execute(
+            f"""CREATE TABLE {targets} (
+                full_path TEXT PRIMARY KEY,
+                md5 BLOB NOT NULL,
+                crc32 INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                pixel_hash BLOB
+            );"""
+        )
+        db_curr.executemany(
+            f"INSERT OR REPLACE INTO {targets} VALUES ( ?, ?, ?, ?, ? );",
+            [
+                (
+                    i.full_path,
+                    _pack_digest(i.md5),
+                    _pack_hash(i.crc32),
+                    i.size,
+                    _pack_digest(i.pixel_hash),
+                )
+                for i in images
+            ],
+        )
+
+        paths = f"{self.db_table}_paths"
+        content = f"{self.db_table}_content"
+        same_md5 = f"EXISTS (SELECT 1 FROM {paths} s WHERE s.md5 = t.md5)"
+        # A pixel hash of NULL never matches
+        is_duplicate = (
+            f"({same_md5} OR EXISTS (SELECT 1 FROM {content} x "
+            + "WHERE x.pixel_hash = t.pixel_hash))"
+        )
+        is_ambiguous = (
+            f"EXISTS (SELECT 1 FROM {content} c "
+            + "WHERE c.crc32 = t.crc32 AND c.size = t.size)"
+        )
+        result = {}
+        result["duplicates"] = db_curr.execute(
+            f"""SELECT t.full_path, MIN(s.full_path) FROM {targets} t
+            JOIN {paths} s ON s.md5 = t.md5
+            GROUP BY t.full_path
+            UNION ALL
+            SELECT t.full_path, MIN(s.full_path) FROM {targets} t
+            JOIN {content} c ON c.pixel_hash = t.pixel_hash
+            JOIN {paths} s ON s.md5 = c.md5
+            WHERE NOT {same_md5}
+            GROUP BY t.full_path ORDER BY 1;"""
+        ).fetchall()
+        result["ambiguous"] = db_curr.execute(
+            f"""SELECT t.full_path, MIN(s.full_path) FROM {targets} t
+            JOIN {content} c ON c.crc32 = t.crc32 AND c.size = t.size
+            JOIN {paths} s ON s.md5 = c.md5
+            WHERE NOT {is_duplicate}
+            GROUP BY t.full_path ORDER BY t.full_path;"""
+        ).fetchall()
+        result["migrate"] = db_curr.execute(
+            f"""SELECT t.full_path, NULL FROM {targets} t
+            WHERE NOT {is_duplicate} AND NOT {is_ambiguous}
+            ORDER BY t.full_path;"""
+        ).fetchall()
+
+        db_curr.execute(f"DROP TABLE {targets};")
+        self.db_conn.commit()
+        db_curr.close()
+        self._lock.release()
+        self.metrics.add_time(
+            "sqlite_classify", time.perf_counter() - start, len(images)
+        )
+        return result
+
+    async def verify_files(
+        self,
+        executor: concurrent.futures.Executor,
+        files: List[Tuple[str, os.stat_result]],
+        perceptual: bool = False,
+    ) -> Tuple[List[ImageHelper], Dict[str, List[Tuple[str, Optional[str]]]]]:
+        """
+        Classify files against the cache like `classify_targets`, reading each
+        only as far as the `verify` level needs. Every file is type checked,
+        only those the same size as a cached file get a partial digest, and
+        only those whose partial digest matches too are read in full. Files
+        which don't collide are settled as unique at the cheapest level.
+
+        At 'pixels', and when `perceptual` is set, every file which isn't a
+        duplicate is decoded for its ImageHashes. With 'pixels' each one is
+        then compared, pixel by pixel, against the cached files with the same
+        phash, and reported as a duplicate if any match. Returns the images
+        read in full along with the classes.
+        """
+        self.flush()
+        stats = dict(files)
+        classified: Dict[str, List[Tuple[str, Optional[str]]]] = {
+            "duplicates": [],
+            "ambiguous": [],
+            "migrate": [],
+        }
+        cached: Dict[int, List[tuple]] = {}
+        for row in self._rows_with_sizes({stat.st_size for stat in stats.values()}):
+            cached.setdefault(row[1], []).append(row)
+
+        sniffed: List[ImageHelper] = []
+        await self._pipeline(
+            executor,
+            sniff_image,
+            [
+                (full, stat, self.verify != "size" and stat.st_size in cached)
+                for full, stat in files
+            ],
+            sniffed.append,
+        )
+        colliding: List[ImageHelper] = []
+        for image in sniffed:
+            # Cached rows from before partial digests existed match any partial
+            rows = [
+                row
+                for row in cached.get(image.size, [])
+                if row[0] != image.full_path
+                and (self.verify == "size" or not row[2] or row[2] == image.partial)
+            ]
+            if not rows:
+                classified["migrate"].append((image.full_path, None))
+                level = "partial" if image.partial else "size"
+                self.metrics.increment(f"verify_{level}")
+            elif self.verify == "size":
+                classified["duplicates"].append((image.full_path, rows[0][0]))
+                self.metrics.increment("verify_size")
+            elif self.verify == "partial" and any(row[2] for row in rows):
+                original = next(row[0] for row in rows if row[2])
+                classified["duplicates"].append((image.full_path, original))
+                self.metrics.increment("verify_partial")
+            else:
+                # Rows without a partial digest only prove the size, go on to
+                # the md5 rather than settle it on that
+                colliding.append(image)
+
+        decode = perceptual or self.verify == "pixels"
+        images: List[ImageHelper] = []
+        if colliding:
+            # Size first filtering leaves cached files without an md5
+            incomplete = sorted(
+                set(
+                    row[0]
+                    for image in colliding
+                    for row in cached[image.size]
+                    if not row[3]
+                )
+            )
+            if incomplete:
+                await self._complete_paths(executor, incomplete)
+            await self._pipeline(
+                executor,
+                hash_image,
+                [
+                    (image.full_path, decode, stats[image.full_path])
+                    for image in colliding
+                ],
+                images.append,
+                read=True,
+            )
+            for name, pairs in self.classify_targets(images).items():
+                classified[name] += pairs
+            self.metrics.increment("verify_md5", len(images))
+
+        if decode:
+            read = set(image.full_path for image in images)
+            await self._pipeline(
+                executor,
+                hash_image,
+                [
+                    (full, True, stats[full])
+                    for full, _ in classified["migrate"]
+                    if full not in read
+                ],
+                images.append,
+                read=True,
+            )
+
+        if self.verify == "pixels":
+            duplicates = set(full for full, _ in classified["duplicates"])
+            candidates = [
+                (image.full_path, original)
+                for image in images
+                if image.full_path not in duplicates
+                for _, original in self.find_similar(image.phash, 0)
+                if original != image.full_path
+            ]
+            matched: Dict[str, str] = {}
+
+            def compared(job: tuple, same: Optional[bool]) -> None:
+                if same:
+                    matched.setdefault(job[0], job[1])
+
+            await self._pipeline(
+                executor, same_pixels, candidates, lambda same: None, compared
+            )
+            self.metrics.increment("verify_pixels", len(candidates))
+            for name in ("ambiguous", "migrate"):
+                classified[name] = [
+                    pair for pair in classified[name] if pair[0] not in matched
+                ]
+            classified["duplicates"] += list(matched.items())
+
+        for pairs in classified.values():
+            pairs.sort()
+        return images, classified
+
+    async def verify_directory(
+        self, target: str, perceptual: bool = False
+    ) -> Tuple[List[ImageHelper], Dict[str, List[Tuple[str, Optional[str]]]]]:
+        """
+        Walk `target` and check every file in it against the cache up to the
+        `verify` level, see `verify_files`. Unlike `hash_directory` the whole
+        tree is listed first and the run isn't recorded as a scan session.
+        """
+        files: List[Tuple[str, os.stat_result]] = []
+        async for root, listing in self._scan(target):
+            files += listing
+        logger.info(f"Verifying {len(files)} files in {target} by {self.verify}")
+        with self._executor() as executor:
+            result = await self.verify_files(executor, files, perceptual)
+        self.metrics.emit("finished")
+        return result
+
+    def _load_known(self, source: str) -> Dict[str, tuple]:
+        """
+        Fetch the size, mtime and inode of every cached file under `source`,
+        keyed on the full path. Used to decide what a refresh has to rehash.
+        """
+        # Bounded at a separator, so /photos doesn't take in /photos_backup
+        prefix = os.path.join(source, "")
+        db_curr = self.db_conn.cursor()
+        rows = db_curr.execute(
+            f"""SELECT full_path, size, mtime, inode FROM {self.db_table}
+            WHERE full_path >= ? AND full_path < ?;""",
+            # A range over the full_path index covers everything under source
+            (prefix, prefix + chr(0x10FFFF)),
+        ).fetchall()
+        db_curr.close()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def _is_unchanged(self, image: ImageHelper, known: Dict[str, tuple]) -> bool:
+        """
+        A refresh only rehashes files which are new, or whose size, mtime or
+        inode differ from what we cached. Stale rows are dropped with the next
+        batch, so the new digests don't match the file's own out of date entry.
+        """
+        previous = known.get(image.full_path)
+        if previous is None:
+            return False
+        if previous == (image.size, image.mtime, image.inode):
+            return True
+        self._queue_delete(image.full_path)
+        return False
+
+    def _rows_with_sizes(self, sizes: List[int]) -> List[tuple]:
+        """
+        Fetch (full_path, size, partial, md5) for every cached file with one
+        of the given sizes
+        """
+        self.flush()
+        rows = []
+        sizes = list(sizes)
+        db_curr = self.db_conn.cursor()
+        for i in range(0, len(sizes), self.lookup_chunk):
+            chunk = sizes[i : i + self.lookup_chunk]
+            chunk += [chunk[-1]] * (self.lookup_chunk - len(chunk))
+            rows += db_curr.execute(
+                f"""SELECT full_path, size, partial, md5 FROM {self.db_table}
+                WHERE size IN ({", ".join("?" * self.lookup_chunk)});""",
+                chunk,
+            ).fetchall()
+        db_curr.close()
+        return rows
+
+    async def _filter_by_size(
+        self,
+        executor: concurrent.futures.Executor,
+        candidates: List[Tuple[str, os.stat_result]],
+        finished=None,
+    ) -> List[Tuple[str, os.stat_result]]:
+        """
+        Size first filtering. Every candidate is type checked and given a
+        cheap partial digest, then only files whose size and partial digest
+        collide with another file, walked or cached, are returned to be fully
+        hashed. The rest are cached straight away without an md5 or crc32,
+        see `complete_digests`. `finished` is called with every candidate
+        which is dealt with here, rather than returned.
+        """
+
+        def done(job: tuple, image: Optional[ImageHelper]) -> None:
+            if image is None and finished is not None:
+                finished(job[0])
+
+        images: List[ImageHelper] = []
+        await self._pipeline(executor, sniff_image, candidates, images.append, done)
+
+        # Cached rows from before partial digests existed match any partial.
+        # A candidate's own row, from an earlier run, is no other file.
+        stats = dict(candidates)
+        groups: Dict[tuple, int] = {}
+        wildcard_sizes = set()
+        incomplete = []
+        cached = [
+            row
+            for row in self._rows_with_sizes({image.size for image in images})
+            if row[0] not in stats
+        ]
+        for full_path, size, partial, md5 in cached:
+            if not partial:
+                wildcard_sizes.add(size)
+            groups[(size, partial)] = groups.get((size, partial), 0) + 1
+        for image in images:
+            key = (image.size, image.partial)
+            groups[key] = groups.get(key, 0) + 1
+
+        # Cached rows which now collide with a new file need their digests
+        # too, or the new file can't be checked against them
+        for full_path, size, partial, md5 in cached:
+            if not md5 and (groups[(size, partial)] > 1 or size in wildcard_sizes):
+                incomplete.append(full_path)
+        if incomplete:
+            await self._complete_paths(executor, incomplete)
+
+        colliding = []
+        for image in images:
+            if groups[(image.size, image.partial)] > 1 or image.size in wildcard_sizes:
+                colliding.append((image.full_path, stats[image.full_path]))
+            else:
+                self.insert(image)
+                if finished is not None:
+                    finished(image.full_path)
+        logger.info(
+            f"Size first filtering: {len(images) - len(colliding)} of "
+            + f"{len(images)} images are unique and were not fully read."
+        )
+        return colliding
+
+    async def _complete_paths(
+        self, executor: concurrent.futures.Executor, paths: List[str]
+    ) -> None:
+        """
+        Fill in the md5 and crc32 of cached rows written by size first filtering
+        """
+        images: List[ImageHelper] = []
+        await self._pipeline(
+            executor,
+            hash_image,
+            [(full, False) for full in paths],
+            images.append,
+            read=True,
+        )
+        self._lock.acquire()
+        db_curr = self.db_conn.cursor()
+        db_curr.executemany(
+            f"UPDATE {self.db_table}_paths SET md5 = ? WHERE full_path = ?;",
+            [(_pack_digest(image.md5), image.full_path) for image in images],
+        )
+        # They were never decoded, so keep any content a copy already has.
+        # JPEGs still have a pixel hash, see ImageHelper.compute_pixel_hash.
+        db_curr.executemany(
+            f"""INSERT OR IGNORE INTO {self.db_table}_content (
+                md5, crc32, size, pixel_hash
+            ) VALUES ( ?, ?, ?, ? );""",
+            [
+                (
+                    _pack_digest(image.md5),
+                    _pack_hash(image.crc32),
+                    image.size,
+                    _pack_digest(image.pixel_hash),
+                )
+                for image in images
+            ],
+        )
+        db_curr.executemany(
+            f"""UPDATE {self.db_table}_content SET pixel_hash = ?
+            WHERE md5 = ? AND pixel_hash IS NULL;""",
+            [
+                (_pack_digest(image.pixel_hash), _pack_digest(image.md5))
+                for image in images
+                if image.pixel_hash
+            ],
+        )
+        self.db_conn.commit()
+        db_curr.close()
+        self._lock.release()
+
+    async def complete_digests(self, sizes: List[int]) -> int:
+        """
+        Size first filtering caches unique files without an md5 or crc32.
+        Before checking files of the given sizes against the cache, fully
+        hash any such rows they could match. Returns how many were hashed.
+        """
+        paths = [row[0] for row in self._rows_with_sizes(sizes) if not row[3]]
+        if paths:
+            with self._executor() as executor:
+                await self._complete_paths(executor, paths)
+        return len(paths)
+
+    async def gen_cache_from_directory(self, source: str) -> None:
+        """
+        Given a directory generate the image cache for all image files. The
+        walk, the worker pool computing digests and the writer recording the
+        results run concurrently as a bounded pipeline, see `_pipeline`.
+
+        When `refresh` is set only new or modified files are hashed, and rows
+        for files which no longer exist under `source` are removed. With
+        `size_first` the whole tree is walked before anything is hashed, so
+        that files with a unique size and partial digest are never fully read.
+        Those have no pixel hash, so copies of them with edited metadata are
+        only found once `complete_digests` has read them.
+
+        Progress is recorded in a scan session as the walk goes. With `resume`,
+        an interrupted walk of `source` carries on from where it stopped,
+        skipping files it already processed and directories it finished.
+
+        Files the same size and partial digest as a cached file are likely
+        copies, so they are only digested at first. Their content is looked up
+        by md5, and only those which turn out to be new are decoded for the
+        ImageHashes. Any other file is decoded as it is read. Cached files
+        size first filtering left without an md5 are read in full first when
+        one of them matches, so copies of them are still found.
+        """
+        start = time.time()
+        session = self.start_scan("cache", source)
+        known = self._load_known(source) if self.refresh else {}
+        seen = set()
+        unlisted: List[str] = []
+        queued = 0
+        candidates = []
+        digested: Dict[str, os.stat_result] = {}
+        undecoded: Dict[str, os.stat_result] = {}
+        deferred: Dict[str, Tuple[ImageHelper, os.stat_result]] = {}
+        incomplete: Set[str] = set()
+
+        def consume(image: ImageHelper) -> None:
+            stat = digested.pop(image.full_path, None)
+            if stat is not None and not image.ahash and not self.by_md5(image.md5):
+                # It may be a copy of a file whose md5 isn't known yet. Those
+                # walked this time are hashed anyway.
+                unread = self._paths_without_md5(image.size, image.partial) - seen
+                if unread:
+                    incomplete.update(unread)
+                    deferred[image.full_path] = (image, stat)
+                    return
+                undecoded[image.full_path] = stat
+                return
+            self.record(image)
+
+        def finished(job: tuple, image: Optional[ImageHelper] = None) -> None:
+            # Files still waiting to be decoded aren't done yet
+            if job[0] not in undecoded and job[0] not in deferred:
+                session.finished(job[0])
+
+        def reconsume() -> None:
+            for full, (image, stat) in deferred.items():
+                digested[full] = stat
+                consume(image)
+                if full not in undecoded:
+                    session.finished(full)
+            deferred.clear()
+
+        def plan(root: str, files: List[Tuple[str, os.stat_result]]) -> List[tuple]:
+            nonlocal queued
+            planned = []
+            for full, stat in files:
+                seen.add(full)
+                if full in session.processed:
+                    continue
+                if self.refresh or self.fast:
+                    image = ImageHelper(full, stat=stat)
+                    unchanged = self.refresh and self._is_unchanged(image, known)
+                    # Don't bother the pool with files 'fast' mode would skip
+                    if unchanged or (self.fast and self._is_fast_duplicate(image)):
+                        session.finished(full)
+                        continue
+                queued += 1
+                session.queued(root, full)
+                if self.size_first:
+                    candidates.append((full, stat))
+                    continue
+                partials = self._partials_with_size(stat.st_size)
+                if partials is None or partials:
+                    digested[full] = stat
+                    planned.append((full, False, stat, partials))
+                    continue
+                planned.append((full, True, stat))
+            session.listed(root)
+            return planned
+
+        async def jobs():
+            # A refresh has to see every file to spot deleted ones
+            walked = set() if self.refresh else session.walked
+            async for root, files in self._scan(source, walked, unlisted.append):
+                logger.info(f"Processing {len(files)} files in {root}")
+                for job in await self._db(plan, root, files):
+                    yield job
+
+        with self._executor() as executor:
+            await self._pipeline(
+                executor, hash_image, jobs(), consume, finished, read=True
+            )
+            if incomplete:
+                await self._complete_paths(executor, sorted(incomplete))
+                await self._db(reconsume)
+            if undecoded:
+                decode = list(undecoded.items())
+                undecoded.clear()
+                await self._pipeline(
+                    executor,
+                    hash_image,
+                    [(full, True, stat) for full, stat in decode],
+                    self.record,
+                    finished,
+                    read=True,
+                )
+            if self.size_first:
+                colliding = await self._filter_by_size(
+                    executor, candidates, session.finished
+                )
+                await self._pipeline(
+                    executor,
+                    hash_image,
+                    [(full, True, stat) for full, stat in colliding],
+                    self.record,
+                    finished,
+                    read=True,
+                )
+
+        # Only files the walk would have returned are gone, whole directories
+        # of them included. Those under a directory which failed to list, or
+        # which are filtered out, keep their rows.
+        unlisted_prefixes = tuple(os.path.join(root, "") for root in unlisted)
+        removed = [
+            full
+            for full in known
+            if full not in seen
+            and not full.startswith(unlisted_prefixes)
+            and is_walked(
+                full,
+                source,
+                self.scan_options["include"],
+                self.scan_options["exclude"],
+                self.scan_options["skip_hidden"],
+            )
+        ]
+        for full in removed:
+            self._queue_delete(full)
+        self.flush()
+        if self.refresh:
+            logger.info(
+                f"Refreshed {queued} new or modified files, "
+                + f"removed {len(removed)} deleted files."
+            )
+
+        session.close()
+        self.processing_time = int(time.time() - start)
+        self.metrics.emit("finished")
+
+    def insert(self, image: ImageHelper) -> None:
+        """
+        Helper sqlite function to queue a new row. Rows are written out in
+        batches, see `flush`.
+        """
+        # Images which were only digested, because their content was already
+        # cached, must not replace the content row with empty hashes
+        store_content = bool(image.md5) and (
+            bool(image.ahash) or not self.by_md5(image.md5)
+        )
+        self._start_batch()
+        self._pending.append(
+            (
+                image.filename,
+                image.full_path,
+                _pack_digest(image.md5),
+                image.size,
+                image.img_type,
+                image.mtime,
+                image.inode,
+                _pack_digest(image.partial),
+            )
+        )
+        if store_content:
+            self._pending_content.append(
+                (_pack_digest(image.md5), _pack_hash(image.crc32), image.size)
+                + tuple(_pack_hash(getattr(image, h)) for h in PERCEPTUAL_HASHES)
+                + tuple(getattr(image, column) for column in EXIF_COLUMNS)
+                + (_pack_digest(image.pixel_hash),)
+            )
+
+        # Remember the keys we look rows up by so that duplicates within the
+        # same batch are caught before it reaches the database. The pending
+        # rows mirror the column order of SELECT *.
+        pending_row = (
+            None,
+            image.filename,
+            image.full_path,
+            image.crc32,
+            image.md5,
+            image.ahash,
+            image.phash,
+            image.dhash,
+            image.whash,
+            image.size,
+            image.img_type,
+            image.mtime,
+            image.inode,
+            image.partial,
+        ) + tuple(getattr(image, column) for column in EXIF_COLUMNS)
+        pending_row += (image.pixel_hash,)
+        for kind, columns in LOOKUP_KEYS.items():
+            key = (kind,) + tuple(getattr(image, column) for column in columns)
+            self._pending_keys.setdefault(key, pending_row)
+
+        self._end_batch()
+
+    def _queue_delete(self, full_path: str) -> None:
+        """
+        Queue the row for a file to be removed, along with its content unless
+        another path still points at it. The row is dropped before the batch's
+        new rows are written, so the file can be queued again straight away.
+        """
+        self._start_batch()
+        self._pending_deletes.add(full_path)
+        self._end_batch()
+
+    def _has_pending(self) -> bool:
+        return bool(
+            self._pending
+            or self._pending_files
+            or self._pending_directories
+            or self._pending_deletes
+        )
+
+    def _start_batch(self) -> None:
+        if not self._has_pending():
+            self._pending_since = time.time()
+
+    def _end_batch(self) -> None:
+        if (
+            max(
+                len(self._pending), len(self._pending_files), len(self._pending_deletes)
+            )
+            >= self.batch_size
+            or time.time() - self._pending_since >= self.commit_interval
+        ):
+            self.flush()
+
+    def _queue_progress(
+        self,
+        scan_id: int,
+        full_path: Optional[str] = None,
+        image: Optional[ImageHelper] = None,
+        directory: Optional[str] = None,
+    ) -> None:
+        """
+        Queue a file or a directory finished by a scan session. Progress is
+        written with the rows, so a file is never recorded as processed before
+        the row it produced is committed.
+        """
+        self._start_batch()
+        if directory is not None:
+            self._pending_directories.append((scan_id, directory))
+        if full_path is not None:
+            values = (None,) * 7
+            if image is not None:
+                values = (
+                    image.size,
+                    image.mtime,
+                    image.inode,
+                    image.crc32,
+                    image.md5,
+                    image.phash,
+                    image.pixel_hash,
+                )
+            self._pending_files.append((scan_id, full_path) + values)
+        self._end_batch()
+
+    def start_scan(self, kind: str, root: str) -> ScanSession:
+        """
+        Begin a scan session of the given kind over `root`. With `resume` the
+        latest unfinished session for the same walk is picked up instead, and
+        otherwise any such session is abandoned.
+        """
+        self.flush()
+        scans = f"{self.db_table}_scans"
+        self._lock.acquire()
+        db_curr = self.db_conn.cursor()
+        unfinished = db_curr.execute(
+            f"""SELECT id FROM {scans} WHERE kind = ? AND root = ?
+            AND finished IS NULL ORDER BY id DESC;""",
+            (kind, root),
+        ).fetchall()
+        processed, walked = set(), set()
+        if self.resume and unfinished:
+            scan_id = unfinished.pop(0)[0]
+            processed = set(
+                row[0]
+                for row in db_curr.execute(
+                    f"""SELECT full_path FROM {self.db_table}_scan_files
+                    WHERE scan_id = ?;""",
+                    (scan_id,),
+                )
+            )
+            walked = set(
+                row[0]
+                for row in db_curr.execute(
+                    f"""SELECT directory FROM {self.db_table}_scan_dirs
+                    WHERE scan_id = ?;""",
+                    (scan_id,),
+                )
+            )
+            logger.info(
+                f"Resuming scan of {root}: {len(processed)} files in "
+                + f"{len(walked)} finished directories are skipped."
+            )
+        else:
+            scan_id = db_curr.execute(
+                f"INSERT INTO {scans} (kind, root, started) VALUES ( ?, ?, ? );",
+                (kind, root, time.time()),
+            ).lastrowid
+        for (abandoned,) in unfinished:
+            self._clear_scan(db_curr, abandoned)
+            db_curr.execute(f"DELETE FROM {scans} WHERE id = ?;", (abandoned,))
+        self.db_conn.commit()
+        db_curr.close()
+        self._lock.release()
+        return ScanSession(self, scan_id, processed, walked)
+
+    def _clear_scan(self, db_curr: sqlite3.Cursor, scan_id: int) -> None:
+        for table in ("scan_files", "scan_dirs"):
+            db_curr.execute(
+                f"DELETE FROM {self.db_table}_{table} WHERE scan_id = ?;", (scan_id,)
+            )
+
+    def finish_scan(self, scan_id: int) -> None:
+        """
+        Mark a scan session as complete and drop its progress
+        """
+        self.flush()
+        self._lock.acquire()
+        db_curr = self.db_conn.cursor()
+        self._clear_scan(db_curr, scan_id)
+        db_curr.execute(
+            f"UPDATE {self.db_table}_scans SET finished = ? WHERE id = ?;",
+            (time.time(), scan_id),
+        )
+        self.db_conn.commit()
+        db_curr.close()
+        self._lock.release()
+
+    def _scan_images(self, scan_id: int) -> List[ImageHelper]:
+        """
+        Rebuild the images a scan session recorded with their digests
+        """
+        db_curr = self.db_conn.cursor()
+        rows = db_curr.execute(
+            f"""SELECT full_path, size, mtime, inode, crc32, md5, phash, pixel_hash
+            FROM {self.db_table}_scan_files
+            WHERE scan_id = ? AND md5 IS NOT NULL;""",
+            (scan_id,),
+        ).fetchall()
+        db_curr.close()
+        return [
+            ImageHelper.restore(
+                full,
+                size,
+                mtime,
+                inode,
+                crc32=crc32,
+                md5=md5,
+                phash=phash,
+                pixel_hash=pixel_hash,
+            )
+            for full, size, mtime, inode, crc32, md5, phash, pixel_hash in rows
+        ]
+
+    def flush(self) -> None:
+        """
+        Write every queued row, along with any scan progress, in a single
+        transaction and commit it
+        """
+        if not self._has_pending():
+            return
+        start = time.perf_counter()
+        self._lock.acquire()
+        db_curr = self.db_conn.cursor()
+        deleted = [(full_path,) for full_path in self._pending_deletes]
+        orphans = [
+            row
+            for full_path in deleted
+            for row in db_curr.execute(
+                f"""SELECT md5 FROM {self.db_table}_paths
+                WHERE full_path = ? AND md5 IS NOT NULL;""",
+                full_path,
+            ).fetchall()
+        ]
+        db_curr.executemany(
+            f"DELETE FROM {self.db_table}_paths WHERE full_path = ?;", deleted
+        )
+        # Queued rows hold the image type, the table its id
+        type_ids = self._type_ids(db_curr, set(row[4] for row in self._pending))
+        db_curr.executemany(
+            f"""INSERT OR REPLACE INTO {self.db_table}_paths (
+                {", ".join(PATH_COLUMNS)}
+            ) VALUES ( {", ".join("?" * len(PATH_COLUMNS))} )""",
+            [row[:4] + (type_ids[row[4]],) + row[5:] for row in self._pending],
+        )
+        db_curr.executemany(
+            f"""INSERT OR REPLACE INTO {self.db_table}_content (
+                {", ".join(CONTENT_COLUMNS)}
+            ) VALUES ( {", ".join("?" * len(CONTENT_COLUMNS))} )""",
+            self._pending_content,
+        )
+        # Content goes once no path, old or new, points at it any more
+        db_curr.executemany(
+            f"""DELETE FROM {self.db_table}_content WHERE md5 = ? AND NOT EXISTS (
+                SELECT 1 FROM {self.db_table}_paths p
+                WHERE p.md5 = {self.db_table}_content.md5
+            );""",
+            orphans,
+        )
+        db_curr.executemany(
+            f"""INSERT OR REPLACE INTO {self.db_table}_scan_files (
+                scan_id, full_path, size, mtime, inode, crc32, md5, phash,
+                pixel_hash
+            ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )""",
+            self._pending_files,
+        )
+        db_curr.executemany(
+            f"""INSERT OR IGNORE INTO {self.db_table}_scan_dirs (
+                scan_id, directory
+            ) VALUES ( ?, ? )""",
+            self._pending_directories,
+        )
+        self.db_conn.commit()
+        db_curr.close()
+        self._lock.release()
+        self.metrics.add_time(
+            "sqlite_insert", time.perf_counter() - start, len(self._pending)
+        )
+        logger.debug(f"Committed {len(self._pending)} rows to {self.db_table}")
+        if self._pending or self._pending_deletes:
+            self._similarity_indexes = {}
+        self._pending = []
+        self._pending_content = []
+        self._pending_keys = {}
+        self._pending_deletes = set()
+        self._pending_files = []
+        self._pending_directories = []
+
+    def _lookup_one(self, kind: str, key: tuple) -> List[str]:
+        """
+        Look a row up in the queued writes first, then in the database
+        """
+        row = self._pending_keys.get((kind,) + key)
+        if row is not None:
+            return row
+        with self.metrics.timer("sqlite_lookup"):
+            db_curr = self.db_conn.cursor()
+            ret = db_curr.execute(
+                self._lookup_sql[kind], _pack_key(LOOKUP_KEYS[kind], key)
+            ).fetchone()
+            db_curr.close()
+        # A row queued for removal must not be matched, drop it and look again
+        if ret is not None and ret[2] in self._pending_deletes:
+            self.flush()
+            return self._lookup_one(kind, key)
+        return [] if ret is None else ret
+
+    def _lookup_many(self, kind: str, keys: List[tuple]) -> Dict[tuple, tuple]:
+        """
+        Look up one row for each of many keys, in chunks of `lookup_chunk`.
+        The last chunk is padded with a repeated key so that every query has
+        the same text and reuses the same cached statement.
+        """
+        # Rows queued for removal must not be matched
+        if self._pending_deletes:
+            self.flush()
+        found = {}
+        remaining = []
+        for key in dict.fromkeys(keys):
+            row = self._pending_keys.get((kind,) + key)
+            if row is not None:
+                found[key] = row
+            else:
+                remaining.append(key)
+
+        start = time.perf_counter()
+        db_curr = self.db_conn.cursor()
+        for i in range(0, len(remaining), self.lookup_chunk):
+            chunk = remaining[i : i + self.lookup_chunk]
+            chunk += [chunk[-1]] * (self.lookup_chunk - len(chunk))
+            params = [
+                value for key in chunk for value in _pack_key(LOOKUP_KEYS[kind], key)
+            ]
+            rows = db_curr.execute(self._lookup_many_sql[kind], params)
+            names = [d[0] for d in db_curr.description]
+            indexes = [names.index(column) for column in LOOKUP_KEYS[kind]]
+            for row in rows:
+                found.setdefault(tuple(row[i] for i in indexes), row)
+        db_curr.close()
+        self.metrics.add_time(
+            "sqlite_lookup", time.perf_counter() - start, len(remaining)
+        )
+        return found
+
+    def by_md5(self, md5: str) -> List[str]:
+        """
+        Fetch a cached image with the given md5, or [] if there is none
+        """
+        return self._lookup_one("md5", (md5,))
+
+    def by_crc_size(self, crc32: str, size: int) -> List[str]:
+        """
+        Fetch a cached image with the given crc32 and size, or [] if there is none
+        """
+        return self._lookup_one("crc_size", (crc32, size))
+
+    def by_name_size(self, filename: str, size: int) -> List[str]:
+        """
+        Fetch a cached image with the given file name and size, or [] if there
+        is none
+        """
+        return self._lookup_one("name_size", (filename, size))
+
+    def _paths_without_md5(self, size: int, partial: str) -> Set[str]:
+        """
+        The cached files of the given size and partial digest which size first
+        filtering never read in full, see `complete_digests`
+        """
+        db_curr = self.db_conn.cursor()
+        paths = set(
+            row[0]
+            for row in db_curr.execute(
+                f"""SELECT full_path FROM {self.db_table}_paths
+                WHERE size = ? AND partial = ? AND md5 IS NULL;""",
+                (size, _pack_digest(partial)),
+            )
+        )
+        db_curr.close()
+        return paths
+
+    def _partials_with_size(self, size: int) -> Optional[Set[str]]:
+        """
+        The partial digests of every cached file of the given size, queued
+        ones included. None if any of them has none, as it could match any.
+        """
+        with self.metrics.timer("sqlite_lookup"):
+            db_curr = self.db_conn.cursor()
+            packed = [
+                row[0]
+                for row in db_curr.execute(
+                    f"SELECT partial FROM {self.db_table}_paths WHERE size = ?;",
+                    (size,),
+                )
+            ]
+            db_curr.close()
+        packed += [row[7] for row in self._pending if row[3] == size]
+        if any(partial is None for partial in packed):
+            return None
+        return {partial.hex() for partial in packed}
+
+    def by_pixel_hash(self, pixel_hash: str) -> List[str]:
+        """
+        Fetch a cached image showing the same pixels, whatever its metadata,
+        or [] if there is none. See ImageHelper.compute_pixel_hash.
+        """
+        if not pixel_hash:
+            return []
+        return self._lookup_one("pixel_hash", (pixel_hash,))
+
+    def by_md5_many(self, md5s: List[str]) -> Dict[str, tuple]:
+        """
+        Fetch a cached image for each of the given md5s, keyed on the md5.
+        Digests with no match are left out.
+        """
+        found = self._lookup_many("md5", [(md5,) for md5 in md5s])
+        return {key[0]: row for key, row in found.items()}
+
+    def by_crc_size_many(self, keys: List[Tuple[str, int]]) -> Dict[tuple, tuple]:
+        """
+        Fetch a cached image for each of the given (crc32, size) pairs
+        """
+        return self._lookup_many("crc_size", [tuple(key) for key in keys])
+
+    def by_name_size_many(self, keys: List[Tuple[str, int]]) -> Dict[tuple, tuple]:
+        """
+        Fetch a cached image for each of the given (filename, size) pairs
+        """
+        return self._lookup_many("name_size", [tuple(key) for key in keys])
+
+    def delete(self, full_path: str) -> None:
+        """
+        Helper sqlite function to remove the row for a given file, and its
+        content unless another path still points at it
+        """
+        # A queued row for the path would otherwise be written after the delete
+        self.flush()
+        self._queue_delete(full_path)
+        self.flush()
+
+    def rename(self, full_path: str, new_path: str) -> None:
+        """
+        Helper sqlite function to point the row for a file at its new location
+        """
+        self.flush()
+        self._lock.acquire()
+        db_curr = self.db_conn.cursor()
+        db_curr.execute(
+            f"""UPDATE OR REPLACE {self.db_table}_paths SET full_path = ?, filename = ?
+            WHERE full_path = ?;""",
+            (new_path, os.path.basename(new_path), full_path),
+        )
+        self.db_conn.commit()
+        db_curr.close()
+        self._lock.release()
+
+    def similarity_index(self, hash_name: str = "phash") -> BKTree:
+        """
+        Fetch the BK-tree over one of the ImageHash columns, building it from
+        the table if this is the first search since the cache last changed.
+        """
+        if hash_name not in PERCEPTUAL_HASHES:
+            raise ValueError(
+                f"Unknown hash {hash_name}, expected one of {PERCEPTUAL_HASHES}"
+            )
+        index = self._similarity_indexes.get(hash_name)
+        if index is not None:
+            return index
+
+        self.flush()
+        start = time.time()
+        index = BKTree()
+        db_curr = self.db_conn.cursor()
+        # The hashes are stored signed, mask them back to 64 bits
+        rows = db_curr.execute(
+            f"""SELECT c.{hash_name}, p.full_path
+            FROM {self.db_table}_paths p
+            JOIN {self.db_table}_content c ON c.md5 = p.md5
+            WHERE c.{hash_name} IS NOT NULL;"""
+        )
+        for image_hash, full_path in rows:
+            index.add(image_hash & 0xFFFFFFFFFFFFFFFF, full_path)
+        db_curr.close()
+        logger.info(
+            f"Built {hash_name} index over {len(index)} images in "
+            + f"{time.time() - start:.2f} seconds."
+        )
+        self._similarity_indexes[hash_name] = index
+        return index
+
+    def find_similar(
+        self, image_hash: str, max_distance: int = 8, hash_name: str = "phash"
+    ) -> List[Tuple[int, str]]:
+        """
+        Find every cached image whose `hash_name` is within `max_distance`
+        bits of the given hex hash. Returns (distance, full_path) pairs,
+        closest first.
+        """
+        if not image_hash:
+            return []
+        index = self.similarity_index(hash_name)
+        return index.search(int(image_hash, 16), max_distance)
+
+    def find_clusters(
+        self,
+        max_distance: int = 8,
+        hash_names: Tuple[str, ...] = ("phash", "dhash"),
+        block_size: int = 512,
+    ) -> List[List[str]]:
+        """
+        Group every cached image into clusters of visually similar images. Two
+        images are similar when each of `hash_names` is within `max_distance`
+        bits, see similarity.cluster_hashes for how all pairs are compared.
+        """
+        for hash_name in hash_names:
+            if hash_name not in PERCEPTUAL_HASHES:
+                raise ValueError(
+                    f"Unknown hash {hash_name}, expected one of {PERCEPTUAL_HASHES}"
+                )
+
+        self.flush()
+        start = time.time()
+        columns = ", ".join(f"c.{h}" for h in hash_names)
+        present = " AND ".join(f"c.{h} IS NOT NULL" for h in hash_names)
+        rows = self.query(
+            f"""SELECT p.full_path, {columns} FROM {self.db_table}_paths p
+            JOIN {self.db_table}_content c ON c.md5 = p.md5 WHERE {present}"""
+        )
+        if not rows:
+            return []
+
+        paths = [row[0] for row in rows]
+        hashes = [
+            stored_to_array([row[i + 1] for row in rows])
+            for i in range(len(hash_names))
+        ]
+        clusters = [
+            [paths[i] for i in group]
+            for group in cluster_hashes(
+                hashes, max_distance, block_size, workers=self.workers
+            )
+        ]
+        logger.info(
+            f"Found {len(clusters)} clusters among {len(paths)} images in "
+            + f"{time.time() - start:.2f} seconds."
+        )
+        return clusters
+
+    def get_table(self) -> str:
+        return self.db_table
+
+    def get_duplicates(self) -> List[Dict[str, str]]:
+        return self.duplicates
+
+    def get_ambiguous(self) -> List[Dict[str, str]]:
+        return self.ambiguous
+
+    def lookup(self, where_clause: str = "", params: tuple = ()) -> List[str]:
+        """
+        Helper sqlite function to look up any rows that might exist given
+        a where clause. Returns at most one row. Prefer the by_* lookups, or
+        at least pass values as bound `params` rather than in the clause.
+        """
+        query = f"""
+            SELECT * FROM {self.db_table}
+        """
+        if where_clause:
+            query += " " + where_clause
+        query += ";"
+        db_curr = self.db_conn.cursor()
+        ret = db_curr.execute(query, params).fetchone()
+        db_curr.close()
+        return [] if ret is None else ret
+
+    def get_count(self, where_clause: str = "") -> List[str]:
+        """
+        Helper sqlite function to fetch the size of the DB
+        """
+        query = f"""
             SELECT COUNT(id) FROM {self.db_table};
         """
         db_curr = self.db_conn.cursor()
         ret = db_curr.execute(query).fetchone()
         return 0 if ret is None else ret[0]
 
-    def query(self, query: str = "") -> List[str]:
+    def query(self, query: str = "", params: tuple = ()) -> List[str]:
         """
         Helper sqlite function to exec an arbitrary query
         """
-        if not query.endswith(';'):
-            query += ';'
+        if not query.endswith(";"):
+            query += ";"
         db_curr = self.db_conn.cursor()
-        return db_curr.execute(query).fetchall()
+        rows = db_curr.execute(query, params).fetchall()
+        db_curr.close()
+        return rows
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+import unittest
+
+# Insert the src directory for our code to the beginning of the path
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__),
+            "../src"
+        )
+    )
+)
+
+from benchmark import generate_corpus
+from benchmark import run_benchmark
+from scanner import walk
+
+
+def async_test(coro):
+    def wrapper(*args, **kwargs):
+        loop = asyncio.new_event_loop()
+        return loop.run_until_complete(coro(*args, **kwargs))
+    return wrapper
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_generate_corpus(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            corpus = generate_corpus(
+                tmpdir, 30, formats=("jpeg", "png"), duplicate_ratio=0.3,
+                size=(64, 48)
+            )
+            files = [full for _, listing in walk(tmpdir) for full, _ in listing]
+            self.assertEqual(len(files), 30)
+            self.assertEqual(corpus["unique"] + corpus["duplicates"], 30)
+            self.assertGreater(corpus["duplicates"], 0)
+            self.assertTrue(any(f.endswith(".png") for f in files))
+            self.assertEqual(corpus["bytes"], sum(os.path.getsize(f) for f in files))
+
+    @async_test
+    async def test_run_benchmark(self):
+        results = await run_benchmark(
+            count=20, size=(64, 48), duplicate_ratio=0.5, worker_mode="thread",
+            workers=2
+        )
+        # Everything has to survive a round trip through JSON
+        results = json.loads(json.dumps(results))
+        for stage in ("walk", "type_check", "read", "md5", "perceptual_hash",
+                      "insert", "lookup"):
+            self.assertGreater(results["stages"][stage]["files"], 0)
+            self.assertGreaterEqual(results["stages"][stage]["seconds"], 0)
+        self.assertEqual(results["pipeline"]["gen_cache"]["files"], 20)
+        dupes = results["pipeline"]["find_dupes"]
+        self.assertEqual(dupes["duplicates"], 1)
+        self.assertEqual(dupes["migrate"], 2)
+        metrics = results["pipeline"]["metrics"]
+        self.assertGreater(metrics["counters"]["files"], 0)
+        self.assertIn("sqlite_classify", metrics["stages"])
+
+
+if __name__ == "__main__":
+    unittest.main()
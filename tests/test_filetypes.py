@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+
+import unittest
+
+# Insert the src directory for our code to the beginning of the path
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__),
+            "../src"
+        )
+    )
+)
+
+from filetypes import sniff_image_type
+from image_cache import ImageHelper
+
+
+class TestSniffImageType(unittest.TestCase):
+
+    def test_signatures(self):
+        headers = {
+            b"\xff\xd8\xff\xe0\x00\x10JFIF\x00": "jpeg",
+            b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR": "png",
+            b"GIF89a\x01\x00\x01\x00": "gif",
+            b"RIFF\x24\x00\x00\x00WEBPVP8 ": "webp",
+            b"II*\x00\x08\x00\x00\x00": "tiff",
+            b"MM\x00*\x00\x00\x00\x08": "tiff",
+            b"II*\x00\x10\x00\x00\x00CR\x02\x00": "cr2",
+            b"IIRO\x08\x00\x00\x00": "orf",
+            b"IIU\x00\x18\x00\x00\x00": "rw2",
+            b"FUJIFILMCCD-RAW 0201": "raf",
+            b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00": "heic",
+            b"\x00\x00\x00\x18ftypmif1\x00\x00\x00\x00": "heif",
+            b"\x00\x00\x00\x1cftypavif\x00\x00\x00\x00": "avif",
+            b"\x00\x00\x00\x18ftypcrx \x00\x00\x00\x01": "cr3",
+            b"BM\x36\x00\x0c\x00\x00\x00\x00\x00\x36\x00\x00\x00\x28\x00\x00\x00": "bmp",
+        }
+        for header, expected in headers.items():
+            self.assertEqual(sniff_image_type(header), expected)
+
+    def test_unknown(self):
+        self.assertIsNone(sniff_image_type(b""))
+        self.assertIsNone(sniff_image_type(b"hello world, not an image"))
+        self.assertIsNone(sniff_image_type(b"\x00\x00\x00\x18ftypisom"))
+        # Plenty of text files start with 'BM'
+        self.assertIsNone(sniff_image_type(b"BMW owners manual, chapter one"))
+
+
+class TestImageHelperTyping(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as fout:
+            fout.write(data)
+        return path
+
+    def test_sniffed_type(self):
+        ih = ImageHelper(self.write("a.gif", b"GIF89a" + bytes(64)))
+        ih.check_image_type()
+        self.assertTrue(ih.is_image)
+        self.assertEqual(ih.img_type, "gif")
+
+    def test_libmagic_fallback(self):
+        ih = ImageHelper(self.write("a.txt", b"just some text\n" * 10))
+        ih.check_image_type()
+        self.assertFalse(ih.is_image)
+        self.assertIn("text", ih.img_type)
+
+    def test_header_reused_by_read(self):
+        data = b"\xff\xd8\xff\xe0" + os.urandom(ImageHelper.magic_buffer * 3)
+        ih = ImageHelper(self.write("a.jpg", data))
+        ih.check_image_type()
+        self.assertEqual(len(ih.header), ImageHelper.magic_buffer)
+        ih.read_image()
+        self.assertEqual(bytes(ih.data), data)
+
+        streamed = ImageHelper(ih.full_path)
+        streamed.check_image_type()
+        streamed.read_image(keep_data=False)
+        self.assertEqual(streamed.md5, ih.md5)
+        self.assertEqual(streamed.data, b"")
+
+        plain = ImageHelper(ih.full_path)
+        plain.read_image()
+        self.assertEqual(plain.md5, ih.md5)
+        self.assertEqual(plain.crc32, ih.crc32)
+
+
+if __name__ == "__main__":
+    unittest.main()
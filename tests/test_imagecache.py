@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 
+import asyncio
+import hashlib
+import mmap
 import os
 import shutil
+import sqlite3
 import sys
 import tempfile
 
 import unittest
+from unittest import mock
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
 
 # Insert the src directory for our code to the beginning of the path
 sys.path.insert(
@@ -19,7 +27,19 @@ sys.path.insert(
 )
 
 from image_cache import ImageCache
+from image_cache import hash_image
+from image_cache import jpeg_scan_digest
+from image_cache import read_ahead
 from image_cache import ImageHelper
+from image_cache import same_pixels
+from image_cache import SCHEMA_VERSION
+
+
+def async_test(coro):
+    def wrapper(*args, **kwargs):
+        loop = asyncio.new_event_loop()
+        return loop.run_until_complete(coro(*args, **kwargs))
+    return wrapper
 
 
 class TestImageCache(unittest.TestCase):
@@ -36,6 +56,854 @@ class TestImageCache(unittest.TestCase):
     def test_ic_get_table_name(self):
         self.assertIsInstance(self.ic.get_table(), str)
 
+    def test_ic_rejects_unknown_worker_mode(self):
+        with self.assertRaises(ValueError):
+            ImageCache(worker_mode="fibers")
+
+
+class TestImageCacheGeneration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='ic-tests')
+        self.db = os.path.join(self.tmpdir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @async_test
+    async def test_gen_cache_process_pool(self):
+        ic = ImageCache(db_name=self.db, workers=2, worker_mode='process')
+        await ic.gen_cache_from_directory('./tests/img')
+        self.assertEqual(ic.get_count(), 4)
+        row = ic.lookup("WHERE filename = 'rick_and_morty_1.png'")
+        self.assertEqual(row[4], "d0dc519b6b46614c390aea7a6b5ff8ae")
+        self.assertEqual(row[6], "c10e372dce8369b5")
+
+    @async_test
+    async def test_gen_cache_thread_pool(self):
+        ic = ImageCache(db_name=self.db, workers=2, worker_mode='thread')
+        await ic.gen_cache_from_directory('./tests/img')
+        self.assertEqual(ic.get_count(), 4)
+
+    @async_test
+    async def test_gen_cache_io_concurrency(self):
+        columns = "full_path, crc32, md5, ahash, phash, dhash, whash, size"
+        expected = ImageCache(db_name=self.db, worker_mode='thread')
+        await expected.gen_cache_from_directory('./tests/img')
+        rows = expected.query(
+            f"SELECT {columns} FROM {expected.get_table()} ORDER BY full_path"
+        )
+        for mode in ('thread', 'process'):
+            ic = ImageCache(
+                db_name=self.db, table_name=f"io_{mode}", workers=2,
+                worker_mode=mode, io_concurrency=4
+            )
+            await ic.gen_cache_from_directory('./tests/img')
+            self.assertEqual(
+                ic.query(f"SELECT {columns} FROM io_{mode} ORDER BY full_path"),
+                rows
+            )
+            self.assertEqual(ic.metrics.snapshot()["counters"]["files"], 4)
+
+    @async_test
+    async def test_gen_cache_metrics(self):
+        events = []
+        ic = ImageCache(
+            db_name=self.db, worker_mode='thread', progress_interval=0,
+            hooks=(lambda event, snapshot: events.append((event, snapshot)),)
+        )
+        await ic.gen_cache_from_directory('./tests/img')
+        event, snapshot = events[-1]
+        self.assertEqual(event, "finished")
+        self.assertIn("progress", [e for e, _ in events])
+        self.assertEqual(snapshot["counters"]["files"], 4)
+        for stage in ("walk", "type_check", "read", "digest", "decode",
+                      "imagehash", "sqlite_insert"):
+            self.assertIn(stage, snapshot["stages"])
+        self.assertEqual(snapshot["stages"]["sqlite_insert"]["count"], 4)
+        self.assertGreater(snapshot["queues"]["jobs"]["max"], 0)
+
+    @async_test
+    async def test_refresh_only_rehashes_changes(self):
+        source = os.path.join(self.tmpdir, 'img')
+        shutil.copytree('./tests/img', source)
+        ic = ImageCache(db_name=self.db, worker_mode='thread', refresh=True)
+        await ic.gen_cache_from_directory(source)
+        self.assertEqual(ic.get_count(), 4)
+        before = dict(ic.query(f"SELECT full_path, id FROM {ic.get_table()}"))
+
+        changed = os.path.join(source, 'rick_and_morty_2.png')
+        with open(changed, 'ab') as fout:
+            fout.write(b'\0')
+        os.remove(os.path.join(source, 'exif2.jpg'))
+
+        await ic.gen_cache_from_directory(source)
+        after = dict(ic.query(f"SELECT full_path, id FROM {ic.get_table()}"))
+        self.assertEqual(len(after), 3)
+        self.assertNotIn(os.path.join(source, 'exif2.jpg'), after)
+        self.assertNotEqual(before[changed], after[changed])
+        unchanged = os.path.join(source, 'exif1.jpg')
+        self.assertEqual(before[unchanged], after[unchanged])
+
+    @async_test
+    async def test_refresh_keeps_rows_it_did_not_walk(self):
+        source = os.path.join(self.tmpdir, 'photos')
+        sibling = os.path.join(self.tmpdir, 'photos_backup')
+        shutil.copytree('./tests/img', source)
+        shutil.copytree('./tests/img', sibling)
+        ic = ImageCache(db_name=self.db, worker_mode='thread', refresh=True)
+        await ic.gen_cache_from_directory(sibling)
+        await ic.gen_cache_from_directory(source)
+        self.assertEqual(ic.get_count(), 8)
+
+        # Files the walk filters out aren't deleted, nor are those of a
+        # directory it never listed
+        hidden = os.path.join(source, 'hidden')
+        os.makedirs(hidden)
+        shutil.copy('./tests/img/exif1.jpg', hidden)
+        await ic.gen_cache_from_directory(source)
+        self.assertEqual(ic.get_count(), 9)
+        ic = ImageCache(
+            db_name=self.db, worker_mode='thread', refresh=True,
+            include=('*.png',), exclude=('hidden',)
+        )
+        await ic.gen_cache_from_directory(source)
+        self.assertEqual(ic.get_count(), 9)
+
+        # Nor are those of a directory which fails to list
+        ic = ImageCache(db_name=self.db, worker_mode='thread', refresh=True)
+        scandir = os.scandir
+
+        def failing(path):
+            if path == hidden:
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+
+        with mock.patch('scanner.os.scandir', side_effect=failing):
+            await ic.gen_cache_from_directory(source)
+        self.assertEqual(ic.get_count(), 9)
+
+        # A directory which is gone takes its rows with it
+        shutil.rmtree(hidden)
+        await ic.gen_cache_from_directory(source)
+        self.assertEqual(ic.get_count(), 8)
+
+    def test_refresh_queues_stale_rows(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        image = hash_image('./tests/img/exif1.jpg')
+        ic.insert(image)
+        ic.flush()
+        known = ic._load_known('./tests/img')
+        known[image.full_path] = (image.size, image.mtime - 1, image.inode)
+        self.assertFalse(ic._is_unchanged(image, known))
+        # Dropped with the next batch rather than committed on its own
+        self.assertEqual(ic.get_count(), 1)
+        self.assertEqual(ic.by_md5(image.md5), [])
+        self.assertEqual(ic.get_count(), 0)
+
+    def test_migrates_missing_columns(self):
+        conn = sqlite3.connect(self.db)
+        conn.execute(
+            "CREATE TABLE image_cache (id INTEGER PRIMARY KEY, "
+            "filename TEXT NOT NULL, full_path TEXT NOT NULL, "
+            "crc32 TEXT NOT NULL, md5 TEXT NOT NULL, ahash TEXT, phash TEXT, "
+            "dhash TEXT, whash TEXT, size INTEGER NOT NULL, "
+            "img_type TEXT NOT NULL)"
+        )
+        for _ in range(2):
+            conn.execute(
+                "INSERT INTO image_cache (filename, full_path, crc32, md5, "
+                "size, img_type) VALUES ('a.png', '/a.png', '0', '0', 1, 'png')"
+            )
+        conn.commit()
+        conn.close()
+        ic = ImageCache(db_name=self.db)
+        columns = [r[1] for r in ic.query("PRAGMA table_info(image_cache)")]
+        self.assertIn('mtime', columns)
+        self.assertIn('inode', columns)
+        self.assertIn('date_taken', columns)
+        self.assertIn('gps_longitude', columns)
+        self.assertEqual(ic.get_count(), 1)
+        self.assertEqual(
+            ic.query(
+                "SELECT value FROM image_cache_meta WHERE key = 'schema_version'"
+            )[0][0],
+            SCHEMA_VERSION
+        )
+
+
+    def test_migrates_tables_separately(self):
+        conn = sqlite3.connect(self.db)
+        conn.execute(
+            "CREATE TABLE image_cache (id INTEGER PRIMARY KEY, "
+            "filename TEXT NOT NULL, full_path TEXT NOT NULL, "
+            "crc32 TEXT NOT NULL, md5 TEXT NOT NULL, ahash TEXT, phash TEXT, "
+            "dhash TEXT, whash TEXT, size INTEGER NOT NULL, "
+            "img_type TEXT NOT NULL)"
+        )
+        conn.commit()
+        conn.close()
+        # A new cache in the same database doesn't count as migrating this one
+        ImageCache(db_name=self.db, table_name='other')
+        ic = ImageCache(db_name=self.db)
+        self.assertEqual(ic.get_count(), 0)
+        columns = [r[1] for r in ic.query("PRAGMA table_info(image_cache)")]
+        self.assertIn('pixel_hash', columns)
+
+    @async_test
+    async def test_caches_exif(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory('./tests/img')
+        rows = ic.query(
+            f"SELECT filename, date_taken, camera_model, width, height, "
+            f"orientation, gps_latitude FROM {ic.get_table()} ORDER BY filename"
+        )
+        self.assertEqual(
+            rows[0],
+            ('exif1.jpg', '2012:07:20 20:49:25', 'Canon PowerShot SD1400 IS',
+             4320, 3240, 1, None)
+        )
+        self.assertEqual(rows[1][1:3], ('2010:01:23 12:32:13', 'FE4000,X920,X925'))
+        self.assertEqual(
+            rows[2], ('rick_and_morty_1.png', None, None, 729, 486, None, None)
+        )
+
+    @async_test
+    async def test_resume_interrupted_scan(self):
+        ic = ImageCache(db_name=self.db, workers=1, worker_mode='thread', batch_size=1)
+        recorded = []
+
+        def interrupted(image):
+            if len(recorded) == 2:
+                raise InterruptedError('killed by the maintenance window')
+            recorded.append(image.full_path)
+            ImageCache.record(ic, image)
+
+        ic.record = interrupted
+        with self.assertRaises(InterruptedError):
+            await ic.gen_cache_from_directory('./tests/img')
+        self.assertEqual(ic.get_count(), 2)
+
+        resumed = ImageCache(db_name=self.db, worker_mode='thread', resume=True)
+        hashed = []
+
+        def record(image):
+            hashed.append(image.full_path)
+            ImageCache.record(resumed, image)
+
+        resumed.record = record
+        await resumed.gen_cache_from_directory('./tests/img')
+        self.assertEqual(resumed.get_count(), 4)
+        self.assertEqual(len(hashed), 2)
+        self.assertFalse(set(hashed) & set(recorded))
+
+        # Finished sessions don't keep their progress around
+        scans = resumed.query("SELECT finished FROM image_cache_scans")
+        self.assertEqual(len(scans), 1)
+        self.assertIsNotNone(scans[0][0])
+        files = resumed.query("SELECT COUNT(*) FROM image_cache_scan_files")
+        self.assertEqual(files[0][0], 0)
+
+    @async_test
+    async def test_resume_restores_targets(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        session = ic.start_scan('targets', './tests/img')
+        image = hash_image('./tests/img/rick_and_morty_1.png')
+        session.finished(image.full_path, image)
+        ic.flush()
+
+        # Without resume the unfinished session is abandoned
+        fresh = ImageCache(db_name=self.db, worker_mode='thread')
+        self.assertEqual(fresh.start_scan('targets', './tests/img').processed, set())
+
+        session = ic.start_scan('targets', './tests/img')
+        session.finished(image.full_path, image)
+        ic.flush()
+        resumed = ImageCache(db_name=self.db, worker_mode='thread', resume=True)
+        images = await resumed.hash_directory('./tests/img', perceptual=True)
+        self.assertEqual(len(images), 4)
+        restored = [i for i in images if i.full_path == image.full_path]
+        self.assertEqual(len(restored), 1)
+        self.assertEqual(restored[0].md5, image.md5)
+        self.assertEqual(restored[0].phash, image.phash)
+        self.assertEqual(restored[0].size, image.size)
+
+    @async_test
+    async def test_same_size_files_are_read_once(self):
+        source = os.path.join(self.tmpdir, 'img')
+        os.makedirs(source)
+        red = os.path.join(source, 'red.png')
+        blue = os.path.join(source, 'blue.png')
+        Image.new('RGB', (64, 64), (255, 0, 0)).save(red)
+        Image.new('RGB', (64, 64), (0, 0, 255)).save(blue)
+        # Pad the smaller one, anything after the image is ignored
+        sizes = {path: os.path.getsize(path) for path in (red, blue)}
+        with open(min(sizes, key=sizes.get), 'ab') as fout:
+            fout.write(b'\0' * abs(sizes[red] - sizes[blue]))
+        os.rename(blue, os.path.join(self.tmpdir, 'blue.png'))
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory(source)
+
+        # Same size, different partial digest, so decoded on the first read
+        os.rename(os.path.join(self.tmpdir, 'blue.png'), blue)
+        with mock.patch('image_cache.hash_image', wraps=hash_image) as hasher:
+            await ic.gen_cache_from_directory(source)
+        self.assertEqual([c[0][0] for c in hasher.call_args_list].count(blue), 1)
+        self.assertTrue(ic.lookup("WHERE full_path = ?", (blue,))[6])
+
+    @async_test
+    async def test_copies_share_content(self):
+        source = os.path.join(self.tmpdir, 'img')
+        shutil.copytree('./tests/img', source)
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        ic.duplicates = []
+        await ic.gen_cache_from_directory(source)
+
+        # A copy is only digested, its path points at the cached content
+        copy = os.path.join(source, 'copy.png')
+        shutil.copy(os.path.join(source, 'rick_and_morty_1.png'), copy)
+        ic.metrics.stages.clear()
+        await ic.gen_cache_from_directory(source)
+        self.assertNotIn('decode', ic.metrics.stages)
+        self.assertIn(
+            {'original': os.path.join(source, 'rick_and_morty_1.png'),
+             'duplicate': copy},
+            ic.get_duplicates()
+        )
+        row = ic.lookup("WHERE full_path = ?", (copy,))
+        self.assertEqual(row[6], "c10e372dce8369b5")
+        table = ic.get_table()
+        self.assertEqual(ic.get_count(), 5)
+        self.assertEqual(ic.query(f"SELECT COUNT(*) FROM {table}_content")[0][0], 4)
+
+        # Content stays cached until no path points at it
+        ic.delete(copy)
+        self.assertEqual(ic.query(f"SELECT COUNT(*) FROM {table}_content")[0][0], 4)
+        ic.delete(os.path.join(source, 'rick_and_morty_1.png'))
+        self.assertEqual(ic.query(f"SELECT COUNT(*) FROM {table}_content")[0][0], 3)
+
+    @async_test
+    async def test_copy_with_new_content_is_decoded(self):
+        source = os.path.join(self.tmpdir, 'img')
+        shutil.copytree('./tests/img', source)
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory(source)
+
+        # Same size as a cached file, but different bytes
+        original = os.path.join(source, 'rick_and_morty_1.png')
+        changed = os.path.join(source, 'changed.png')
+        with open(original, 'rb') as fin:
+            data = bytearray(fin.read())
+        data[-1] ^= 0xFF
+        with open(changed, 'wb') as fout:
+            fout.write(data)
+        await ic.gen_cache_from_directory(source)
+        row = ic.lookup("WHERE full_path = ?", (changed,))
+        self.assertEqual(row[4], hashlib.md5(data).hexdigest())
+        self.assertTrue(row[6])
+
+    def _verify_targets(self):
+        target = os.path.join(self.tmpdir, 'target')
+        os.makedirs(target)
+        original = './tests/img/rick_and_morty_1.png'
+        shutil.copyfile(original, os.path.join(target, 'copy.png'))
+        # Same size and partial digest, different bytes in the middle
+        with open(original, 'rb') as fin:
+            data = bytearray(fin.read())
+        data[len(data) // 2] ^= 0xFF
+        with open(os.path.join(target, 'flipped.png'), 'wb') as fout:
+            fout.write(data)
+        # The same pixels with different metadata
+        info = PngInfo()
+        info.add_text('Comment', 'tagged')
+        with Image.open(original) as img:
+            img.save(os.path.join(target, 'tagged.png'), pnginfo=info)
+        Image.new('RGB', (64, 64), (255, 0, 0)).save(
+            os.path.join(target, 'new.png')
+        )
+        return target
+
+    def test_same_pixels_palette_and_frames(self):
+        paths = {}
+        for name, colour in (('red', (255, 0, 0)), ('blue', (0, 0, 255))):
+            paths[name] = os.path.join(self.tmpdir, f'{name}.png')
+            Image.new('RGB', (64, 64), colour).convert('P').save(paths[name])
+        self.assertFalse(same_pixels(paths['red'], paths['blue']))
+        self.assertTrue(same_pixels(paths['red'], paths['red']))
+
+        frames = [Image.new('RGB', (16, 16), (c, 0, 0)) for c in (0, 255, 128)]
+        for name, last in (('first', frames[1]), ('second', frames[2])):
+            paths[name] = os.path.join(self.tmpdir, f'{name}.gif')
+            frames[0].save(paths[name], save_all=True, append_images=[last])
+        self.assertFalse(same_pixels(paths['first'], paths['second']))
+        self.assertTrue(same_pixels(paths['first'], paths['first']))
+
+    @async_test
+    async def test_verify_levels(self):
+        target = self._verify_targets()
+        expected = {
+            'size': ['copy.png', 'flipped.png'],
+            'partial': ['copy.png', 'flipped.png'],
+            'md5': ['copy.png'],
+            'pixels': ['copy.png', 'tagged.png'],
+        }
+        for level, duplicates in expected.items():
+            ic = ImageCache(db_name=self.db, worker_mode='thread', verify=level)
+            await ic.gen_cache_from_directory('./tests/img')
+            _, classified = await ic.verify_directory(target)
+            self.assertEqual(
+                [os.path.basename(full) for full, _ in classified["duplicates"]],
+                duplicates
+            )
+            self.assertEqual(
+                len(classified["migrate"]) + len(classified["duplicates"]), 4
+            )
+            counters = ic.metrics.snapshot()["counters"]
+            if level == 'md5':
+                # Only the two files colliding on size and partial were read
+                self.assertEqual(counters["verify_md5"], 2)
+                self.assertEqual(counters["verify_size"], 2)
+
+    @async_test
+    async def test_verify_partial_without_cached_partials(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread', verify='partial')
+        await ic.gen_cache_from_directory('./tests/img')
+        # Caches from before partial digests existed
+        ic.query(f"UPDATE {ic.get_table()}_paths SET partial = NULL")
+        target = os.path.join(self.tmpdir, 'target')
+        os.makedirs(target)
+        with open('./tests/img/exif1.jpg', 'rb') as fin:
+            data = bytearray(fin.read())
+        data[-100] ^= 0xFF
+        with open(os.path.join(target, 'changed.jpg'), 'wb') as fout:
+            fout.write(data)
+        shutil.copy('./tests/img/exif2.jpg', os.path.join(target, 'copy.jpg'))
+
+        # The size alone settles nothing, both are read in full
+        _, classified = await ic.verify_directory(target)
+        self.assertEqual(
+            [os.path.basename(full) for full, _ in classified["duplicates"]],
+            ['copy.jpg']
+        )
+        self.assertEqual(
+            [os.path.basename(full) for full, _ in classified["migrate"]],
+            ['changed.jpg']
+        )
+        self.assertEqual(ic.metrics.snapshot()["counters"]["verify_md5"], 2)
+
+    def test_rejects_unknown_verify_level(self):
+        with self.assertRaises(ValueError):
+            ImageCache(db_name=self.db, verify="bytes")
+
+    @async_test
+    async def test_gen_stats_for_file_verify(self):
+        target = self._verify_targets()
+        ic = ImageCache(db_name=self.db, worker_mode='thread', verify='partial')
+        await ic.gen_cache_from_directory('./tests/img')
+        ic.duplicates.clear()
+        await ic.gen_stats_for_file(os.path.join(target, 'flipped.png'))
+        await ic.gen_stats_for_file(os.path.join(target, 'new.png'))
+        self.assertEqual(
+            [d["duplicate"] for d in ic.duplicates],
+            [os.path.join(target, 'flipped.png')]
+        )
+        # Copies proven without reading them aren't stored, new files are
+        ic.flush()
+        self.assertEqual(ic.get_count(), 5)
+        self.assertTrue(ic.lookup("WHERE filename = 'new.png'")[6])
+
+    def test_splits_existing_cache(self):
+        conn = sqlite3.connect(self.db)
+        conn.execute(
+            "CREATE TABLE image_cache (id INTEGER PRIMARY KEY, "
+            "filename TEXT NOT NULL, full_path TEXT NOT NULL, "
+            "crc32 TEXT NOT NULL, md5 TEXT NOT NULL, ahash TEXT, phash TEXT, "
+            "dhash TEXT, whash TEXT, size INTEGER NOT NULL, "
+            "img_type TEXT NOT NULL)"
+        )
+        conn.executemany(
+            "INSERT INTO image_cache (filename, full_path, crc32, md5, phash, "
+            "size, img_type) VALUES (?, ?, ?, ?, ?, ?, 'png')",
+            [('a.png', '/a.png', '1', 'aa', 'c10e372dce8369b5', 1),
+             ('b.png', '/b.png', '1', 'aa', 'c10e372dce8369b5', 1),
+             ('c.png', '/c.png', '', '', '', 2)]
+        )
+        conn.commit()
+        conn.close()
+        ic = ImageCache(db_name=self.db)
+        self.assertEqual(ic.get_count(), 3)
+        self.assertEqual(
+            ic.query("SELECT COUNT(*) FROM image_cache_content")[0][0], 1
+        )
+        self.assertEqual(ic.by_md5('aa')[6], 'c10e372dce8369b5')
+        self.assertEqual(ic.by_crc_size('00000001', 1)[2], '/a.png')
+        self.assertIsNone(ic.lookup("WHERE full_path = '/c.png'")[4])
+
+    def test_new_table_in_migrated_database(self):
+        ImageCache(db_name=self.db)
+        ic = ImageCache(db_name=self.db, table_name='second')
+        tables = [r[0] for r in ic.query("SELECT name FROM sqlite_master")]
+        self.assertIn('second_scans', tables)
+        self.assertIn('second_paths_md5', tables)
+
+    @async_test
+    async def test_find_similar(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory('./tests/img')
+        # A couple of flipped bits should still land on the original
+        near = f"{int('c10e372dce8369b5', 16) ^ 0b101:016x}"
+        matches = ic.find_similar(near, 4)
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0][0], 2)
+        self.assertTrue(matches[0][1].endswith('rick_and_morty_1.png'))
+        self.assertEqual(ic.find_similar(near, 1), [])
+        with self.assertRaises(ValueError):
+            ic.find_similar(near, 4, hash_name='md5')
+
+    @async_test
+    async def test_find_clusters(self):
+        source = os.path.join(self.tmpdir, 'img')
+        shutil.copytree('./tests/img', source)
+        small = Image.open(os.path.join(source, 'rick_and_morty_1.png'))
+        small.resize((364, 243)).save(os.path.join(source, 'small.png'))
+
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory(source)
+        clusters = ic.find_clusters(4)
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(
+            sorted(os.path.basename(p) for p in clusters[0]),
+            ['rick_and_morty_1.png', 'small.png'],
+        )
+
+    @async_test
+    async def test_classify_targets(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory('./tests/img')
+
+        target = os.path.join(self.tmpdir, "it's a target")
+        os.makedirs(target)
+        shutil.copy('./tests/img/exif1.jpg', target)
+        shutil.copy('./tests/img/exif2.jpg', os.path.join(target, 'new.jpg'))
+        images = await ic.hash_directory(target)
+        # Fake a crc32 collision with a source file of the same size
+        ambiguous = next(i for i in images if i.filename == 'new.jpg')
+        ambiguous.md5, ambiguous.pixel_hash = '0' * 32, ''
+        ambiguous.full_path = os.path.join(target, 'ambiguous.jpg')
+        unique = ImageHelper('./tests/img/exif2.jpg')
+        unique.full_path = os.path.join(target, 'unique.jpg')
+        unique.md5, unique.crc32 = '1' * 32, '00000000'
+        images.append(unique)
+
+        result = ic.classify_targets(images)
+        self.assertEqual(
+            result['duplicates'],
+            [(os.path.join(target, 'exif1.jpg'), './tests/img/exif1.jpg')],
+        )
+        self.assertEqual(
+            result['ambiguous'],
+            [(os.path.join(target, 'ambiguous.jpg'), './tests/img/exif2.jpg')],
+        )
+        self.assertEqual(result['migrate'], [(unique.full_path, None)])
+
+    def _retag(self, original, target):
+        # Add a comment and an APP13 segment, the pixels are left alone
+        with open(original, 'rb') as fin:
+            data = fin.read()
+        comment = b'retagged'
+        segments = (
+            b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment
+            + b'\xff\xed' + (len(comment) + 2).to_bytes(2, 'big') + comment
+        )
+        with open(target, 'wb') as fout:
+            fout.write(data[:2] + segments + data[2:])
+
+    def test_pixel_hash_ignores_metadata(self):
+        retagged = os.path.join(self.tmpdir, 'retagged.jpg')
+        self._retag('./tests/img/exif1.jpg', retagged)
+        original = hash_image('./tests/img/exif1.jpg')
+        image = hash_image(retagged, perceptual=False)
+        self.assertNotEqual(image.md5, original.md5)
+        self.assertEqual(image.pixel_hash, original.pixel_hash)
+        with open(retagged, 'rb') as fin:
+            self.assertEqual(jpeg_scan_digest(fin.read()), original.pixel_hash)
+        self.assertEqual(jpeg_scan_digest(b'\x89PNG\r\n'), '')
+
+        # Anything else digests the decoded pixels
+        tagged = os.path.join(self.tmpdir, 'tagged.png')
+        info = PngInfo()
+        info.add_text('Comment', 'tagged')
+        with Image.open('./tests/img/rick_and_morty_1.png') as img:
+            img.save(tagged, pnginfo=info)
+        self.assertEqual(
+            hash_image(tagged).pixel_hash,
+            hash_image('./tests/img/rick_and_morty_1.png').pixel_hash
+        )
+        self.assertNotEqual(
+            hash_image(tagged).pixel_hash,
+            hash_image('./tests/img/rick_and_morty_2.png').pixel_hash
+        )
+
+    def test_pixel_hash_palette_and_frames(self):
+        hashes = []
+        for colour in ((255, 0, 0), (0, 0, 255)):
+            path = os.path.join(self.tmpdir, f'{colour[0]}.png')
+            Image.new('RGB', (64, 64), colour).convert('P').save(path)
+            hashes.append(hash_image(path).pixel_hash)
+        self.assertNotEqual(hashes[0], hashes[1])
+
+        animated = os.path.join(self.tmpdir, 'animated.gif')
+        frames = [Image.new('RGB', (16, 16), (c, 0, 0)) for c in (0, 255)]
+        frames[0].save(animated, save_all=True, append_images=frames[1:])
+        self.assertEqual(hash_image(animated).pixel_hash, '')
+
+    @async_test
+    async def test_retagged_copies_are_duplicates(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory('./tests/img')
+        target = os.path.join(self.tmpdir, 'target')
+        os.makedirs(target)
+        retagged = os.path.join(target, 'retagged.jpg')
+        self._retag('./tests/img/exif2.jpg', retagged)
+        # Anything but a JPEG is decoded for it, ImageHashes or not
+        tagged = os.path.join(target, 'tagged.png')
+        info = PngInfo()
+        info.add_text('Comment', 'tagged')
+        with Image.open('./tests/img/rick_and_morty_1.png') as img:
+            img.save(tagged, pnginfo=info)
+
+        images = await ic.hash_directory(target)
+        found = {image.full_path: image for image in images}
+        self.assertEqual(
+            ic.by_pixel_hash(found[retagged].pixel_hash)[2], './tests/img/exif2.jpg'
+        )
+        self.assertEqual(ic.by_pixel_hash(''), [])
+        self.assertEqual(found[tagged].ahash, '')
+        result = ic.classify_targets(images)
+        self.assertEqual(
+            sorted(result['duplicates']),
+            [(retagged, './tests/img/exif2.jpg'),
+             (tagged, './tests/img/rick_and_morty_1.png')]
+        )
+        self.assertEqual(result['migrate'], [])
+
+    @async_test
+    async def test_typed_lookups(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory('./tests/img')
+        md5 = "d0dc519b6b46614c390aea7a6b5ff8ae"
+        row = ic.by_md5(md5)
+        self.assertEqual(row[1], 'rick_and_morty_1.png')
+        self.assertEqual(ic.by_crc_size(row[3], row[9])[0], row[0])
+        self.assertEqual(ic.by_name_size(row[1], row[9])[0], row[0])
+        self.assertEqual(ic.by_md5("it's not there"), [])
+
+        many = ic.by_md5_many([md5, 'missing'] * 300)
+        self.assertEqual(list(many.keys()), [md5])
+        many = ic.by_name_size_many([(row[1], row[9]), ("o'brien.png", 1)])
+        self.assertEqual(list(many.keys()), [(row[1], row[9])])
+        many = ic.by_crc_size_many([(row[3], row[9])])
+        self.assertEqual(many[(row[3], row[9])][0], row[0])
+
+    def test_quoted_paths_are_untouched(self):
+        quoted = os.path.join(self.tmpdir, "it's \"quoted\".png")
+        shutil.copy('./tests/img/rick_and_morty_1.png', quoted)
+        ih = ImageHelper(quoted)
+        self.assertEqual(ih.full_path, quoted)
+        ic = ImageCache(db_name=self.db)
+        ih.read_image()
+        ic.insert(ih)
+        ic.flush()
+        self.assertEqual(ic.by_name_size(ih.filename, ih.size)[2], quoted)
+        self.assertTrue(os.path.exists(quoted))
+
+    @async_test
+    async def test_size_first_only_hashes_collisions(self):
+        source = os.path.join(self.tmpdir, 'img')
+        shutil.copytree('./tests/img', source)
+        shutil.copy('./tests/img/exif1.jpg', os.path.join(source, 'copy.jpg'))
+        ic = ImageCache(db_name=self.db, worker_mode='thread', size_first=True)
+        ic.duplicates = []
+        await ic.gen_cache_from_directory(source)
+
+        # The two copies collide and are fully hashed, one is a duplicate
+        self.assertEqual(len(ic.get_duplicates()), 1)
+        rows = dict(ic.query(f"SELECT filename, md5 FROM {ic.get_table()}"))
+        self.assertEqual(len(rows), 5)
+        self.assertIsNone(rows['rick_and_morty_1.png'])
+        self.assertIsNone(rows['exif2.jpg'])
+        self.assertEqual(
+            [v for k, v in rows.items() if k in ('exif1.jpg', 'copy.jpg')],
+            ['515667663c094cc7402355d6f2100273'] * 2,
+        )
+
+        # A target of the same size fills in the missing digests
+        size = os.stat(os.path.join(source, 'exif2.jpg')).st_size
+        self.assertEqual(await ic.complete_digests([size]), 1)
+        self.assertEqual(
+            ic.by_md5('c9afc8582daedf0b6da09f41208e4aa5')[1], 'exif2.jpg'
+        )
+        # JPEGs get their pixel hash without being decoded
+        self.assertEqual(
+            ic.by_md5('c9afc8582daedf0b6da09f41208e4aa5')[-1],
+            hash_image('./tests/img/exif2.jpg').pixel_hash
+        )
+
+    @async_test
+    async def test_size_first_rerun_reads_nothing(self):
+        source = os.path.join(self.tmpdir, 'img')
+        shutil.copytree('./tests/img', source)
+        ic = ImageCache(db_name=self.db, worker_mode='thread', size_first=True)
+        await ic.gen_cache_from_directory(source)
+
+        # The files' own rows don't make them collide with themselves
+        ic.duplicates = []
+        with mock.patch('image_cache.hash_image', wraps=hash_image) as hasher:
+            await ic.gen_cache_from_directory(source)
+        self.assertEqual(hasher.call_count, 0)
+        self.assertEqual(ic.get_duplicates(), [])
+        self.assertEqual(ic.get_count(), 4)
+
+    @async_test
+    async def test_copies_of_size_first_files_are_found(self):
+        first = os.path.join(self.tmpdir, 'a')
+        second = os.path.join(self.tmpdir, 'b')
+        os.makedirs(first)
+        os.makedirs(second)
+        shutil.copy('./tests/img/rick_and_morty_1.png', os.path.join(first, 'x.png'))
+        shutil.copy('./tests/img/rick_and_morty_1.png', os.path.join(second, 'y.png'))
+        await ImageCache(
+            db_name=self.db, worker_mode='thread', size_first=True
+        ).gen_cache_from_directory(first)
+
+        # The size first row has no md5 until the copy makes it read
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        ic.duplicates = []
+        await ic.gen_cache_from_directory(second)
+        self.assertEqual(
+            ic.get_duplicates(),
+            [{'original': os.path.join(first, 'x.png'),
+              'duplicate': os.path.join(second, 'y.png')}]
+        )
+        self.assertEqual(
+            ic.lookup("WHERE full_path = ?", (os.path.join(first, 'x.png'),))[4],
+            hash_image('./tests/img/rick_and_morty_1.png').md5
+        )
+
+    def test_partial_digest_matches_streamed(self):
+        small = ImageHelper('./tests/img/rick_and_morty_1.png')
+        small.read_image()
+        small.compute_partial()
+        large = ImageHelper('./tests/img/rick_and_morty_1.png')
+        large.compute_partial()
+        self.assertEqual(small.partial, large.partial)
+        self.assertNotEqual(small.partial, small.md5)
+
+    def test_inserts_are_batched(self):
+        ic = ImageCache(db_name=self.db, batch_size=2, commit_interval=60)
+        first = ImageHelper('./tests/img/rick_and_morty_1.png')
+        first.read_image()
+        first.compute_md5()
+        ic.insert(first)
+        self.assertEqual(ic.get_count(), 0)
+
+        # Queued rows are still found by the duplicate checks
+        dupe = ImageHelper('./tests/img/rick_and_morty_1.png')
+        dupe.md5 = first.md5
+        self.assertEqual(ic.by_md5(dupe.md5)[2], first.full_path)
+
+        second = ImageHelper('./tests/img/rick_and_morty_2.png')
+        ic.insert(second)
+        self.assertEqual(ic.get_count(), 2)
+
+    @async_test
+    async def test_pipeline_is_bounded(self):
+        ic = ImageCache(
+            db_name=self.db, workers=1, worker_mode='thread', queue_size=2
+        )
+        counts = {'produced': 0, 'consumed': 0, 'outstanding': 0}
+
+        def jobs():
+            for i in range(100):
+                counts['produced'] += 1
+                counts['outstanding'] = max(
+                    counts['outstanding'], counts['produced'] - counts['consumed']
+                )
+                yield (i,)
+
+        def consume(item):
+            counts['consumed'] += 1
+
+        with ic._executor() as executor:
+            await ic._pipeline(executor, lambda i: i, jobs(), consume)
+        self.assertEqual(counts['consumed'], 100)
+        # Two queues of two plus the two hashers, never the whole backlog
+        self.assertLessEqual(counts['outstanding'], 7)
+
+    @async_test
+    async def test_pipeline_raises_consume_errors(self):
+        ic = ImageCache(db_name=self.db, workers=1, worker_mode='thread', queue_size=1)
+
+        def consume(item):
+            raise sqlite3.OperationalError('disk I/O error')
+
+        with ic._executor() as executor:
+            with self.assertRaises(sqlite3.OperationalError):
+                await ic._pipeline(
+                    executor, lambda i: i, [(i,) for i in range(10)], consume
+                )
+
+    def test_connection_uses_wal(self):
+        ic = ImageCache(db_name=self.db)
+        self.assertEqual(ic.query("PRAGMA journal_mode")[0][0], 'wal')
+
+    def test_lookups_use_indexes(self):
+        ic = ImageCache(db_name=self.db)
+        for kind, key in (
+            ("md5", (b'\xab',)),
+            ("crc_size", (1, 1)),
+            ("name_size", ('abc', 1)),
+            ("pixel_hash", (b'\xab',)),
+        ):
+            plan = ic.query(f"EXPLAIN QUERY PLAN {ic._lookup_sql[kind]}", key)
+            self.assertIn('USING INDEX', plan[0][3])
+            plan = ic.query(
+                f"EXPLAIN QUERY PLAN {ic._lookup_many_sql[kind]}",
+                key * ic.lookup_chunk
+            )
+            self.assertFalse([r for r in plan if r[3] == 'SCAN p'])
+
+    @async_test
+    async def test_hashes_stored_compactly(self):
+        ic = ImageCache(db_name=self.db, worker_mode='thread')
+        await ic.gen_cache_from_directory('./tests/img')
+        table = ic.get_table()
+        types = ic.query(
+            f"""SELECT DISTINCT typeof(c.md5), typeof(c.crc32), typeof(c.phash),
+            typeof(p.md5), typeof(p.partial) FROM {table}_paths p
+            JOIN {table}_content c ON c.md5 = p.md5"""
+        )
+        self.assertEqual(types, [('blob', 'integer', 'integer', 'blob', 'blob')])
+        self.assertEqual(
+            sorted(r[0] for r in ic.query(f"SELECT img_type FROM {table}_types")),
+            ['jpeg', 'png']
+        )
+
+        # The view shows the same hex the images were hashed to
+        image = hash_image('./tests/img/rick_and_morty_1.png')
+        row = ic.by_md5(image.md5)
+        self.assertEqual(
+            row[3:10],
+            (image.crc32, image.md5, image.ahash, image.phash, image.dhash,
+             image.whash, image.size)
+        )
+        self.assertEqual(row[13], image.partial)
+        self.assertEqual(ic.by_crc_size(image.crc32, image.size)[2], row[2])
+        for h in ('ahash', 'phash', 'dhash', 'whash'):
+            self.assertEqual(
+                ic.find_similar(getattr(image, h), 0, hash_name=h)[0][1], row[2]
+            )
+
 
 class TestImageHelper(unittest.TestCase):
 
@@ -61,10 +929,7 @@ class TestImageHelper(unittest.TestCase):
         self.assertIsNot(self.ih.filename, "")
 
         self.assertIsInstance(self.ih.img_type, str)
-        self.assertEqual(
-            self.ih.img_type, 
-            "png image data, 729 x 486, 8-bit/color rgba, non-interlaced"
-        )
+        self.assertEqual(self.ih.img_type, "png")
 
         self.assertGreater(len(self.ih.data), 0)
 
@@ -77,6 +942,74 @@ class TestImageHelper(unittest.TestCase):
         self.assertIsInstance(self.ih.md5, str)
         self.assertEqual(self.ih.md5, "d0dc519b6b46614c390aea7a6b5ff8ae")
 
+    def test_ih_streams_large_files(self):
+        # Files over the buffer limit are hashed without being kept around
+        ih = ImageHelper(self.rnm1)
+        ih.buffer_limit = 1024
+        ih.read_image()
+        self.assertEqual(len(ih.data), 0)
+        self.assertEqual(ih.crc32, self.ih.crc32)
+        self.assertEqual(ih.md5, "d0dc519b6b46614c390aea7a6b5ff8ae")
+
+    def test_hash_image_read_ahead(self):
+        data = read_ahead(self.rnm1)
+        self.assertEqual(len(data), os.path.getsize(self.rnm1))
+        image = hash_image(self.rnm1, data=data)
+        expected = hash_image(self.rnm1)
+        self.assertEqual(image.md5, expected.md5)
+        self.assertEqual(image.crc32, expected.crc32)
+        self.assertEqual(image.partial, expected.partial)
+        self.assertEqual(image.phash, expected.phash)
+
+    def test_read_ahead_leaves_large_files(self):
+        limit = ImageHelper.buffer_limit
+        ImageHelper.buffer_limit = 1024
+        try:
+            self.assertIsNone(read_ahead(self.rnm1))
+        finally:
+            ImageHelper.buffer_limit = limit
+
+    def test_ih_extra_digests(self):
+        ih = ImageHelper(self.rnm1, extra_digests=("sha256", "blake2b"))
+        ih.read_image()
+        with open(self.rnm1, 'rb') as fin:
+            data = fin.read()
+        self.assertEqual(ih.digests["sha256"], hashlib.sha256(data).hexdigest())
+        self.assertEqual(ih.digests["blake2b"], hashlib.blake2b(data).hexdigest())
+        self.assertEqual(bytes(ih.data), data)
+
+    def test_ih_mmap_large_files(self):
+        mapped = ImageHelper(self.rnm1, extra_digests=('sha256',))
+        mapped.mmap_threshold = 1024
+        mapped.check_image_type()
+        mapped.read_image()
+        mapped.compute_partial()
+        mapped.compute_image_hashes()
+        self.assertIsInstance(mapped.data, mmap.mmap)
+
+        streamed = ImageHelper(self.rnm1, extra_digests=('sha256',))
+        streamed.check_image_type()
+        streamed.read_image()
+        streamed.compute_partial()
+        streamed.compute_image_hashes()
+        self.assertEqual(mapped.md5, streamed.md5)
+        self.assertEqual(mapped.crc32, streamed.crc32)
+        self.assertEqual(mapped.digests, streamed.digests)
+        self.assertEqual(mapped.partial, streamed.partial)
+        self.assertEqual(mapped.phash, streamed.phash)
+        self.assertEqual(mapped.whash, streamed.whash)
+
+        mapping = mapped.data
+        mapped.release_data()
+        self.assertTrue(mapping.closed)
+        self.assertEqual(mapped.data, b'')
+
+        unkept = ImageHelper(self.rnm1)
+        unkept.mmap_threshold = 1024
+        unkept.read_image(keep_data=False)
+        self.assertEqual(unkept.md5, streamed.md5)
+        self.assertEqual(unkept.data, b'')
+
     def test_ih_image_hash_computations(self):
         # Verify we've actually got data first
         self.ih.check_image_type()
@@ -91,6 +1024,33 @@ class TestImageHelper(unittest.TestCase):
         self.assertIsInstance(self.ih.whash, str)
         self.assertEqual(self.ih.whash, "00007cfcfc686fee")
 
+    def test_ih_jpeg_hashes_from_draft(self):
+        # JPEGs are decoded at reduced scale, the hashes should not change
+        ih = ImageHelper("./tests/img/exif1.jpg")
+        ih.check_image_type()
+        ih.read_image()
+        ih.compute_image_hashes()
+        self.assertEqual(ih.ahash, "ff7ff34dce8e0604")
+        self.assertEqual(ih.phash, "b2c027b8923765ed")
+        self.assertEqual(ih.dhash, "acc8429d943c381d")
+        self.assertEqual(ih.whash, "ff7fe30d4e8c0404")
+
+    def test_ih_exif_gps(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'gps.jpg')
+            exif = Image.Exif()
+            exif[0x0112] = 6
+            exif[0x8825] = {1: 'S', 2: (33.0, 51.0, 54.0), 3: 'E', 4: (151.0, 12.0, 36.0)}
+            Image.new('RGB', (64, 48)).save(path, exif=exif)
+
+            ih = ImageHelper(path)
+            ih.compute_exif()
+            self.assertEqual((ih.width, ih.height), (64, 48))
+            self.assertEqual(ih.orientation, 6)
+            self.assertAlmostEqual(ih.gps_latitude, -33.865)
+            self.assertAlmostEqual(ih.gps_longitude, 151.21)
+            self.assertIsNone(ih.date_taken)
+
     def test_do_not_process_non_image(self):
         # Check the file type
         non_img = ImageHelper(self.not_an_image)
@@ -8,6 +8,9 @@ import sys
 import tempfile
 
 import unittest
+from unittest import mock
+
+from PIL import Image
 
 # Insert the src directory for our code to the beginning of the path
 sys.path.insert(
@@ -20,6 +23,9 @@ sys.path.insert(
     )
 )
 
+from image_cache import ImageCache
+from image_cache import hash_image
+from image_utils import find_dupes
 from image_utils import sort_images
 
 
@@ -46,6 +52,90 @@ class TestImageUtils(unittest.TestCase):
             for f in filenames:
                 print(os.path.join(root, f))
 
+    @async_test
+    async def test_sort_images_from_cache(self):
+        db = os.path.join(self.tmpdir, 'cache.sqlite')
+        dest = os.path.join(self.tmpdir, 'sorted')
+        counts = await sort_images(
+            './tests/img', dest, db_name=db, worker_mode='thread'
+        )
+        self.assertEqual(sum(counts.values()), 2)
+        self.assertNotIn('failed', counts)
+        sorted_files = sorted(
+            os.path.relpath(os.path.join(root, f), dest)
+            for root, _, filenames in os.walk(dest)
+            for f in filenames
+        )
+        self.assertEqual(
+            sorted_files,
+            [os.path.join('2010', '1', 'exif2.jpg'),
+             os.path.join('2012', '7', 'exif1.jpg')]
+        )
+        copied = os.path.join(dest, '2012', '7', 'exif1.jpg')
+        with open(copied, 'rb') as fin, open('./tests/img/exif1.jpg', 'rb') as orig:
+            self.assertEqual(fin.read(), orig.read())
+
+        # Everything is already in place the second time around
+        counts = await sort_images('./tests/img', dest, skip=True, db_name=db)
+        self.assertEqual(counts, {'skipped': 2})
+
+    @async_test
+    async def test_sort_images_skips_unreadable(self):
+        db = os.path.join(self.tmpdir, 'cache.sqlite')
+        source = os.path.join(self.tmpdir, 'img')
+        dest = os.path.join(self.tmpdir, 'sorted')
+        os.makedirs(source)
+        shutil.copy('./tests/img/exif1.jpg', source)
+        # An image type Pillow can't open
+        with open(os.path.join(source, 'photo.heic'), 'wb') as fout:
+            fout.write(b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00' + b'\x00' * 64)
+        counts = await sort_images(source, dest, db_name=db, worker_mode='thread')
+        self.assertEqual(counts, {'copied': 1})
+
+    @async_test
+    async def test_sort_images_move(self):
+        db = os.path.join(self.tmpdir, 'cache.sqlite')
+        source = os.path.join(self.tmpdir, 'img')
+        dest = os.path.join(self.tmpdir, 'sorted')
+        shutil.copytree('./tests/img', source)
+        counts = await sort_images(
+            source, dest, transfer='move', db_name=db, worker_mode='thread'
+        )
+        self.assertEqual(counts, {'moved': 2})
+        moved = os.path.join(dest, '2012', '7', 'exif1.jpg')
+        self.assertTrue(os.path.exists(moved))
+        self.assertFalse(os.path.exists(os.path.join(source, 'exif1.jpg')))
+
+        ic = ImageCache(db_name=db)
+        self.assertEqual(ic.lookup("WHERE full_path = ?", (moved,))[1], "exif1.jpg")
+
+
+    @async_test
+    async def test_find_dupes_similar_after_failed_hash(self):
+        db = os.path.join(self.tmpdir, 'cache.sqlite')
+        target = os.path.join(self.tmpdir, 'target')
+        os.makedirs(target)
+        broken = os.path.join(target, 'new.png')
+        Image.new('RGB', (64, 64), (255, 0, 0)).save(broken)
+
+        def failing(full_path, *args, **kwargs):
+            if full_path == broken:
+                raise OSError(5, 'Input/output error', full_path)
+            return hash_image(full_path, *args, **kwargs)
+
+        # The report is written to the working directory
+        source = os.path.abspath('./tests/img')
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, cwd)
+        with mock.patch('image_cache.hash_image', side_effect=failing):
+            report = await find_dupes(
+                source, target, False, False, similarity=4,
+                db_name=db, worker_mode='thread', verify='size'
+            )
+        self.assertEqual(report['migrate'], [broken])
+        self.assertEqual(report['similar'], [])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+import time
+
+import unittest
+
+# Insert the src directory for our code to the beginning of the path
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__),
+            "../src"
+        )
+    )
+)
+
+from image_cache import ImageHelper
+from metrics import Metrics
+from metrics import log_progress
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_stages_and_counters(self):
+        metrics = Metrics()
+        metrics.add_time("read", 0.5)
+        metrics.add_time("read", 0.25, count=2)
+        with metrics.timer("sqlite_insert", 10):
+            pass
+        metrics.increment("errors")
+        metrics.queue_depth("jobs", 3)
+        metrics.queue_depth("jobs", 1)
+        snapshot = json.loads(json.dumps(metrics.snapshot()))
+        self.assertEqual(snapshot["stages"]["read"], {"seconds": 0.75, "count": 3})
+        self.assertEqual(snapshot["stages"]["sqlite_insert"]["count"], 10)
+        self.assertEqual(snapshot["counters"], {"errors": 1})
+        self.assertEqual(snapshot["queues"]["jobs"], {"current": 1, "max": 3})
+
+    def test_record_image_merges_worker_timings(self):
+        metrics = Metrics()
+        image = ImageHelper('./tests/img/rick_and_morty_1.png')
+        image.check_image_type()
+        image.read_image()
+        metrics.record_image(image)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["files"], 1)
+        self.assertEqual(snapshot["counters"]["bytes"], image.size)
+        for stage in ("type_check", "read", "digest"):
+            self.assertEqual(snapshot["stages"][stage]["count"], 1)
+
+    def test_progress_hooks(self):
+        events = []
+        metrics = Metrics(progress_interval=0)
+        metrics.add_hook(lambda event, snapshot: events.append(event))
+        metrics.add_hook(log_progress)
+        time.sleep(0.01)
+        metrics.tick()
+        metrics.emit("finished")
+        self.assertEqual(events, ["progress", "finished"])
+
+    def test_no_progress_without_interval(self):
+        events = []
+        metrics = Metrics()
+        metrics.add_hook(lambda event, snapshot: events.append(event))
+        metrics.tick()
+        self.assertEqual(events, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+
+import unittest
+
+# Insert the src directory for our code to the beginning of the path
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__),
+            "../src"
+        )
+    )
+)
+
+from image_cache import ImageHelper
+from scanner import is_walked
+from scanner import is_wanted
+from scanner import walk
+
+
+class TestScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        layout = [
+            "a.jpg",
+            "b.png",
+            "notes.txt",
+            ".hidden.jpg",
+            "sub/c.jpg",
+            "sub/deeper/d.JPG",
+            "sub/deeper/e.jpg",
+            ".git/f.jpg",
+            "@eaDir/a.jpg/SYNOFILE_THUMB_M.jpg",
+            "#recycle/g.jpg",
+            "skipme/h.jpg",
+        ]
+        for name in layout:
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fout:
+                fout.write(name.encode())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def scanned(self, **options):
+        return sorted(
+            os.path.relpath(full, self.root)
+            for _, files in walk(self.root, **options)
+            for full, _ in files
+        )
+
+    def test_walk_skips_hidden(self):
+        self.assertEqual(
+            self.scanned(),
+            [
+                "a.jpg",
+                "b.png",
+                "notes.txt",
+                "skipme/h.jpg",
+                "sub/c.jpg",
+                "sub/deeper/d.JPG",
+                "sub/deeper/e.jpg",
+            ],
+        )
+        everything = self.scanned(skip_hidden=False)
+        self.assertEqual(len(everything), 11)
+        self.assertIn(".git/f.jpg", everything)
+        self.assertIn("#recycle/g.jpg", everything)
+
+    def test_walk_globs(self):
+        self.assertEqual(
+            self.scanned(include=("*.jpg",), exclude=("skipme", "e.*")),
+            ["a.jpg", "sub/c.jpg"],
+        )
+        self.assertEqual(
+            self.scanned(include=("*.jpg", "*.JPG"), exclude=("sub",)),
+            ["a.jpg", "skipme/h.jpg"],
+        )
+
+    def test_walk_parallel(self):
+        self.assertEqual(self.scanned(workers=4), self.scanned())
+        roots = [root for root, _ in walk(self.root, workers=4)]
+        self.assertEqual(len(roots), len(set(roots)))
+        self.assertEqual(len(roots), 4)
+
+    def test_walk_stats(self):
+        for _, files in walk(self.root):
+            for full, stat in files:
+                self.assertEqual(stat, os.stat(full))
+                ih = ImageHelper(full, stat=stat)
+                self.assertEqual(ih.size, stat.st_size)
+                self.assertEqual(ih.inode, stat.st_ino)
+
+    def test_walk_skip_files(self):
+        skip = set([os.path.join(self.root, 'sub')])
+        self.assertEqual(
+            self.scanned(skip_files=skip),
+            ["a.jpg", "b.png", "notes.txt", "skipme/h.jpg",
+             "sub/deeper/d.JPG", "sub/deeper/e.jpg"],
+        )
+
+    def test_walk_missing(self):
+        # A directory which can't be listed isn't mistaken for an empty one
+        missing = os.path.join(self.root, "missing")
+        self.assertEqual(list(walk(missing)), [])
+        self.assertEqual(list(walk(missing, workers=2)), [])
+        for workers in (1, 2):
+            failed = []
+            list(walk(missing, workers=workers, failed=failed.append))
+            self.assertEqual(failed, [missing])
+
+    def test_is_wanted(self):
+        self.assertTrue(is_wanted("a.jpg"))
+        self.assertFalse(is_wanted(".hidden.jpg"))
+        self.assertTrue(is_wanted(".hidden.jpg", skip_hidden=False))
+        self.assertFalse(is_wanted("notes.txt", include=("*.jpg",)))
+        self.assertFalse(is_wanted("e.jpg", exclude=("e.*",)))
+
+    def test_is_walked(self):
+        root = os.path.join(self.root, "photos")
+        self.assertTrue(is_walked(os.path.join(root, "gone", "a.jpg"), root))
+        self.assertFalse(is_walked(os.path.join(root, ".git", "a.jpg"), root))
+        self.assertFalse(
+            is_walked(os.path.join(root, "raw", "a.jpg"), root, exclude=("raw",))
+        )
+        self.assertFalse(is_walked(os.path.join(self.root, "a.jpg"), root))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import sys
+
+import numpy
+import unittest
+
+# Insert the src directory for our code to the beginning of the path
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__),
+            "../src"
+        )
+    )
+)
+
+from similarity import BKTree
+from similarity import cluster_hashes
+from similarity import hamming
+from similarity import popcount64
+from similarity import stored_to_array
+
+
+class TestBKTree(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(1234)
+        self.hashes = [rng.getrandbits(64) for _ in range(500)]
+        self.tree = BKTree()
+        for i, h in enumerate(self.hashes):
+            self.tree.add(h, i)
+
+    def test_hamming(self):
+        self.assertEqual(hamming(0b1011, 0b0001), 2)
+        self.assertEqual(hamming(0xFFFFFFFFFFFFFFFF, 0), 64)
+
+    def test_search_matches_linear_scan(self):
+        query = self.hashes[42] ^ 0b10000001
+        for radius in (0, 2, 8, 24):
+            expected = sorted(
+                i for i, h in enumerate(self.hashes) if hamming(query, h) <= radius
+            )
+            found = sorted(value for _, value in self.tree.search(query, radius))
+            self.assertEqual(found, expected)
+
+    def test_search_orders_by_distance(self):
+        self.tree.add(self.hashes[7] ^ 1, 'near')
+        matches = self.tree.search(self.hashes[7], 1)
+        self.assertEqual(matches, [(0, 7), (1, 'near')])
+
+    def test_identical_hashes_share_a_node(self):
+        self.tree.add(self.hashes[0], 'copy')
+        self.assertEqual(len(self.tree), 501)
+        self.assertEqual(
+            [v for _, v in self.tree.search(self.hashes[0], 0)], [0, 'copy']
+        )
+
+
+
+class TestClustering(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(4321)
+        # A handful of seeds, each with a few near copies, plus noise
+        self.phashes = []
+        self.dhashes = []
+        for _ in range(10):
+            p, d = rng.getrandbits(64), rng.getrandbits(64)
+            for _ in range(rng.randint(1, 4)):
+                self.phashes.append(p ^ (1 << rng.randrange(64)))
+                self.dhashes.append(d ^ (1 << rng.randrange(64)))
+        for _ in range(40):
+            self.phashes.append(rng.getrandbits(64))
+            self.dhashes.append(rng.getrandbits(64))
+
+    def brute_force(self, max_distance):
+        groups = [{i} for i in range(len(self.phashes))]
+        for i in range(len(self.phashes)):
+            for j in range(i + 1, len(self.phashes)):
+                if (hamming(self.phashes[i], self.phashes[j]) <= max_distance
+                        and hamming(self.dhashes[i], self.dhashes[j]) <= max_distance):
+                    a = next(g for g in groups if i in g)
+                    b = next(g for g in groups if j in g)
+                    if a is not b:
+                        a.update(b)
+                        groups.remove(b)
+        return sorted(sorted(g) for g in groups if len(g) > 1)
+
+    def test_popcount(self):
+        values = numpy.array([0xffffffffffffffff, 0, 0x8000000000000001], dtype=numpy.uint64)
+        self.assertEqual(popcount64(values).tolist(), [64, 0, 2])
+
+    def test_stored_to_array(self):
+        # SQLite keeps 64 bit hashes as signed integers
+        stored = [-1, 0, -(1 << 63) + 1, 0x7fffffffffffffff]
+        self.assertEqual(
+            stored_to_array(stored).tolist(),
+            [0xffffffffffffffff, 0, 0x8000000000000001, 0x7fffffffffffffff]
+        )
+
+    def test_clusters_match_brute_force(self):
+        hashes = [
+            numpy.array(self.phashes, dtype=numpy.uint64),
+            numpy.array(self.dhashes, dtype=numpy.uint64),
+        ]
+        # A small block size makes sure pairs across blocks are compared
+        for block_size in (7, 2048):
+            clusters = cluster_hashes(hashes, 2, block_size=block_size)
+            self.assertEqual(
+                sorted(sorted(c) for c in clusters), self.brute_force(2)
+            )
+            self.assertGreater(len(clusters), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
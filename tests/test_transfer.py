@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+
+import unittest
+
+from unittest import mock
+
+# Insert the src directory for our code to the beginning of the path
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__),
+            "../src"
+        )
+    )
+)
+
+from transfer import copy_file
+from transfer import transfer_file
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, 'src.jpg')
+        self.dest = os.path.join(self.tmpdir.name, 'dest.jpg')
+        self.data = os.urandom(300000)
+        with open(self.src, 'wb') as fout:
+            fout.write(self.data)
+        os.utime(self.src, (1262349133, 1262349133))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def contents(self, path):
+        with open(path, 'rb') as fin:
+            return fin.read()
+
+    def test_copy(self):
+        how = transfer_file(self.src, self.dest)
+        self.assertIn(how, ('copied', 'reflinked'))
+        self.assertEqual(self.contents(self.dest), self.data)
+        self.assertEqual(os.stat(self.dest).st_mtime, 1262349133)
+        self.assertNotEqual(os.stat(self.dest).st_ino, os.stat(self.src).st_ino)
+        self.assertTrue(os.path.exists(self.src))
+
+    def test_copy_empty_file(self):
+        open(self.src, 'wb').close()
+        copy_file(self.src, self.dest)
+        self.assertEqual(self.contents(self.dest), b'')
+
+    def test_link(self):
+        self.assertEqual(transfer_file(self.src, self.dest, 'link'), 'linked')
+        self.assertEqual(os.stat(self.dest).st_ino, os.stat(self.src).st_ino)
+
+    def test_move(self):
+        self.assertEqual(transfer_file(self.src, self.dest, 'move'), 'moved')
+        self.assertFalse(os.path.exists(self.src))
+        self.assertEqual(self.contents(self.dest), self.data)
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'), 'needs copy_file_range')
+    def test_short_copy_range_falls_back(self):
+        calls = []
+
+        def short_copy(src, dst, count, *args):
+            # Copy one block, then claim the source is exhausted
+            calls.append(count)
+            if len(calls) > 1:
+                return 0
+            return os.write(dst, os.read(src, 4096))
+
+        with mock.patch('transfer._reflink', return_value=False), \
+                mock.patch('os.copy_file_range', short_copy):
+            self.assertEqual(copy_file(self.src, self.dest), 'copied')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.contents(self.dest), self.data)
+
+    def test_move_keeps_source_after_short_copy(self):
+        def truncated(src, dest):
+            with open(dest, 'wb') as fout:
+                fout.write(self.data[:4096])
+            return 'copied'
+
+        with mock.patch('transfer.same_filesystem', return_value=False), \
+                mock.patch('transfer.copy_file', truncated):
+            with self.assertRaises(OSError):
+                transfer_file(self.src, self.dest, 'move')
+        self.assertEqual(self.contents(self.src), self.data)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            transfer_file(self.src, self.dest, 'teleport')
+
+
+if __name__ == "__main__":
+    unittest.main()